@@ -38,25 +38,47 @@ stdin/stdout filter.
 import argparse
 import cmd
 import collections.abc
+import concurrent.futures
 import dataclasses
 import datetime
+import email.utils
 import enum
+import fnmatch
+import hashlib
 import http.client
+import itertools
 import json
 import math
 import os
 import os.path
 import platform
+import queue
+import random
 import re
+import socket
+import sqlite3
 import subprocess
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import traceback
 import typing
 import urllib.parse
 
+try:
+    import fcntl
+
+except ImportError:
+    fcntl = None
+
+try:
+    import msvcrt
+
+except ImportError:
+    msvcrt = None
+
 
 is_quiet = False
 
@@ -73,8 +95,29 @@ SYSTEM_PROMPT_FILE_NAME = os.path.expanduser(
     os.path.join("~", ".ai-cat-sys.txt" if not IS_WINDOWS else "_ai-cat-sys.txt")
 )
 
+INDEX_FILE_NAME = ".ai-cat-index.sqlite" if not IS_WINDOWS else "_ai-cat-index.sqlite"
+
+BATCH_STATE_FILE_NAME = ".ai-cat-batch.json" if not IS_WINDOWS else "_ai-cat-batch.json"
+
+RESPONSE_CACHE_DIR_NAME = os.path.expanduser(
+    os.path.join("~", ".ai-cat-cache" if not IS_WINDOWS else "_ai-cat-cache")
+)
+
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+RATE_LIMITS_FILE_NAME = os.path.expanduser(
+    os.path.join("~", ".ai-cat-ratelimits.json" if not IS_WINDOWS else "_ai-cat-ratelimits.json")
+)
+
 MODELS_CACHE_TTL_SECONDS = 3 * 24 * 60 * 60
 
+DEFAULT_CONTEXT_TOKENS = 2000
+
+DEFAULT_PARALLEL_JOBS = 8
+
+DEFAULT_BATCH_POLL_SECONDS = 60.0
+BATCH_MAX_POLL_SECONDS = 30 * 60.0
+
 EXIT_CODE_ERROR = 2
 EXIT_CODE_REPLACE_FAIL = 1
 
@@ -157,7 +200,7 @@ trade-offs, etc.
 Note that even when the plugin can successfully perform the replacement, your \
 reasoning and explanation will still be shown to me.
 
-File name: {FILE_NAME!r}
+{CONTEXT}File name: {FILE_NAME!r}
 
 Selected lines:
 
@@ -166,6 +209,32 @@ Selected lines:
 --- END SELECTION ---
 """
 
+REPLACE_CONTEXT_PROMPT = """\
+Here are some snippets from other parts of the project which might be \
+relevant. They are provided for reference only, do not modify them.
+
+{SNIPPETS}
+
+"""
+
+REPLACE_CONTEXT_SNIPPET = """\
+`{PATH}` (lines {FIRST_LINE}-{LAST_LINE}):
+
+```
+{TEXT}
+```"""
+
+# Passed to providers which support predicted outputs: the explanation before
+# the replacement is unpredictable, but the replacement itself is usually
+# mostly the same as the selection.
+REPLACE_PREDICTION = """\
+--- BEGIN REPLACEMENT ---
+{LINES}
+--- END REPLACEMENT ---
+"""
+
+CASCADE_USAGE_STATUS_RE = re.compile(r"^(usage\.[^:\s]+): (.*)$", re.MULTILINE)
+
 
 def main(argv):
     global is_quiet
@@ -210,6 +279,16 @@ def main(argv):
                 " (The default when stdin is not a TTY.)"
             )
         )
+        stdio_parser.add_argument(
+            "--continue",
+            action="store_true",
+            dest="continue_response",
+            help=(
+                "Ask the AI to continue the last response of the conversation"
+                " from where it stopped (e.g. due to a timeout or a network"
+                " error)."
+            ),
+        )
 
         replace_parser = subparsers.add_parser(
             "replace",
@@ -221,12 +300,118 @@ def main(argv):
                 " printed to stdout."
             )
         )
+        replace_parser.add_argument(
+            "--context-tokens",
+            type=int,
+            default=DEFAULT_CONTEXT_TOKENS,
+            dest="context_tokens",
+            help=(
+                "Maximum number of tokens (estimated) to spend on relevant"
+                " snippets from the project index (see the index command);"
+                " 0 disables adding context."
+                f" (Default: {DEFAULT_CONTEXT_TOKENS}.)"
+            ),
+        )
         replace_parser.add_argument(
             "file_name",
             nargs=argparse.REMAINDER,
             help="Name of the file in which the lines to be replaced appear.",
         )
 
+        index_parser = subparsers.add_parser(
+            "index",
+            help=(
+                f"Create or update the {INDEX_FILE_NAME} search index in the"
+                " given directory (default: the current directory). The replace"
+                " command looks for the nearest index above the edited file,"
+                " and uses it for adding relevant snippets to the prompt."
+            )
+        )
+        index_parser.add_argument(
+            "directory",
+            nargs="?",
+            default=".",
+            help="Root directory of the project to be indexed.",
+        )
+
+        parallel_parser = subparsers.add_parser(
+            "parallel",
+            help=(
+                "Answer the conversations in the *.md files of the given"
+                " directory (default: the current directory) which end with a"
+                " User block, by sending several of them at the same time, and"
+                " write the responses back to the files. Conversations which"
+                " have already been answered are skipped, so an interrupted run"
+                " can be resumed by running the command again."
+            )
+        )
+        parallel_parser.add_argument(
+            "--jobs",
+            type=int,
+            default=DEFAULT_PARALLEL_JOBS,
+            dest="jobs",
+            help=(
+                "Maximum number of concurrent requests."
+                f" (Default: {DEFAULT_PARALLEL_JOBS}.)"
+            ),
+        )
+        parallel_parser.add_argument(
+            "--provider-jobs",
+            type=parse_provider_jobs,
+            action="append",
+            default=[],
+            dest="provider_jobs",
+            metavar="PROVIDER=N",
+            help=(
+                "Maximum number of concurrent requests for a provider, e.g."
+                " openai=4. (Can be used multiple times.)"
+            ),
+        )
+        parallel_parser.add_argument(
+            "directory",
+            nargs="?",
+            default=".",
+            help="Directory of the conversation files.",
+        )
+
+        batch_parser = subparsers.add_parser(
+            "batch",
+            help=(
+                "Answer the conversations in the *.md files of the given"
+                " directory (default: the current directory) using the batch"
+                " APIs of the providers, and write the responses back to the"
+                " files. Submitted jobs are recorded in"
+                f" {BATCH_STATE_FILE_NAME}, so an interrupted run can be"
+                " resumed by running the command again."
+            )
+        )
+        batch_parser.add_argument(
+            "--no-wait",
+            action="store_false",
+            dest="wait",
+            help=(
+                "Submit the new conversations and collect the results of the"
+                " finished jobs, but do not wait for the rest."
+            ),
+        )
+        batch_parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=DEFAULT_BATCH_POLL_SECONDS,
+            dest="poll_interval",
+            help=(
+                "Number of seconds to wait before checking the jobs again; it"
+                f" is doubled after each check, up to {BATCH_MAX_POLL_SECONDS:.0f}s."
+                f" (Default: {DEFAULT_BATCH_POLL_SECONDS:.0f}.)"
+            ),
+        )
+        batch_parser.add_argument(
+            "directory",
+            nargs="?",
+            default=".",
+            help="Directory of the conversation files.",
+        )
+
         if len(argv) > 0:
             argv.pop(0)
 
@@ -235,12 +420,23 @@ def main(argv):
         if parsed_argv.quiet:
             is_quiet = True
 
+        if parsed_argv.command == "index":
+            return cmd_index(parsed_argv.directory)
+
         state = load_state()
 
         if state is None:
             return EXIT_CODE_ERROR
 
-        api_keys_state_file, models, models_cache_updated, settings, system_prompt, editor_state_file = state
+        (
+            api_keys_state_file,
+            models,
+            models_cache_updated,
+            settings,
+            system_prompt,
+            editor_state_file,
+            client_states,
+        ) = state
 
         api_keys = collect_api_keys(api_keys_state_file)
         editor = find_editor(editor_state_file)
@@ -255,12 +451,20 @@ def main(argv):
             "xai": XAiClient,
         }
 
+        AiClient.rate_limiter = RateLimiter(RATE_LIMITS_FILE_NAME)
+        AiClient.connection_pool = ConnectionPool()
+
         ai_clients = {
             name: ai_client_cls[name](api_key)
             for name, api_key in api_keys.items()
             if name in ai_client_cls
         }
 
+        for name, ai_client in ai_clients.items():
+            ai_client.set_persistent_state(
+                get_item(client_states, name, default={}, expect_type=dict)
+            )
+
         models, models_cache_updated = ensure_up_to_date_models(
             ai_clients,
             models,
@@ -272,9 +476,19 @@ def main(argv):
         for provider, provider_models in models.items():
             models_list.extend([f"{provider}/{model}" for model in provider_models])
 
-        messenger = AiMessenger(ai_clients, models_list, system_prompt)
+        def create_messenger():
+            messenger = AiMessenger(
+                ai_clients,
+                models_list,
+                system_prompt,
+                ResponseCache(RESPONSE_CACHE_DIR_NAME),
+            )
+
+            apply_settings(messenger, settings)
+
+            return messenger
 
-        apply_settings(messenger, settings)
+        messenger = create_messenger()
 
         command = parsed_argv.command
 
@@ -287,18 +501,59 @@ def main(argv):
 
         elif command == "stdio":
             response_only = getattr(parsed_argv, "response_only", False)
-            exit_code = cmd_stdio(messenger, response_only)
+            continue_response = getattr(parsed_argv, "continue_response", False)
+            exit_code = cmd_stdio(messenger, response_only, continue_response)
 
         elif command == "replace":
-            exit_code = cmd_replace(messenger, parsed_argv.file_name)
+            exit_code = cmd_replace(
+                messenger,
+                parsed_argv.file_name,
+                parsed_argv.context_tokens,
+            )
+
+        elif command == "parallel":
+            exit_code = cmd_parallel(
+                create_messenger,
+                parsed_argv.directory,
+                parsed_argv.jobs,
+                dict(parsed_argv.provider_jobs),
+            )
+
+        elif command == "batch":
+            exit_code = cmd_batch(
+                create_messenger,
+                ai_clients,
+                parsed_argv.directory,
+                parsed_argv.wait,
+                parsed_argv.poll_interval,
+            )
 
         settings = {
             "model": messenger.get_model(),
             "reasoning": messenger.get_reasoning(),
+            "max_tokens": messenger.get_max_tokens(),
+            "tier": messenger.get_tier(),
             "streaming": messenger.get_streaming(),
             "temperature": messenger.get_temperature(),
+            "server_state": messenger.get_server_state(),
+            "cache": messenger.get_cache(),
+            "hedge": messenger.get_hedge(),
+            "hedge_delay": messenger.get_hedge_delay(),
+            "fallback": messenger.get_fallback(),
+            "compare": messenger.get_compare(),
+            "map_reduce": messenger.get_map_reduce(),
+            "cascade": messenger.get_cascade(),
+            "cascade_deadline": messenger.get_cascade_deadline(),
+            "first_token_timeout": messenger.get_first_token_timeout(),
+            "connect_timeout": messenger.get_connect_timeout(),
+            "first_byte_timeout": messenger.get_first_byte_timeout(),
+            "idle_timeout": messenger.get_idle_timeout(),
+            "total_timeout": messenger.get_total_timeout(),
         }
 
+        for name, ai_client in ai_clients.items():
+            client_states[name] = ai_client.get_persistent_state()
+
         try:
             save_state(
                 api_keys_state_file,
@@ -306,6 +561,7 @@ def main(argv):
                 models_cache_updated,
                 settings,
                 editor_state_file,
+                client_states,
             )
 
         except Exception as exc:
@@ -319,6 +575,23 @@ def main(argv):
     return exit_code
 
 
+def parse_provider_jobs(provider_jobs: str) -> tuple[str, int]:
+    provider, _, jobs = provider_jobs.partition("=")
+
+    try:
+        jobs = int(jobs)
+
+    except ValueError:
+        jobs = 0
+
+    if provider.strip() == "" or jobs < 1:
+        raise argparse.ArgumentTypeError(
+            f"expected PROVIDER=N with a positive N, got {provider_jobs!r}"
+        )
+
+    return provider.strip().lower(), jobs
+
+
 def info(message: str, end=os.linesep):
     if is_quiet:
         return
@@ -437,1036 +710,876 @@ def get_item(
     return container
 
 
+def estimate_tokens(text: str) -> int:
+    """
+    Rough, tokenizer-independent estimation of the number of tokens in the
+    given text.
+    """
+
+    return (len(text) + 3) // 4
+
+
+def split_into_chunks(text: str, max_tokens: int) -> typing.List[str]:
+    """
+    Split the text into chunks of at most max_tokens (estimated) at paragraph
+    boundaries, keeping fenced code blocks together. Blocks which are too
+    large on their own are split at line boundaries, and lines which are too
+    long are split wherever they need to be.
+    """
+
+    blocks = []
+    block_lines = []
+    is_in_code_block = False
+
+    for line in text.splitlines():
+        if line.startswith("```"):
+            is_in_code_block = not is_in_code_block
+
+        if line.strip() == "" and not is_in_code_block:
+            if len(block_lines) > 0:
+                blocks.append("\n".join(block_lines))
+                block_lines = []
+
+            continue
+
+        block_lines.append(line)
+
+    if len(block_lines) > 0:
+        blocks.append("\n".join(block_lines))
+
+    # Each piece is preceded by the separator that joins it to the previous
+    # one in the original text.
+    pieces = []
+    max_chars = max(1, max_tokens * 4)
+
+    for block in blocks:
+        if estimate_tokens(block) <= max_tokens:
+            pieces.append(("\n\n", block))
+
+            continue
+
+        separator = "\n\n"
+
+        for line in block.split("\n"):
+            while len(line) > max_chars:
+                pieces.append((separator, line[:max_chars]))
+                line = line[max_chars:]
+                separator = ""
+
+            pieces.append((separator, line))
+            separator = "\n"
+
+    chunks = []
+    chunk = ""
+
+    for separator, piece in pieces:
+        if chunk == "":
+            chunk = piece
+
+        elif estimate_tokens(chunk + separator + piece) <= max_tokens:
+            chunk += separator + piece
+
+        else:
+            chunks.append(chunk)
+            chunk = piece
+
+    if chunk.strip() != "":
+        chunks.append(chunk)
+
+    return chunks
+
+
+def hash_conversation(conversation: collections.abc.Sequence["Message"]) -> str:
+    # Texts are stripped because that's how they come back after a round trip
+    # through AiMessenger.conversation_to_str() and parsing.
+    digest = hashlib.sha256()
+
+    for message in conversation:
+        digest.update(message.type.value.encode("utf-8") + b"\0")
+        digest.update(message.text.strip().encode("utf-8") + b"\0")
+
+    return digest.hexdigest()
+
+
 class HttpError(Exception):
-    def __init__(self, status, reason, body):
+    def __init__(self, status, reason, body, headers=None):
         super().__init__(f"HTTP error: {status} ({reason}) - body: {body}")
 
         self.status = status
         self.reason = reason
         self.body = body
 
+        # Header names are lowercase.
+        self.headers = dict(headers or {})
 
-class Reasoning(str, enum.Enum):
-    DEFAULT = "default"
-    OFF = "off"
-    ON = "on"
 
+class RequestCancelledError(Exception):
+    pass
 
-class Streaming(str, enum.Enum):
-    OFF = "off"
-    ON = "on"
 
+class BatchError(Exception):
+    pass
 
-class MessageType(str, enum.Enum):
-    SYSTEM = "system"
-    SETTINGS = "settings"
-    USER = "user"
-    AI = "ai"
-    AI_REASONING = "ai_reasoning"
-    AI_STATUS = "ai_status"
 
+class RequestTimeoutError(TimeoutError):
+    def __init__(self, kind: str, seconds: float):
+        super().__init__(f"{kind.capitalize()} timeout ({seconds}s) exceeded")
 
-@dataclasses.dataclass
-class Message:
-    type: MessageType
-    text: str
+        self.kind = kind
+        self.seconds = seconds
 
 
 @dataclasses.dataclass
-class AiResponse:
-    is_delta: bool
-    is_reasoning: bool
-    is_status: bool
-    text: str
+class RequestTimeouts:
+    # Seconds; 0 means no limit.
+    connect: float = 30.0
+    first_byte: float = 600.0
+    idle: float = 300.0
+    total: float = 0.0
 
 
-class AiClient:
-    def __init__(self, api_key: str):
-        self._api_key = api_key
+def is_retryable_error(exc: BaseException) -> bool:
+    """
+    Tell whether an error is likely to be transient or specific to the
+    provider, so that trying again later or trying another provider might
+    succeed.
+    """
 
-    def list_models(self) -> collections.abc.Sequence[str]:
-        raise NotImplementedError()
+    if isinstance(exc, HttpError):
+        return exc.status in (408, 409, 429) or exc.status >= 500
 
-    def respond(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        raise NotImplementedError()
+    return isinstance(exc, (ConnectionError, TimeoutError, http.client.IncompleteRead))
 
-    def respond_streaming(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        raise NotImplementedError()
 
-    @classmethod
-    def http_sse(
-            cls,
-            method: str,
-            url: str,
-            headers: typing.Optional[typing.Dict[str, str]]=None,
-            body: typing.Optional[bytes]=None,
-            bufsize: int=4096,
-    ) -> typing.Iterator[tuple[str, str]]:
-        buffer = b""
+DURATION_RE = re.compile(r"^(?:([0-9.]+)h)?(?:([0-9.]+)m(?!s))?(?:([0-9.]+)s)?(?:([0-9.]+)ms)?$")
 
-        for chunk in cls.http_request_buffered(method, url, headers, body, bufsize=bufsize):
-            if chunk:
-                buffer += chunk
 
-            elif len(buffer.strip()) > 0:
-                buffer += b"\n\n"
+def parse_duration(duration: str) -> typing.Optional[float]:
+    """
+    Parse durations like "1s", "6m0s", "1h2m3.5s", "20ms", or "1.5" (seconds)
+    into seconds.
+    """
 
-            buffer = buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    duration = duration.strip()
 
-            while b"\n\n" in buffer:
-                block, buffer = buffer.split(b"\n\n", 1)
+    try:
+        return float(duration)
 
-                event_type = ""
-                data = ""
+    except ValueError:
+        pass
 
-                for line in block.split(b"\n"):
-                    line = line.decode("utf-8", errors="ignore")
+    match = DURATION_RE.match(duration)
 
-                    if line.startswith("event: "):
-                        event_type = line[7:].strip()
+    if duration == "" or not match:
+        return None
 
-                    elif line.startswith("data: "):
-                        data += line[6:]
+    hours, minutes, seconds, milliseconds = (float(g or 0.0) for g in match.groups())
 
-                yield event_type, data
+    return hours * 3600.0 + minutes * 60.0 + seconds + milliseconds / 1000.0
 
-    @staticmethod
-    def http_request_buffered(
-            method: str,
-            url: str,
-            headers: typing.Optional[typing.Dict[str, str]]=None,
-            body: typing.Optional[bytes]=None,
-            bufsize: int=65536,
-    ) -> typing.Iterator[bytes]:
-        parsed_url = urllib.parse.urlparse(url)
-        conn = http.client.HTTPSConnection(parsed_url.netloc)
 
-        path = parsed_url.path
+def parse_timestamp(timestamp: str) -> typing.Optional[float]:
+    """
+    Parse RFC 3339 and HTTP-date timestamps into seconds since the epoch.
+    """
 
-        if parsed_url.query:
-            path += "?" + parsed_url.query
+    try:
+        return datetime.datetime.fromisoformat(timestamp.strip()).timestamp()
 
-        conn.request(method, path, body=body, headers=headers)
-        resp = conn.getresponse()
+    except ValueError:
+        pass
 
-        if resp.status != 200:
-            raise HttpError(resp.status, resp.reason, resp.read().decode())
+    try:
+        return email.utils.parsedate_to_datetime(timestamp).timestamp()
 
-        chunk = True
+    except (TypeError, ValueError):
+        return None
 
-        while chunk:
-            chunk = resp.read(bufsize)
 
-            yield chunk
+def parse_retry_after(headers: typing.Dict[str, str], now: float) -> typing.Optional[float]:
+    """
+    Find out from the (lowercase) headers of an error response how many
+    seconds to wait before trying again, if the server tells it.
+    """
 
-    @classmethod
-    def http_request(
-            cls,
-            method: str,
-            url: str,
-            headers: typing.Optional[typing.Dict[str, str]]=None,
-            body: typing.Optional[bytes]=None,
-            bufsize: int=65536,
-    ) -> bytes:
-        response = b""
+    if "retry-after-ms" in headers:
+        retry_after_ms = parse_duration(headers["retry-after-ms"])
 
-        for chunk in cls.http_request_buffered(method, url, headers or {}, body, bufsize):
-            response += chunk
+        if retry_after_ms is not None:
+            return retry_after_ms / 1000.0
 
-        return response
+    if "retry-after" in headers:
+        retry_after = parse_duration(headers["retry-after"])
 
-    @staticmethod
-    def extract_status(data, paths: typing.Iterator[str]) -> typing.Dict[str, typing.Any]:
-        status = {}
+        if retry_after is None:
+            timestamp = parse_timestamp(headers["retry-after"])
+            retry_after = None if timestamp is None else timestamp - now
 
-        for path in paths:
-            value = get_item(data, path)
+        if retry_after is not None:
+            return max(0.0, retry_after)
 
-            if value is not None and value != "":
-                status[path] = value
+    # Provider-specific rate limit headers tell when the limits that have
+    # run out will be reset; OpenAI, xAI, etc. send durations, Anthropic
+    # sends timestamps.
+    resets = []
 
-        return status
+    for name, value in headers.items():
+        if value.strip() != "0":
+            continue
 
-    @staticmethod
-    def compile_status(status: typing.Dict[str, typing.Any]) -> typing.Iterator[AiResponse]:
-        if len(status) > 0:
-            status_text = (
-                "```\n"
-                + ("\n".join(f"{path}: {value}" for path, value in status.items()))
-                + "\n```"
-            )
+        if name.startswith("x-ratelimit-remaining-"):
+            limit = name[len("x-ratelimit-remaining-"):]
+            reset = parse_duration(headers.get("x-ratelimit-reset-" + limit, ""))
 
-            yield AiResponse(
-                is_delta=False,
-                is_reasoning=False,
-                is_status=True,
-                text=status_text,
-            )
+        elif name.startswith("anthropic-ratelimit-") and name.endswith("-remaining"):
+            limit = name[:-len("-remaining")]
+            timestamp = parse_timestamp(headers.get(limit + "-reset", ""))
+            reset = None if timestamp is None else timestamp - now
 
+        else:
+            continue
 
-# Some of the following AiClient implementations are very similar to each other,
-# and while I'm aware of the DRY-principle (Don't Repeat Yourself), I'm also
-# aware of the DNAHCTTSC-principle (Do Not Apply Huffman-Coding To The Source
-# Code): since each provider already has their own set of unique little quirks,
-# it is not unreasonable to expect that they will keep diverging from each other
-# on the long run, making it more and more difficult to unify them under a
-# a single, sensible AI-provider-based abstraction layer, or to untangle them
-# when such a layer snaps. Therefore, at least for now, the central abstraction
-# here will remain defined in terms of the needs of AiMessenger, and the
-# surface-level similarities between the concrete AiClient implementations will
-# be kept as is.
+        if reset is not None:
+            resets.append(max(0.0, reset))
 
+    if len(resets) > 0:
+        return max(resets)
 
-class AnthropicClient(AiClient):
-    # https://docs.anthropic.com/en/api/messages
-    # https://console.anthropic.com/settings/limits
+    return None
 
-    URL_CHAT = "https://api.anthropic.com/v1/messages"
-    URL_MODELS = "https://api.anthropic.com/v1/models?limit=1000"
 
-    STATUS_PATHS = (
-        "delta.stop_reason",
-        "id",
-        "message.id",
-        "message.model",
-        "message.role",
-        "message.usage.cache_creation_input_tokens",
-        "message.usage.cache_read_input_tokens",
-        "message.usage.input_tokens",
-        "message.usage.output_tokens",
-        "message.usage.service_tier",
-        "model",
-        "role",
-        "stop_reason",
-        "usage.cache_creation_input_tokens",
-        "usage.cache_read_input_tokens",
-        "usage.input_tokens",
-        "usage.output_tokens",
-        "usage.service_tier",
-    )
+RATE_LIMIT_HEADER_RE = re.compile(
+    r"^(?:x-ratelimit-(limit|remaining|reset)-(.+)|anthropic-ratelimit-(.+)-(limit|remaining|reset))$"
+)
 
-    def list_models(self) -> collections.abc.Sequence[str]:
-        raw_response = self.http_request(
-            "GET",
-            self.URL_MODELS,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "x-api-key": self._api_key,
-                "anthropic-version": "2023-06-01",
-            },
-        )
-        response = json.loads(raw_response)
 
-        return [
-            model["id"]
-            for model in get_item(response, "data", [])
-            if model["type"] == "model"
-        ]
+def parse_rate_limits(
+        headers: typing.Dict[str, str],
+        now: float,
+) -> typing.Dict[str, typing.Dict[str, float]]:
+    """
+    Collect the limit, the remaining amount, and the time of the reset (in
+    seconds since the epoch) of each rate limit (requests, tokens, etc.) from
+    the (lowercase) headers of a response.
+    """
 
-    def respond(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=False,
-        )
-        response_bytes = self.http_request("POST", self.URL_CHAT, headers, body)
+    rate_limits = {}
 
-        try:
-            response = json.loads(response_bytes)
+    for name, value in headers.items():
+        match = RATE_LIMIT_HEADER_RE.match(name)
 
-        except json.JSONDecodeError:
-            pass
+        if not match:
+            continue
+
+        if match[1] is not None:
+            field, limit_name = match[1], match[2]
 
         else:
-            for content in get_item(response, "content", []):
-                content_type = get_item(content, "type")
+            limit_name, field = match[3], match[4]
 
-                if content_type == "text":
-                    yield AiResponse(
-                        is_delta=False,
-                        is_reasoning=False,
-                        is_status=False,
-                        text=get_item(content, "text", "")
-                    )
+        if field == "reset":
+            reset = parse_duration(value)
 
-                elif content_type == "thinking":
-                    yield AiResponse(
-                        is_delta=False,
-                        is_reasoning=True,
-                        is_status=False,
-                        text=get_item(content, "thinking", ""),
-                    )
+            if reset is not None and match[1] is not None:
+                parsed_value = now + reset
 
-            yield from self.compile_status(
-                self.extract_status(response, self.STATUS_PATHS)
-            )
+            else:
+                parsed_value = parse_timestamp(value)
 
-    def respond_streaming(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=True,
-        )
-        status = {}
+            field = "reset_at"
 
-        for event_type, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
-            try:
-                data = json.loads(data_bytes)
+        else:
+            parsed_value = parse_duration(value)
 
-            except json.JSONDecodeError:
-                continue
+        if parsed_value is not None:
+            rate_limits.setdefault(limit_name, {})[field] = parsed_value
 
-            status.update(self.extract_status(data, self.STATUS_PATHS))
+    return {
+        limit_name: rate_limit
+        for limit_name, rate_limit in rate_limits.items()
+        if len(rate_limit) == 3
+    }
 
-            if event_type == "content_block_start":
-                content_type = get_item(data, "content_block.type")
 
-                if content_type == "thinking":
-                    yield AiResponse(
-                        is_delta=True,
-                        is_reasoning=True,
-                        is_status=False,
-                        text=get_item(data, "content_block.thinking", ""),
-                    )
+class RateLimiter:
+    """
+    Pace requests according to the rate limits that the providers report in
+    the headers of their responses, before running into HTTP 429 errors.
+    The limits are kept in a file which is shared by all ai-cat.py processes,
+    and each limit is treated as a token bucket which is refilled linearly
+    until its reset time, and from which each request takes 1 request and
+    the estimated number of its input tokens.
+    """
 
-                elif content_type == "text":
-                    yield AiResponse(
-                        is_delta=True,
-                        is_reasoning=False,
-                        is_status=False,
-                        text=get_item(data, "content_block.text", ""),
-                    )
+    MAX_WAIT_SECONDS = 60.0
+    STALE_SECONDS = 24 * 60 * 60
 
-            elif event_type == "content_block_delta":
-                delta_type = get_item(data, "delta.type")
+    def __init__(self, file_name: str):
+        self._file_name = file_name
+        self._lock = threading.Lock()
 
-                if delta_type == "thinking_delta":
-                    yield AiResponse(
-                        is_delta=True,
-                        is_reasoning=True,
-                        is_status=False,
-                        text=get_item(data, "delta.thinking", ""),
-                    )
+    @staticmethod
+    def make_key(url: str, headers: typing.Dict[str, str]) -> str:
+        # The API key is included only as a hash, and depending on the
+        # provider, it may be in one of the headers or in the URL.
+        parsed_url = urllib.parse.urlparse(url)
+        query = urllib.parse.parse_qs(parsed_url.query)
+        credentials = "\0".join(
+            [
+                headers.get("Authorization", ""),
+                headers.get("x-api-key", ""),
+                ",".join(query.get("key", [])),
+            ]
+        )
 
-                elif delta_type == "text_delta":
-                    yield AiResponse(
-                        is_delta=True,
-                        is_reasoning=False,
-                        is_status=False,
-                        text=get_item(data, "delta.text", ""),
-                    )
+        return parsed_url.netloc + ":" + hashlib.sha256(credentials.encode("utf-8")).hexdigest()[:16]
 
-        yield from self.compile_status(status)
+    def acquire(self, key: str, tokens: int, now: float) -> float:
+        """
+        Take 1 request and the given number of tokens from the buckets of the
+        key if they are available, otherwise return the number of seconds to
+        wait before trying again.
+        """
 
-    def _build_request(self, model, conversation, temperature, reasoning, stream):
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "x-api-key": self._api_key,
-            "anthropic-version": "2023-06-01",
-            "anthropic-beta": "extended-cache-ttl-2025-04-11",
-        }
-        system_prompt, messages = self._convert_conversation(conversation)
+        return self._update(lambda state: self._acquire(state, key, tokens, now), now)
 
-        body = {
-            "model": model,
-            "temperature": temperature,
-            "stream": stream,
-            "messages": messages,
-            "max_tokens": 32000,
-        }
+    def observe(self, key: str, headers: typing.Dict[str, str], now: float):
+        rate_limits = parse_rate_limits(headers, now)
 
-        if system_prompt is not None:
-            body["system"] = system_prompt
+        if len(rate_limits) == 0:
+            return
 
-        if reasoning == Reasoning.ON:
-            body["thinking"] = {
-                "type": "enabled",
-                "budget_tokens": 16000,
-            }
+        for rate_limit in rate_limits.values():
+            # The rate at which the bucket is refilled is determined when the
+            # provider reports it, so that taking from the bucket doesn't
+            # change it.
+            limit, remaining, reset_at = (
+                rate_limit["limit"],
+                rate_limit["remaining"],
+                rate_limit["reset_at"],
+            )
+            rate_limit["updated"] = now
+            rate_limit["rate"] = (
+                (limit - remaining) / (reset_at - now)
+                if reset_at > now and limit > remaining
+                else 0.0
+            )
 
-        elif reasoning == Reasoning.OFF:
-            body["thinking"] = {"type": "disabled"}
+        self._update(lambda state: state.setdefault(key, {}).update(rate_limits), now)
 
-        return headers, json.dumps(body).encode("utf-8")
+    @classmethod
+    def _acquire(
+            cls,
+            state: typing.Dict[str, typing.Any],
+            key: str,
+            tokens: int,
+            now: float,
+    ) -> float:
+        rate_limits = state.get(key, {})
+        wait = 0.0
+        available_amounts = {}
+
+        for limit_name, rate_limit in rate_limits.items():
+            if "output" in limit_name:
+                continue
 
-    def _convert_conversation(self, conversation):
-        messages = []
-        system_prompt = None
-        remaining_cached_block = 4
+            amount = 1 if limit_name == "requests" else tokens
+            amount = min(amount, rate_limit["limit"])
+            available, rate = cls._get_available(rate_limit, now)
+            available_amounts[limit_name] = available - amount
 
-        for message in conversation:
-            if message.type == MessageType.SYSTEM:
-                system_prompt, remaining_cached_block = self._wrap_text(
-                    message.text,
-                    remaining_cached_block,
-                )
+            if available < amount:
+                if rate > 0.0:
+                    wait = max(wait, (amount - available) / rate)
 
-            else:
-                text, remaining_cached_block = self._wrap_text(
-                    message.text,
-                    remaining_cached_block,
-                )
-                messages.append(
-                    {
-                        "role": "assistant" if message.type == MessageType.AI else "user",
-                        "content": text,
-                    }
-                )
+                else:
+                    wait = max(wait, rate_limit["reset_at"] - now)
 
-        return system_prompt, messages
+        if wait > 0.0:
+            return wait
+
+        for limit_name, remaining in available_amounts.items():
+            rate_limits[limit_name]["remaining"] = remaining
+            rate_limits[limit_name]["updated"] = now
+
+        return 0.0
 
     @staticmethod
-    def _wrap_text(text: str, remaining_cached_block: int) -> typing.List:
-        if remaining_cached_block > 0:
-            wrapped_text = [
-                {
-                    "type": "text",
-                    "text": text,
-                    "cache_control": {
-                        "type": "ephemeral",
-                        "ttl": "1h",
-                    },
-                },
-            ]
+    def _get_available(rate_limit: typing.Dict[str, float], now: float) -> tuple[float, float]:
+        limit = rate_limit["limit"]
+        rate = rate_limit["rate"]
 
-            return wrapped_text, remaining_cached_block - 1
+        if now >= rate_limit["reset_at"]:
+            return limit, rate
 
-        return [{"type": "text", "text": text}], 0
+        elapsed = max(0.0, now - rate_limit["updated"])
 
+        return min(limit, rate_limit["remaining"] + rate * elapsed), rate
 
-class DeepSeekClient(AiClient):
-    # https://api-docs.deepseek.com/api/create-chat-completion
+    def _update(
+            self,
+            update_func: collections.abc.Callable[[typing.Dict], typing.Any],
+            now: float,
+    ) -> typing.Any:
+        with self._lock:
+            try:
+                with open(self._file_name, "a+", encoding="utf-8") as f:
+                    self._lock_file(f)
 
-    URL_CHAT = "https://api.deepseek.com/chat/completions"
-    URL_MODELS = "https://api.deepseek.com/models"
+                    try:
+                        f.seek(0)
+                        old_state_str = f.read()
 
-    STATUS_PATHS = (
-        "created",
-        "finish_reason",
-        "id",
-        "model",
-        "system_fingerprint",
-        "usage.completion_tokens",
-        "usage.completion_tokens_details.reasoning_tokens",
-        "usage.prompt_cache_hit_tokens",
-        "usage.prompt_cache_miss_tokens",
-        "usage.prompt_tokens",
-        "usage.prompt_tokens_details.cached_tokens",
-        "usage.total_tokens",
-    )
+                        try:
+                            state = json.loads(old_state_str or "{}")
 
-    def list_models(self) -> collections.abc.Sequence[str]:
-        raw_response = self.http_request(
-            "GET",
-            self.URL_MODELS,
-            headers=self._build_request_headers(),
-        )
-        response = json.loads(raw_response)
+                        except json.JSONDecodeError:
+                            state = {}
 
-        return [
-            model["id"]
-            for model in get_item(response, "data", [])
-            if model["object"] == "model"
-        ]
+                        if not isinstance(state, dict):
+                            state = {}
 
-    def respond(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=False,
-        )
-        response_bytes = self.http_request("POST", self.URL_CHAT, headers, body)
-        status = {}
+                        result = update_func(state)
+                        self._remove_stale(state, now)
+                        new_state_str = json.dumps(state)
 
-        try:
-            response = json.loads(response_bytes)
+                        # Most requests don't change anything (e.g. when the
+                        # provider doesn't report rate limits).
+                        if new_state_str != old_state_str:
+                            f.seek(0)
+                            f.truncate()
+                            f.write(new_state_str)
 
-        except json.JSONDecodeError:
-            pass
+                        return result
 
-        else:
-            for choice in get_item(response, "choices", []):
-                if get_item(choice, "message.role") != "assistant":
-                    continue
+                    finally:
+                        self._unlock_file(f)
 
-                reasoning = get_item(choice, "message.reasoning_content")
-                text = get_item(choice, "message.content", "")
+            except (OSError, KeyError, TypeError):
+                # Rate limiting is only an optimization, failing requests
+                # would be worse than running into 429 errors.
+                return 0.0
 
-                if reasoning is not None:
-                    yield AiResponse(
-                        is_delta=False,
-                        is_reasoning=True,
-                        is_status=False,
-                        text=reasoning,
-                    )
+    @staticmethod
+    def _lock_file(f):
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
 
-                yield AiResponse(
-                    is_delta=False,
-                    is_reasoning=False,
-                    is_status=False,
-                    text=text,
-                )
+        elif msvcrt is not None:
+            # Windows locks byte ranges instead of whole files, so the first
+            # byte stands for the whole file, even while it is still empty.
+            # (LK_LOCK gives up with an OSError after trying for 10 seconds.)
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
 
-                status.update(self.extract_status(choice, self.STATUS_PATHS))
+    @staticmethod
+    def _unlock_file(f):
+        # The flock() lock is released when the file is closed.
+        if fcntl is None and msvcrt is not None:
+            f.flush()
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
-                break
+    @classmethod
+    def _remove_stale(cls, state: typing.Dict[str, typing.Any], now: float):
+        for key in list(state.keys()):
+            rate_limits = state[key]
 
-            status.update(self.extract_status(response, self.STATUS_PATHS))
+            if not isinstance(rate_limits, dict) or all(
+                    now - rate_limit.get("updated", 0.0) > cls.STALE_SECONDS
+                    for rate_limit in rate_limits.values()
+            ):
+                del state[key]
 
-            yield from self.compile_status(status)
 
-    def respond_streaming(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=True,
-        )
-        status = {}
+class ConnectionPool:
+    """
+    Keep the idle keep-alive connections of completed requests, so that later
+    requests to the same host, including the concurrent ones of other threads,
+    can skip the TCP and TLS handshakes.
+    """
 
-        for _, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
-            try:
-                data = json.loads(data_bytes)
+    MAX_IDLE_PER_HOST = 8
+    MAX_IDLE_SECONDS = 30.0
 
-            except json.JSONDecodeError:
-                continue
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle_connections = {}
 
-            if get_item(data, "object") == "chat.completion.chunk":
-                for choice in get_item(data, "choices", []):
-                    reasoning = get_item(choice, "delta.reasoning_content")
+    @staticmethod
+    def make_key(url: str) -> str:
+        parsed_url = urllib.parse.urlparse(url)
 
-                    if reasoning is not None:
-                        yield AiResponse(
-                            is_delta=True,
-                            is_reasoning=True,
-                            is_status=False,
-                            text=reasoning,
-                        )
+        return f"{parsed_url.scheme}://{parsed_url.netloc}"
 
-                    text = get_item(choice, "delta.content")
+    def acquire(self, key: str, now: float) -> typing.Optional[http.client.HTTPConnection]:
+        with self._lock:
+            idle_connections = self._idle_connections.get(key, [])
 
-                    if text is not None:
-                        yield AiResponse(
-                            is_delta=True,
-                            is_reasoning=False,
-                            is_status=False,
-                            text=text,
-                        )
+            while len(idle_connections) > 0:
+                released_at, conn = idle_connections.pop()
 
-                    status.update(self.extract_status(choice, self.STATUS_PATHS))
+                if now - released_at <= self.MAX_IDLE_SECONDS and conn.sock is not None:
+                    return conn
 
-                    break
+                conn.close()
 
-                status.update(self.extract_status(data, self.STATUS_PATHS))
+        return None
 
-        yield from self.compile_status(status)
+    def release(self, key: str, conn: http.client.HTTPConnection, now: float):
+        with self._lock:
+            idle_connections = self._idle_connections.setdefault(key, [])
 
-    def _build_request_headers(self):
-        return {
-            "Authorization": "Bearer " + self._api_key,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
+            if len(idle_connections) >= self.MAX_IDLE_PER_HOST:
+                _, oldest_conn = idle_connections.pop(0)
+                oldest_conn.close()
 
-    def _build_request(self, model, conversation, temperature, reasoning, stream):
-        body = {
-            "model": model,
-            "temperature": temperature,
-            "messages": self._convert_conversation(conversation),
-            "stream": stream,
-        }
+            idle_connections.append((now, conn))
 
-        if reasoning == Reasoning.OFF:
-            body["thinking"] = {"type": "disabled"}
-        elif reasoning == Reasoning.ON:
-            body["thinking"] = {"type": "enabled"}
-            body["reasoning_effort"] = "high"
+    def close(self):
+        with self._lock:
+            for idle_connections in self._idle_connections.values():
+                for _, conn in idle_connections:
+                    conn.close()
 
-        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+            self._idle_connections = {}
 
-    def _convert_conversation(self, conversation):
-        roles = {
-            MessageType.SYSTEM: "system",
-            MessageType.USER: "user",
-            MessageType.AI: "assistant",
-        }
 
-        return [
-            {
-                "role": roles.get(message.type, "user"),
-                "content": message.text,
-            }
-            for message in conversation
-        ]
+class RequestContext:
+    """
+    Bookkeeping for the HTTP requests that an AiClient makes on behalf of a
+    single response. Instead of being passed through each AiClient
+    implementation, the context is bound to the thread which makes the
+    requests, for the duration of a with statement.
+    """
 
+    _local = threading.local()
 
-class GoogleClient(AiClient):
-    # https://ai.google.dev/gemini-api/docs/text-generation
-    # https://ai.google.dev/api/generate-content#method:-models.generatecontent
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._previous_contexts = []
+        self._cancelled_event = threading.Event()
+        self.is_cancelled = False
+        self.retries = 0
+        self.backoff_seconds = 0.0
+        self.rate_limit_wait_seconds = 0.0
+        self.timeouts = RequestTimeouts()
+        self.start_time = time.monotonic()
+        self.first_output_time = None
+        self.end_time = None
 
-    URL_TPL_CHAT = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
-    URL_TPL_CHAT_STREAM = "https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
-    URL_TPL_MODELS = "https://generativelanguage.googleapis.com/v1beta/models?pageSize=1000&key={api_key}"
+    @classmethod
+    def get_current(cls) -> typing.Optional["RequestContext"]:
+        return getattr(cls._local, "context", None)
 
-    HEADERS = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
+    def __enter__(self) -> "RequestContext":
+        self._previous_contexts.append(self.get_current())
+        self._local.context = self
 
-    STATUS_PATHS = (
-        "finishReason",
-        "modelVersion",
-        "promptFeedback.blockReason",
-        "responseId",
-        "usageMetadata.cachedContentTokenCount",
-        "usageMetadata.candidatesTokenCount",
-        "usageMetadata.promptTokenCount",
-        "usageMetadata.thoughtsTokenCount",
-        "usageMetadata.toolUsePromptTokenCount",
-        "usageMetadata.totalTokenCount",
-    )
+        return self
 
-    def list_models(self) -> collections.abc.Sequence[str]:
-        raw_response = self.http_request(
-            "GET",
-            self.URL_TPL_MODELS.format(api_key=self._api_key),
-            headers=self.HEADERS,
-        )
-        response = json.loads(raw_response)
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self._local.context = self._previous_contexts.pop()
 
-        return [
-            model["name"].split("/", 1)[-1] if model["name"].startswith("models/") else model["name"]
-            for model in get_item(response, "models", [])
-            if "generateContent" in model["supportedGenerationMethods"]
-        ]
+    def cancel(self):
+        """
+        Make the requests of the context fail as soon as possible, even if
+        they are blocked in another thread, by shutting down the sockets of
+        their connections. (This also makes the provider stop generating.)
+        """
 
-    def respond(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        url = self.URL_TPL_CHAT.format(model=model, api_key= self._api_key)
-        body = self._build_request_body(conversation, temperature, reasoning)
-        response = self.http_request("POST", url, self.HEADERS, body)
-        status = {}
-        citations = []
+        with self._lock:
+            self.is_cancelled = True
+            self._cancelled_event.set()
+            connections = list(self._connections)
 
-        yield from self._process_response(response, status, citations, is_delta=True)
-        yield from self._compile_status(status, citations)
+        for conn in connections:
+            if conn.sock is not None:
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
 
-    def respond_streaming(
+                except OSError:
+                    pass
+
+    def check_cancelled(self):
+        if self.is_cancelled:
+            raise RequestCancelledError("Request cancelled")
+
+    def sleep(self, seconds: float):
+        if self._cancelled_event.wait(seconds):
+            raise RequestCancelledError("Request cancelled")
+
+    def get_socket_timeout(
             self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        url = self.URL_TPL_CHAT_STREAM.format(model=model, api_key= self._api_key)
-        body = self._build_request_body(conversation, temperature, reasoning)
+            kind: str,
+            seconds: float,
+    ) -> tuple[typing.Optional[float], RequestTimeoutError]:
+        """
+        Return the timeout to be used for the next socket operation, taking
+        the total timeout into account as well, and the error to be raised
+        when it expires.
+        """
+
+        if self.timeouts.total > 0.0:
+            remaining = self.timeouts.total - (time.monotonic() - self.start_time)
+            total_timeout_error = RequestTimeoutError("total", self.timeouts.total)
+
+            if remaining <= 0.0:
+                raise total_timeout_error
+
+            if seconds <= 0.0 or remaining < seconds:
+                return remaining, total_timeout_error
+
+        return (seconds if seconds > 0.0 else None), RequestTimeoutError(kind, seconds)
+
+    def get_status(self) -> typing.Dict[str, typing.Any]:
         status = {}
-        citations = []
 
-        for _, data in self.http_sse("POST", url, self.HEADERS, body):
-            yield from self._process_response(data, status, citations, is_delta=True)
+        if self.retries > 0:
+            status["http.retries"] = self.retries
+            status["http.backoff_seconds"] = round(self.backoff_seconds, 3)
 
-        yield from self._compile_status(status, citations)
+        if self.rate_limit_wait_seconds > 0.0:
+            status["http.rate_limit_wait_seconds"] = round(self.rate_limit_wait_seconds, 3)
 
-    def _build_request_body(self, conversation, temperature, reasoning):
-        system_prompt, contents = self._convert_conversation(conversation)
+        return status
 
-        body = {
-            "contents": contents,
-            "generationConfig": {
-                "temperature": temperature,
-            },
-        }
+    def add_connection(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            self.check_cancelled()
+            self._connections.add(conn)
 
-        if system_prompt is not None:
-            # As of August, 2025, the official documentation uses snake case,
-            # for example, in the cURL example at
-            # https://ai.google.dev/gemini-api/docs/text-generation#rest_2
-            #
-            # Though camel case also seems to work, let's keep to the format
-            # that is used in the official docs.
+    def remove_connection(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            self._connections.discard(conn)
 
-            body["system_instruction"] = system_prompt
 
-        if reasoning == Reasoning.OFF:
-            body["generationConfig"]["thinkingConfig"] = {
-                "includeThoughts": False,
-                "thinkingBudget": 0,
-            }
+class Reasoning(str, enum.Enum):
+    DEFAULT = "default"
+    OFF = "off"
+    ON = "on"
+    LOW = "low"
+    MEDIUM = "medium"
+    HIGH = "high"
 
-        else:
-            body["generationConfig"]["thinkingConfig"] = {
-                "includeThoughts": True,
-            }
 
-        return json.dumps(body).encode("utf-8")
+class Streaming(str, enum.Enum):
+    OFF = "off"
+    ON = "on"
 
-    def _convert_conversation(self, conversation):
-        contents = []
-        system_prompt = None
 
-        for message in conversation:
-            if message.type == MessageType.SYSTEM:
-                system_prompt = {"parts": [{"text": message.text}]}
+class ServerState(str, enum.Enum):
+    OFF = "off"
+    ON = "on"
 
-            else:
-                contents.append(
-                    {
-                        "role": "model" if message.type == MessageType.AI else "user",
-                        "parts": [{"text": message.text}],
-                    }
-                )
 
-        return system_prompt, contents
+class CacheMode(str, enum.Enum):
+    OFF = "off"
+    READ = "read"
+    WRITE = "write"
+    ON = "on"
 
-    def _process_response(
-            self,
-            response_bytes: bytes,
-            status: typing.Dict[str, typing.Any],
-            citations: typing.List[str],
-            is_delta: bool,
-    ) -> typing.Iterator[AiResponse]:
-        try:
-            response = json.loads(response_bytes)
 
-        except json.JSONDecodeError:
-            pass
+class Tier(str, enum.Enum):
+    DEFAULT = "default"
+    STANDARD = "standard"
+    PRIORITY = "priority"
+    FLEX = "flex"
 
-        else:
-            for candidate in get_item(response, "candidates", []):
-                if get_item(candidate, "content.role") != "model":
-                    continue
 
-                for part in get_item(candidate, "content.parts", []):
-                    text = get_item(part, "text")
+class MessageType(str, enum.Enum):
+    SYSTEM = "system"
+    SETTINGS = "settings"
+    USER = "user"
+    AI = "ai"
+    AI_REASONING = "ai_reasoning"
+    AI_STATUS = "ai_status"
 
-                    if text is not None:
-                        yield AiResponse(
-                            is_delta=True,
-                            is_reasoning=get_item(part, "thought", False),
-                            is_status=False,
-                            text=text,
-                        )
 
-                status.update(self.extract_status(candidate, self.STATUS_PATHS))
+@dataclasses.dataclass
+class Message:
+    type: MessageType
+    text: str
 
-                candidate_citations = get_item(
-                    candidate,
-                    "citationMetadata.citationSources",
-                    [],
-                )
 
-                for candidate_citation in candidate_citations:
-                    uri = get_item(candidate_citation, "uri")
+@dataclasses.dataclass
+class AiResponse:
+    is_delta: bool
+    is_reasoning: bool
+    is_status: bool
+    text: str
+    status: typing.Optional[typing.Dict[str, typing.Any]] = None
 
-                    if uri:
-                        citations.append(uri)
 
-                break
+@dataclasses.dataclass
+class RequestOptions:
+    # When set, then the first previous_message_count messages of the
+    # conversation are already stored on the provider's side as the context of
+    # this response.
+    previous_response_id: typing.Optional[str] = None
+    previous_message_count: int = 0
 
-            status.update(self.extract_status(response, self.STATUS_PATHS))
+    # 0 means that the default of the provider or the reasoning level is used.
+    max_tokens: int = 0
+    reasoning_budget: int = 0
 
-    def _compile_status(
-            self,
-            status: typing.Dict[str, typing.Any],
-            citations: typing.List[str],
-    ) -> typing.Iterator[AiResponse]:
-        if len(citations) == 0:
-            yield from super().compile_status(status)
+    tier: Tier = Tier.DEFAULT
 
-        else:
-            # Citations are stored in the status message because they are
-            # usually not directly referenced in the response text.
-            citations_text = (
-                "Citations:\n"
-                + (
-                    "\n".join(
-                        f"{i+1}. {citation}"
-                        for i, citation in enumerate(dict.fromkeys(citations).keys())
-                    )
-                )
-            )
-            responses = list(self.compile_status(status))
+    # Text that the response is expected to largely repeat, so that providers
+    # which support predicted outputs can generate it faster.
+    prediction: typing.Optional[str] = None
 
-            if len(responses) == 0:
-                yield AiResponse(
-                    is_delta=False,
-                    is_reasoning=False,
-                    is_status=True,
-                    text=citations_text,
-                )
 
-            else:
-                responses[0] = AiResponse(
-                    is_delta=False,
-                    is_reasoning=False,
-                    is_status=True,
-                    text=citations_text + "\n\n" + responses[0].text,
-                )
+@dataclasses.dataclass
+class BatchRequest:
+    custom_id: str
+    model: str
+    conversation: typing.List[Message]
+    temperature: float
+    reasoning: Reasoning
+    options: RequestOptions
 
-                yield from responses
 
+class StatusPaths:
+    """
+    A set of dot-separated paths (see get_item()) compiled into a trie, so
+    that every present field can be extracted from a response in a single
+    pass, without splitting the paths and checking each prefix again for
+    each event of a stream.
+    """
 
-class MistralClient(AiClient):
-    # https://docs.mistral.ai/api/endpoint/chat
-    # https://docs.mistral.ai/api/endpoint/models
+    def __init__(self, paths: collections.abc.Iterable[str]):
+        self.paths = tuple(paths)
 
-    URL_CHAT = "https://api.mistral.ai/v1/chat/completions"
-    URL_MODELS = "https://api.mistral.ai/v1/models"
+        # Each node maps a key to a (path, children) tuple, where path is None
+        # if the key is only an intermediate step.
+        self._trie = {}
 
-    STATUS_PATHS = (
-        "usage.prompt_tokens",
-        "usage.total_tokens",
-        "usage.completion_tokens",
-        "usage.prompt_token_details.cached_tokens",
-        "finish_reason",
-    )
+        for path in self.paths:
+            keys = path.split(".")
+            node = self._trie
 
-    def list_models(self) -> collections.abc.Sequence[str]:
-        raw_response = self.http_request(
-            "GET",
-            self.URL_MODELS,
-            headers=self._build_request_headers(),
-        )
-        response = json.loads(raw_response)
+            for i, key in enumerate(keys):
+                leaf_path, children = node.get(key, (None, {}))
 
-        return [
-            model["id"]
-            for model in get_item(response, "data", [])
-        ]
+                if i == len(keys) - 1:
+                    leaf_path = path
 
-    def respond(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=False,
-        )
-        response = self.http_request("POST", self.URL_CHAT, headers, body)
-        status = {}
+                node[key] = (leaf_path, children)
+                node = children
 
-        yield from self._process_response(response, "message", status, is_delta=False)
-        yield from self.compile_status(status)
+    def __iter__(self) -> typing.Iterator[str]:
+        return iter(self.paths)
 
-    def respond_streaming(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=True,
-        )
+    def extract(self, data) -> typing.Dict[str, typing.Any]:
         status = {}
+        self._extract(data, self._trie, status)
 
-        for event_type, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
-            yield from self._process_response(data_bytes, "delta", status, is_delta=True)
-
-        yield from self.compile_status(status)
-
-    def _build_request_headers(self):
-        return {
-            "Authorization": "Bearer " + self._api_key,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
-
-    def _build_request(self, model, conversation, temperature, reasoning, stream):
-        body = {
-            "model": model,
-            "temperature": temperature,
-            "messages": self._convert_conversation(conversation),
-            "safe_prompt": False,
-            "stream": stream,
-        }
-
-        if reasoning == Reasoning.ON:
-            body["reasoning_effort"] = "high"
-
-        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+        return status
 
-    def _convert_conversation(self, conversation):
-        roles = {
-            MessageType.SYSTEM: "system",
-            MessageType.USER: "user",
-            MessageType.AI: "assistant",
-        }
+    @classmethod
+    def _extract(cls, data, node, status: typing.Dict[str, typing.Any]):
+        for key, (path, children) in node.items():
+            if isinstance(data, dict):
+                if key not in data:
+                    continue
 
-        return [
-            {
-                "role": roles.get(message.type, "user"),
-                "content": message.text,
-            }
-            for message in conversation
-        ]
+                value = data[key]
 
-    def _process_response(
-            self,
-            response_bytes: bytes,
-            path: str,
-            status: typing.Dict[str, typing.Any],
-            is_delta: bool,
-    ) -> typing.Iterator[AiResponse]:
-        try:
-            response = json.loads(response_bytes)
+            elif isinstance(data, list) and key.isdigit() and int(key) < len(data):
+                value = data[int(key)]
 
-        except json.JSONDecodeError:
-            pass
+            else:
+                continue
 
-        else:
-            status.update(self.extract_status(response, self.STATUS_PATHS))
+            if path is not None and value is not None and value != "":
+                status[path] = value
 
-            for output in get_item(response, "choices", []):
-                role = get_item(output, path + ".role", "assistant")
+            if children:
+                cls._extract(value, children, status)
 
-                if role != "assistant":
-                    continue
 
-                content = get_item(output, path + ".content", "")
-                status.update(self.extract_status(output, self.STATUS_PATHS))
+class AiClient:
+    SUPPORTS_SERVER_STATE = False
+    SUPPORTS_PREDICTION = False
+    SUPPORTS_BATCH = False
+
+    # The smallest reasoning budget that the provider accepts, when it has to
+    # fit into the output token limit.
+    MIN_REASONING_BUDGET = 0
+
+    # The number of leading messages (including the system prompt) that
+    # determine the prompt cache key. Later messages must not affect it,
+    # otherwise each turn of a conversation would be routed to a different
+    # cache shard.
+    PROMPT_CACHE_KEY_MESSAGES = 2
+
+    RETRY_MAX_ATTEMPTS = 3
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 30.0
+
+    # Set up by main(), so that tests don't touch the shared file.
+    rate_limiter: typing.Optional[RateLimiter] = None
+
+    # Set up by main().
+    connection_pool: typing.Optional[ConnectionPool] = None
+
+    # Chat completions streams repeat the same status fields (id, model, etc.)
+    # in each chunk, and the rest of the status fields appear only in chunks
+    # which contain one of these.
+    STREAM_STATUS_MARKERS = ('"usage"', '"finish_reason":"', '"finish_reason": "')
+
+    # Status paths and values which indicate that a response was cut off
+    # because it reached the output token limit.
+    LENGTH_STOPS = (
+        ("delta.stop_reason", "max_tokens"),
+        ("stop_reason", "max_tokens"),
+        ("finish_reason", "length"),
+        ("finishReason", "MAX_TOKENS"),
+        ("incomplete_details.reason", "max_output_tokens"),
+    )
 
-                if isinstance(content, str):
-                    if content != "":
-                        yield AiResponse(
-                            is_delta=is_delta,
-                            is_reasoning=False,
-                            is_status=False,
-                            text=content,
-                        )
-                elif isinstance(content, collections.abc.Sequence):
-                    for item in content:
-                        item_type = get_item(item, "type")
+    # Thinking budgets for the reasoning levels, for the providers which
+    # expect a number of tokens instead of a level.
+    REASONING_BUDGETS = {
+        Reasoning.LOW: 2048,
+        Reasoning.MEDIUM: 8192,
+        Reasoning.HIGH: 24576,
+    }
 
-                        if item_type == "text":
-                            text = get_item(item, "text", "")
+    def __init__(self, api_key: str):
+        self._api_key = api_key
 
-                            if text != "":
-                                yield AiResponse(
-                                    is_delta=is_delta,
-                                    is_reasoning=False,
-                                    is_status=False,
-                                    text=text,
-                                )
+    def get_persistent_state(self) -> typing.Dict[str, typing.Any]:
+        """
+        Return JSON-serializable data that the client wants to keep between
+        runs. (It is saved in the state file.)
+        """
 
-                        elif item_type == "thinking":
-                            for thinking in get_item(item, "thinking", []):
-                                if get_item(thinking, "type", "") == "text":
-                                    text = get_item(thinking, "text", "")
+        return {}
 
-                                    if text != "":
-                                        yield AiResponse(
-                                            is_delta=is_delta,
-                                            is_reasoning=True,
-                                            is_status=False,
-                                            text=text,
-                                        )
+    def set_persistent_state(self, state: typing.Dict[str, typing.Any]):
+        pass
 
-class OpenAiClient(AiClient):
-    # https://platform.openai.com/docs/guides/text?api-mode=responses
-    # https://platform.openai.com/docs/api-reference/responses/create
+    def list_models(self) -> collections.abc.Sequence[str]:
+        raise NotImplementedError()
 
-    URL_CHAT = "https://api.openai.com/v1/responses"
-    URL_MODELS = "https://api.openai.com/v1/models"
+    def supports_prefill(self, reasoning: Reasoning) -> bool:
+        """
+        Tell whether the model can be made to resume a response when the
+        conversation ends with that response.
+        """
 
-    STATUS_PATHS = (
-        "created_at",
-        "error.code",
-        "error.message",
-        "id",
-        "incomplete_details.reason",
-        "max_output_tokens",
-        "max_tool_calls",
-        "model",
-        "prompt_cache_key",
-        "reasoning.effort",
-        "service_tier",
-        "status",
-        "text.format.type",
-        "text.verbosity",
-        "tool_choice",
-        "truncation",
-        "usage.input_tokens",
-        "usage.input_tokens_details.cached_tokens",
-        "usage.output_tokens",
-        "usage.output_tokens_details.reasoning_tokens",
-        "usage.total_tokens",
-    )
+        return False
 
-    def list_models(self) -> collections.abc.Sequence[str]:
-        raw_response = self.http_request(
-            "GET",
-            self.URL_MODELS,
-            headers=self._build_request_headers(),
-        )
-        response = json.loads(raw_response)
+    def get_output_token_limit(self, model: str) -> typing.Optional[int]:
+        """
+        Return the maximum number of tokens that the model can generate, if
+        the provider reports it.
+        """
 
-        return [
-            model["id"]
-            for model in get_item(response, "data", [])
-            if model["object"] == "model" and model["owned_by"] != "openai-internal"
-        ]
+        return None
 
     def respond(
             self,
@@ -1474,19 +1587,9 @@ class OpenAiClient(AiClient):
             conversation: typing.Iterator[Message],
             temperature: float,
             reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
     ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=False,
-        )
-        response = self.http_request("POST", self.URL_CHAT, headers, body)
-        status = {}
-
-        yield from self._process_complete_response(response, ".", status)
-        yield from self.compile_status(status)
+        raise NotImplementedError()
 
     def respond_streaming(
             self,
@@ -1494,153 +1597,552 @@ class OpenAiClient(AiClient):
             conversation: typing.Iterator[Message],
             temperature: float,
             reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
     ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=True,
-        )
-        status = {}
-
-        for event_type, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
-            if event_type == "response.output_text.delta":
-                try:
-                    text = get_item(json.loads(data_bytes), "delta", "")
+        raise NotImplementedError()
 
-                except json.JSONDecodeError:
-                    pass
+    def submit_batch(self, requests: collections.abc.Sequence[BatchRequest]) -> str:
+        """
+        Submit the requests to the batch API of the provider, and return the
+        ID of the batch job.
+        """
 
-                else:
-                    yield AiResponse(
-                        is_delta=True,
-                        is_reasoning=False,
-                        is_status=False,
-                        text=text,
-                    )
+        raise NotImplementedError()
 
-            elif event_type == "response.created" or event_type == "response.in_progress":
-                try:
-                    data = get_item(json.loads(data_bytes), "response")
+    def fetch_batch_results(
+            self,
+            batch_id: str,
+    ) -> typing.Optional[typing.Dict[str, typing.Union[typing.List[AiResponse], BatchError]]]:
+        """
+        Return None while the batch job is still running, otherwise the
+        responses by the custom IDs of the requests, with a BatchError for
+        each failed request. Raise BatchError if the whole job failed.
+        """
 
-                except json.JSONDecodeError:
-                    pass
+        raise NotImplementedError()
 
-                else:
-                    status.update(self.extract_status(data, self.STATUS_PATHS))
+    @classmethod
+    def http_sse(
+            cls,
+            method: str,
+            url: str,
+            headers: typing.Optional[typing.Dict[str, str]]=None,
+            body: typing.Optional[bytes]=None,
+            bufsize: int=4096,
+    ) -> typing.Iterator[tuple[str, str]]:
+        buffer = b""
 
-            elif event_type == "response.completed":
-                yield from self._process_complete_response(
-                    data_bytes,
-                    "response",
-                    status,
-                )
+        for chunk in cls.http_request_buffered(method, url, headers, body, bufsize=bufsize):
+            if chunk:
+                buffer += chunk
 
-        yield from self.compile_status(status)
+            elif len(buffer.strip()) > 0:
+                buffer += b"\n\n"
 
-    def _build_request_headers(self):
-        return {
-            "Authorization": "Bearer " + self._api_key,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
+            buffer = buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
 
-    def _build_request(self, model, conversation, temperature, reasoning, stream):
-        body = {
-            "model": model,
-            "temperature": temperature,
-            "input": self._convert_conversation(conversation),
-            "stream": stream,
-        }
+            while b"\n\n" in buffer:
+                block, buffer = buffer.split(b"\n\n", 1)
 
-        if reasoning == Reasoning.ON:
-            body["reasoning"] = {"effort": "medium"}
+                event_type = ""
+                data = ""
 
-        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+                for line in block.split(b"\n"):
+                    line = line.decode("utf-8", errors="ignore")
 
-    def _convert_conversation(self, conversation):
-        roles = {
-            MessageType.SYSTEM: "developer",
-            MessageType.USER: "user",
-            MessageType.AI: "assistant",
-        }
+                    if line.startswith("event: "):
+                        event_type = line[7:].strip()
 
-        return [
-            {
-                "role": roles.get(message.type, "user"),
-                "content": message.text,
-            }
-            for message in conversation
-        ]
+                    elif line.startswith("data: "):
+                        data += line[6:]
 
-    def _process_complete_response(
-            self,
-            response_bytes: bytes,
-            path: str,
-            status: typing.Dict[str, typing.Any],
-    ) -> typing.Iterator[AiResponse]:
-        try:
-            response = json.loads(response_bytes)
+                yield event_type, data
 
-        except json.JSONDecodeError:
-            pass
+    @classmethod
+    def http_request_buffered(
+            cls,
+            method: str,
+            url: str,
+            headers: typing.Optional[typing.Dict[str, str]]=None,
+            body: typing.Optional[bytes]=None,
+            bufsize: int=65536,
+    ) -> typing.Iterator[bytes]:
+        context = RequestContext.get_current()
 
-        else:
-            response = get_item(response, path)
+        if context is None:
+            context = RequestContext()
 
-            for output in get_item(response, "output", []):
-                if get_item(output, "type") != "message":
-                    continue
+        rate_limiter = cls.rate_limiter
+        rate_limit_key = None
 
-                for content in get_item(output, "content", []):
-                    if get_item(content, "type") != "output_text":
-                        continue
+        if rate_limiter is not None:
+            rate_limit_key = RateLimiter.make_key(url, headers or {})
 
-                    text = get_item(content, "text", "")
+        attempt = 0
 
-                    yield AiResponse(
-                        is_delta=False,
-                        is_reasoning=False,
-                        is_status=False,
-                        text=text,
-                    )
+        # Retrying is safe only until the first byte of the response body is
+        # handed over to the caller.
+        while True:
+            if rate_limiter is not None:
+                cls._wait_for_rate_limits(rate_limiter, rate_limit_key, body, context)
 
-            status.update(self.extract_status(response, self.STATUS_PATHS))
+            try:
+                conn, resp = cls.send_http_request(method, url, headers, body)
 
+            except Exception as exc:
+                if rate_limiter is not None and isinstance(exc, HttpError):
+                    rate_limiter.observe(rate_limit_key, exc.headers, time.time())
 
-class PerplexityClient(AiClient):
-    # https://docs.perplexity.ai/api-reference/chat-completions
+                delay = cls.get_retry_delay(exc, attempt)
 
-    URL_CHAT = "https://api.perplexity.ai/chat/completions"
+                if delay is None:
+                    raise
+
+                attempt += 1
+                context.retries += 1
+                context.backoff_seconds += delay
+                context.sleep(delay)
+
+                continue
+
+            break
+
+        if rate_limiter is not None:
+            rate_limiter.observe(
+                rate_limit_key,
+                {name.lower(): value for name, value in resp.getheaders()},
+                time.time(),
+            )
+
+        is_drained = False
+
+        try:
+            chunk = True
+
+            while chunk:
+                timeout, timeout_error = context.get_socket_timeout("idle", context.timeouts.idle)
+
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+
+                try:
+                    # read1() returns whatever is available instead of
+                    # waiting for bufsize bytes, so that streamed events are
+                    # passed on as soon as they arrive.
+                    chunk = resp.read1(bufsize)
+
+                except TimeoutError:
+                    context.check_cancelled()
+
+                    raise timeout_error
+
+                context.check_cancelled()
+
+                yield chunk
+
+            is_drained = True
+
+        finally:
+            context.remove_connection(conn)
+
+            # Only a connection with a completely read response can be used
+            # for another request.
+            if (
+                    is_drained
+                    and cls.connection_pool is not None
+                    and conn.sock is not None
+                    and not resp.will_close
+            ):
+                resp.close()
+                cls.connection_pool.release(
+                    ConnectionPool.make_key(url),
+                    conn,
+                    time.monotonic(),
+                )
+
+            else:
+                conn.close()
+
+    @staticmethod
+    def _wait_for_rate_limits(
+            rate_limiter: RateLimiter,
+            rate_limit_key: str,
+            body: typing.Optional[bytes],
+            context: RequestContext,
+    ):
+        tokens = estimate_tokens(body.decode("utf-8", errors="ignore")) if body else 0
+        waited = 0.0
+
+        while waited < RateLimiter.MAX_WAIT_SECONDS:
+            wait = rate_limiter.acquire(rate_limit_key, tokens, time.time())
+
+            if wait <= 0.0:
+                break
+
+            wait = min(wait, RateLimiter.MAX_WAIT_SECONDS - waited)
+            context.sleep(wait)
+            context.rate_limit_wait_seconds += wait
+            waited += wait
+
+    @staticmethod
+    def send_http_request(
+            method: str,
+            url: str,
+            headers: typing.Optional[typing.Dict[str, str]]=None,
+            body: typing.Optional[bytes]=None,
+            use_pool: bool=True,
+    ) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        """
+        Send the request, and return the connection and the response, with
+        the body of the latter not yet read, or raise HttpError.
+        """
+
+        parsed_url = urllib.parse.urlparse(url)
+        context = RequestContext.get_current() or RequestContext()
+        connection_pool = AiClient.connection_pool if use_pool else None
+        conn = None
+
+        if connection_pool is not None:
+            conn = connection_pool.acquire(ConnectionPool.make_key(url), time.monotonic())
+
+        is_reused = conn is not None
+
+        if conn is None:
+            timeout, timeout_error = context.get_socket_timeout("connect", context.timeouts.connect)
+            connection_cls = (
+                http.client.HTTPConnection
+                if parsed_url.scheme == "http"
+                else http.client.HTTPSConnection
+            )
+            conn = connection_cls(parsed_url.netloc, timeout=timeout)
+
+        context.add_connection(conn)
+
+        try:
+            path = parsed_url.path
+
+            if parsed_url.query:
+                path += "?" + parsed_url.query
+
+            if not is_reused:
+                try:
+                    conn.connect()
+
+                except TimeoutError:
+                    raise timeout_error
+
+            timeout, timeout_error = context.get_socket_timeout(
+                "first byte",
+                context.timeouts.first_byte,
+            )
+            conn.sock.settimeout(timeout)
+
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                context.check_cancelled()
+                resp = conn.getresponse()
+
+            except TimeoutError:
+                context.check_cancelled()
+
+                raise timeout_error
+
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not is_reused:
+                    raise
+
+                # The server has closed the idle connection in the meantime.
+                context.remove_connection(conn)
+                conn.close()
+
+                return AiClient.send_http_request(method, url, headers, body, use_pool=False)
+
+            if resp.status != 200:
+                raise HttpError(
+                    resp.status,
+                    resp.reason,
+                    resp.read().decode(),
+                    {name.lower(): value for name, value in resp.getheaders()},
+                )
+
+        except BaseException:
+            context.remove_connection(conn)
+            conn.close()
+
+            raise
+
+        return conn, resp
+
+    @classmethod
+    def get_retry_delay(cls, exc: BaseException, attempt: int) -> typing.Optional[float]:
+        """
+        Return the number of seconds to wait before retrying a failed
+        request, or None if it should not be retried.
+        """
+
+        if attempt >= cls.RETRY_MAX_ATTEMPTS or not is_retryable_error(exc):
+            return None
+
+        # Waiting for the first byte or for the whole response again would
+        # multiply a timeout which is usually long; falling back to another
+        # model is still possible though.
+        if isinstance(exc, RequestTimeoutError) and exc.kind not in ("connect", "idle"):
+            return None
+
+        retry_after = None
+
+        if isinstance(exc, HttpError):
+            retry_after = parse_retry_after(exc.headers, time.time())
+
+        if retry_after is not None:
+            # Waiting for too long would defeat the purpose of falling back
+            # to other models.
+            return retry_after if retry_after <= cls.RETRY_MAX_DELAY else None
+
+        delay = min(cls.RETRY_MAX_DELAY, cls.RETRY_BASE_DELAY * (2.0 ** attempt))
+
+        return delay / 2.0 + random.uniform(0.0, delay / 2.0)
+
+    @classmethod
+    def http_request(
+            cls,
+            method: str,
+            url: str,
+            headers: typing.Optional[typing.Dict[str, str]]=None,
+            body: typing.Optional[bytes]=None,
+            bufsize: int=65536,
+    ) -> bytes:
+        response = b""
+
+        for chunk in cls.http_request_buffered(method, url, headers or {}, body, bufsize):
+            response += chunk
+
+        return response
+
+    @classmethod
+    def derive_prompt_cache_key(cls, conversation: collections.abc.Sequence[Message]) -> str:
+        """
+        Derive a stable key from the beginning of the conversation for
+        providers which use it for routing requests to the server that most
+        likely has the conversation's prefix in its cache.
+        """
+
+        digest = hashlib.sha256()
+
+        for message in conversation[:cls.PROMPT_CACHE_KEY_MESSAGES]:
+            digest.update(message.type.value.encode("utf-8") + b"\0")
+            digest.update(message.text.encode("utf-8") + b"\0")
+
+        return "ai-cat-" + digest.hexdigest()[:32]
+
+    @staticmethod
+    def is_json_event(data: str) -> bool:
+        # Skips "[DONE]" and the like without attempting to decode them.
+        return data.startswith("{")
 
-    STATUS_PATHS = (
-        "created",
-        "finish_reason",
-        "id",
-        "model",
-        "usage.citation_tokens",
-        "usage.completion_tokens",
-        "usage.num_search_queries",
-        "usage.prompt_tokens",
-        "usage.reasoning_tokens",
-        "usage.search_context_size",
-        "usage.total_tokens",
+    @classmethod
+    def has_new_status(cls, data: str, status: typing.Dict[str, typing.Any]) -> bool:
+        """
+        Tell whether a chunk of a chat completions stream may contain status
+        fields that are not yet known, based on a cheap look at its payload.
+        """
+
+        if len(status) == 0:
+            return True
+
+        for marker in cls.STREAM_STATUS_MARKERS:
+            if marker in data:
+                return True
+
+        return False
+
+    @staticmethod
+    def extract_status(data, paths: "StatusPaths") -> typing.Dict[str, typing.Any]:
+        return paths.extract(data)
+
+    @classmethod
+    def is_length_stop(cls, status: typing.Dict[str, typing.Any]) -> bool:
+        return any(status.get(path) == value for path, value in cls.LENGTH_STOPS)
+
+    @staticmethod
+    def is_reasoning_enabled(reasoning: Reasoning) -> bool:
+        return reasoning not in (Reasoning.DEFAULT, Reasoning.OFF)
+
+    @staticmethod
+    def get_max_tokens(
+            options: typing.Optional[RequestOptions],
+            default: typing.Optional[int]=None,
+    ) -> typing.Optional[int]:
+        if options is not None and options.max_tokens > 0:
+            return options.max_tokens
+
+        return default
+
+    @classmethod
+    def get_reasoning_budget(
+            cls,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions],
+            default: typing.Optional[int]=None,
+    ) -> typing.Optional[int]:
+        if options is not None and options.reasoning_budget > 0:
+            return options.reasoning_budget
+
+        return cls.REASONING_BUDGETS.get(reasoning, default)
+
+    @classmethod
+    def get_reasoning_effort(
+            cls,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions],
+            default: str,
+    ) -> str:
+        if options is not None and options.reasoning_budget > 0:
+            for level, budget in cls.REASONING_BUDGETS.items():
+                if options.reasoning_budget <= budget:
+                    return level.value
+
+            return Reasoning.HIGH.value
+
+        if reasoning in cls.REASONING_BUDGETS:
+            return reasoning.value
+
+        return default
+
+    @classmethod
+    def compile_status(cls, status: typing.Dict[str, typing.Any]) -> typing.Iterator[AiResponse]:
+        if len(status) > 0:
+            yield AiResponse(
+                is_delta=False,
+                is_reasoning=False,
+                is_status=True,
+                text=cls.format_status(status),
+                status=dict(status),
+            )
+
+    @staticmethod
+    def format_status(status: typing.Dict[str, typing.Any]) -> str:
+        return (
+            "```\n"
+            + ("\n".join(f"{path}: {value}" for path, value in status.items()))
+            + "\n```"
+        )
+
+
+# Some of the following AiClient implementations are very similar to each other,
+# and while I'm aware of the DRY-principle (Don't Repeat Yourself), I'm also
+# aware of the DNAHCTTSC-principle (Do Not Apply Huffman-Coding To The Source
+# Code): since each provider already has their own set of unique little quirks,
+# it is not unreasonable to expect that they will keep diverging from each other
+# on the long run, making it more and more difficult to unify them under a
+# a single, sensible AI-provider-based abstraction layer, or to untangle them
+# when such a layer snaps. Therefore, at least for now, the central abstraction
+# here will remain defined in terms of the needs of AiMessenger, and the
+# surface-level similarities between the concrete AiClient implementations will
+# be kept as is.
+
+
+class AnthropicClient(AiClient):
+    # https://docs.anthropic.com/en/api/messages
+    # https://console.anthropic.com/settings/limits
+
+    URL_CHAT = "https://api.anthropic.com/v1/messages"
+    URL_MODELS = "https://api.anthropic.com/v1/models?limit=1000"
+
+    # https://docs.anthropic.com/en/docs/build-with-claude/batch-processing
+    URL_BATCHES = "https://api.anthropic.com/v1/messages/batches"
+
+    # https://docs.anthropic.com/en/docs/build-with-claude/extended-thinking
+    MIN_REASONING_BUDGET = 1024
+
+    SUPPORTS_BATCH = True
+
+    # https://docs.anthropic.com/en/docs/build-with-claude/prompt-caching
+    CACHE_MAX_BREAKPOINTS = 4
+    CACHE_LOOKBACK_BLOCKS = 20
+    CACHE_STABLE_STRIDE = 16
+    CACHE_TTL_SHORT = "5m"
+    CACHE_TTL_SHORT_SECONDS = 5 * 60
+    CACHE_TTL_LONG = "1h"
+    CACHE_TTL_LONG_SECONDS = 60 * 60
+
+    # https://docs.anthropic.com/en/api/service-tiers
+    # (Priority Tier is used automatically when it is available for the
+    # organization, and there is no cheaper, slower tier.)
+    SERVICE_TIERS = {
+        Tier.STANDARD: "standard_only",
+        Tier.PRIORITY: "auto",
+        Tier.FLEX: "standard_only",
+    }
+
+    # https://docs.anthropic.com/en/docs/build-with-claude/streaming#event-types
+    STREAM_IGNORED_EVENTS = frozenset(("ping", "content_block_stop", "message_stop"))
+    STREAM_CONTENT_EVENTS = frozenset(("content_block_start", "content_block_delta"))
+
+    STATUS_PATHS = StatusPaths(
+        (
+            "delta.stop_reason",
+            "id",
+            "message.id",
+            "message.model",
+            "message.role",
+            "message.usage.cache_creation_input_tokens",
+            "message.usage.cache_read_input_tokens",
+            "message.usage.input_tokens",
+            "message.usage.output_tokens",
+            "message.usage.service_tier",
+            "model",
+            "role",
+            "stop_reason",
+            "usage.cache_creation_input_tokens",
+            "usage.cache_read_input_tokens",
+            "usage.input_tokens",
+            "usage.output_tokens",
+            "usage.service_tier",
+        )
     )
 
+    def __init__(self, api_key: str):
+        super().__init__(api_key)
+
+        self._last_request_time = None
+
+    def get_persistent_state(self) -> typing.Dict[str, typing.Any]:
+        return {"last_request_time": self._last_request_time}
+
+    def set_persistent_state(self, state: typing.Dict[str, typing.Any]):
+        self._last_request_time = get_item(
+            state,
+            "last_request_time",
+            expect_type=(int, float),
+        )
+
     def list_models(self) -> collections.abc.Sequence[str]:
+        raw_response = self.http_request(
+            "GET",
+            self.URL_MODELS,
+            headers=self._build_request_headers(),
+        )
+        response = json.loads(raw_response)
+
         return [
-            "sonar",
-            "sonar-pro",
-            "sonar-reasoning-pro",
+            model["id"]
+            for model in get_item(response, "data", [])
+            if model["type"] == "model"
         ]
 
+    def supports_prefill(self, reasoning: Reasoning) -> bool:
+        # https://docs.anthropic.com/en/docs/build-with-claude/prefill-claudes-response
+        # (Prefilling is not available in extended thinking mode.)
+        return not self.is_reasoning_enabled(reasoning)
+
     def respond(
             self,
             model: str,
             conversation: typing.Iterator[Message],
             temperature: float,
             reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
     ) -> typing.Iterator[AiResponse]:
         headers, body = self._build_request(
             model,
@@ -1648,6 +2150,7 @@ class PerplexityClient(AiClient):
             temperature,
             reasoning,
             stream=False,
+            options=options,
         )
         response_bytes = self.http_request("POST", self.URL_CHAT, headers, body)
 
@@ -1658,1221 +2161,6292 @@ class PerplexityClient(AiClient):
             pass
 
         else:
-            status = {}
-            content = self._find_content(response, "message", status)
-            status.update(self.extract_status(response, self.STATUS_PATHS))
-            citations = self._format_citations(
-                get_item(response, "citations", []),
-                get_item(response, "search_results", []),
+            yield from self._process_message(response)
+
+    def submit_batch(self, requests: collections.abc.Sequence[BatchRequest]) -> str:
+        batch_requests = []
+
+        for request in requests:
+            # The requests of a batch are not sent in the rhythm of a
+            # conversation, so the timing of the previous request says
+            # nothing about when the cached prefix would be needed again.
+            params = self._build_request_body(
+                request.model,
+                request.conversation,
+                request.temperature,
+                request.reasoning,
+                stream=False,
+                options=request.options,
+                tail_ttl=self.CACHE_TTL_SHORT,
             )
-            reasoning, text = self._extract_response_parts(content)[:2]
 
-            if reasoning != "":
-                yield AiResponse(
-                    is_delta=False,
-                    is_reasoning=True,
-                    is_status=False,
-                    text=reasoning,
-                )
+            # Batches are processed asynchronously anyway.
+            params.pop("stream", None)
+            params.pop("service_tier", None)
 
-            # Citations and search results are often referenced in the response
-            # text so we are handling them as an integral part of the text.
-            yield AiResponse(
-                is_delta=False,
-                is_reasoning=False,
-                is_status=False,
-                text=citations + text,
+            batch_requests.append({"custom_id": request.custom_id, "params": params})
+
+        response = json.loads(
+            self.http_request(
+                "POST",
+                self.URL_BATCHES,
+                self._build_request_headers(),
+                json.dumps({"requests": batch_requests}).encode("utf-8"),
             )
+        )
 
-            yield from self.compile_status(status)
+        return response["id"]
 
-    def respond_streaming(
+    def fetch_batch_results(
             self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=True,
+            batch_id: str,
+    ) -> typing.Optional[typing.Dict[str, typing.Union[typing.List[AiResponse], BatchError]]]:
+        headers = self._build_request_headers()
+        batch = json.loads(
+            self.http_request("GET", self.URL_BATCHES + "/" + batch_id, headers)
         )
 
-        reasoning_started = False
-        old_text_started = False
-        text_started = False
-        citations = None
-        status = {}
+        if get_item(batch, "processing_status") != "ended":
+            return None
 
-        for _, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
-            try:
-                data = json.loads(data_bytes)
+        results = {}
+        results_jsonl = self.http_request("GET", batch["results_url"], headers)
 
-            except json.JSONDecodeError:
+        for line in results_jsonl.splitlines():
+            if line.strip() == b"":
                 continue
 
-            if get_item(data, "object") != "chat.completion":
-                continue
+            result = json.loads(line)
+            custom_id = get_item(result, "custom_id")
+            result_type = get_item(result, "result.type")
 
-            if citations is None:
-                citations = self._format_citations(
-                    get_item(data, "citations", []),
-                    get_item(data, "search_results", []),
+            if result_type == "succeeded":
+                results[custom_id] = list(
+                    self._process_message(get_item(result, "result.message", {}))
                 )
 
-            content = self._find_content(data, "delta", status)
-            status.update(self.extract_status(data, self.STATUS_PATHS))
+            else:
+                message = get_item(result, "result.error.error.message")
+                results[custom_id] = BatchError(
+                    f"{result_type}: {message}" if message else str(result_type)
+                )
+
+        return results
+
+    def _build_request_headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "x-api-key": self._api_key,
+            "anthropic-version": "2023-06-01",
+            "anthropic-beta": "extended-cache-ttl-2025-04-11",
+        }
 
-            old_text_started = text_started
-            reasoning, text, reasoning_started, text_started = (
-                self._extract_response_parts(
-                    content,
-                    reasoning_started,
-                    text_started,
+    def _process_message(self, response) -> typing.Iterator[AiResponse]:
+        for content in get_item(response, "content", []):
+            content_type = get_item(content, "type")
+
+            if content_type == "text":
+                yield AiResponse(
+                    is_delta=False,
+                    is_reasoning=False,
+                    is_status=False,
+                    text=get_item(content, "text", "")
                 )
-            )
 
-            if reasoning_started and reasoning != "":
+            elif content_type == "thinking":
                 yield AiResponse(
-                    is_delta=True,
+                    is_delta=False,
                     is_reasoning=True,
                     is_status=False,
-                    text=reasoning,
+                    text=get_item(content, "thinking", ""),
                 )
 
-            if text_started:
-                if not old_text_started:
+        yield from self.compile_status(
+            self.extract_status(response, self.STATUS_PATHS)
+        )
+
+    def respond_streaming(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=True,
+            options=options,
+        )
+        status = {}
+
+        for event_type, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
+            if event_type in self.STREAM_IGNORED_EVENTS:
+                continue
+
+            try:
+                data = json.loads(data_bytes)
+
+            except json.JSONDecodeError:
+                continue
+
+            if event_type not in self.STREAM_CONTENT_EVENTS:
+                status.update(self.extract_status(data, self.STATUS_PATHS))
+
+            if event_type == "content_block_start":
+                content_type = get_item(data, "content_block.type")
+
+                if content_type == "thinking":
+                    yield AiResponse(
+                        is_delta=True,
+                        is_reasoning=True,
+                        is_status=False,
+                        text=get_item(data, "content_block.thinking", ""),
+                    )
+
+                elif content_type == "text":
                     yield AiResponse(
                         is_delta=True,
                         is_reasoning=False,
                         is_status=False,
-                        text=citations,
+                        text=get_item(data, "content_block.text", ""),
                     )
 
-                yield AiResponse(
-                    is_delta=True,
-                    is_reasoning=False,
-                    is_status=False,
-                    text=text,
-                )
+            elif event_type == "content_block_delta":
+                delta_type = get_item(data, "delta.type")
+
+                if delta_type == "thinking_delta":
+                    yield AiResponse(
+                        is_delta=True,
+                        is_reasoning=True,
+                        is_status=False,
+                        text=get_item(data, "delta.thinking", ""),
+                    )
+
+                elif delta_type == "text_delta":
+                    yield AiResponse(
+                        is_delta=True,
+                        is_reasoning=False,
+                        is_status=False,
+                        text=get_item(data, "delta.text", ""),
+                    )
 
         yield from self.compile_status(status)
 
-    def _build_request(self, model, conversation, temperature, reasoning, stream):
-        headers = {
-            "Authorization": "Bearer " + self._api_key,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
+    def _build_request(self, model, conversation, temperature, reasoning, stream, options=None):
+        now = time.time()
+        tail_ttl = self.choose_cache_ttl(
+            None if self._last_request_time is None else now - self._last_request_time
+        )
+        self._last_request_time = now
+        body = self._build_request_body(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream,
+            options,
+            tail_ttl,
+        )
+
+        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+
+    def _build_request_body(self, model, conversation, temperature, reasoning, stream, options, tail_ttl):
+        system_prompt, messages = self._convert_conversation(conversation, tail_ttl)
+        max_tokens = self.get_max_tokens(options, 32000)
+
         body = {
             "model": model,
             "temperature": temperature,
-            "messages": self._convert_conversation(conversation),
-            "return_related_questions": False,
             "stream": stream,
+            "messages": messages,
+            "max_tokens": max_tokens,
         }
 
-        return headers, json.dumps(body).encode("utf-8")
+        if system_prompt is not None:
+            body["system"] = system_prompt
 
-    def _convert_conversation(self, conversation):
-        roles = {
-            MessageType.SYSTEM: "system",
-            MessageType.USER: "user",
-            MessageType.AI: "assistant",
-        }
+        if options is not None and options.tier in self.SERVICE_TIERS:
+            body["service_tier"] = self.SERVICE_TIERS[options.tier]
 
-        return [
-            {
-                "role": roles.get(message.type, "user"),
-                "content": message.text,
+        # The budget must be at least 1024, and less than max_tokens, so
+        # thinking cannot be enabled when max_tokens is too low.
+        if self.is_reasoning_enabled(reasoning) and max_tokens > self.MIN_REASONING_BUDGET:
+            budget_tokens = self.get_reasoning_budget(reasoning, options, 16000)
+            body["thinking"] = {
+                "type": "enabled",
+                "budget_tokens": max(self.MIN_REASONING_BUDGET, min(budget_tokens, max_tokens - 1)),
             }
-            for message in conversation
-        ]
 
-    @staticmethod
-    def _format_citations(citations, search_results):
-        citations_text = ""
-        search_results_text = ""
+        elif reasoning == Reasoning.OFF:
+            body["thinking"] = {"type": "disabled"}
 
-        if len(citations) > 0:
-            citations_text = (
-                "Citations:\n"
-                + ("\n".join(f"{i + 1}. {url}" for i, url in enumerate(citations)))
-                + "\n\n"
-            )
+        return body
 
-        if len(search_results) > 0:
-            search_results_text = (
-                "Search results:\n"
-                + (
-                    "\n".join(
-                        f"{i + 1}. {obj['title']} - {obj['url']}"
-                        for i, obj in enumerate(search_results)
-                    )
-                )
-                + "\n\n"
-            )
+    def _convert_conversation(self, conversation, tail_ttl):
+        system_prompt = None
+        other_messages = []
 
-        return citations_text + search_results_text
+        for message in conversation:
+            if message.type == MessageType.SYSTEM:
+                system_prompt = self._wrap_text(message.text, self.CACHE_TTL_LONG)
 
-    def _find_content(self, response, key, status):
-        content = None
+            else:
+                other_messages.append(message)
 
-        for choice in get_item(response, "choices", []):
-            if get_item(choice, key + ".role") != "assistant":
-                continue
+        stable_breakpoints, tail_breakpoints = self.plan_cache_breakpoints(
+            [message.type for message in other_messages],
+            system_prompt is not None,
+        )
+        messages = []
 
-            content = get_item(choice, key + ".content")
-            status.update(self.extract_status(choice, self.STATUS_PATHS))
+        for i, message in enumerate(other_messages):
+            ttl = None
+
+            if i in tail_breakpoints:
+                ttl = tail_ttl
+
+            elif i in stable_breakpoints:
+                ttl = self.CACHE_TTL_LONG
+
+            messages.append(
+                {
+                    "role": "assistant" if message.type == MessageType.AI else "user",
+                    "content": self._wrap_text(message.text, ttl),
+                }
+            )
+
+        return system_prompt, messages
+
+    @classmethod
+    def plan_cache_breakpoints(
+            cls,
+            message_types: collections.abc.Sequence[MessageType],
+            has_system_prompt: bool,
+    ) -> tuple[typing.Set[int], typing.Set[int]]:
+        """
+        Select the messages to be marked with cache breakpoints (besides the
+        system prompt which is always marked when present), and return the
+        indices of the stable and the tail breakpoints.
+
+        A tail breakpoint is placed on the last message, so that the next turn
+        can read everything that is sent now. The last message of the previous
+        turn is marked only if it is too far away for the automatic lookback
+        (CACHE_LOOKBACK_BLOCKS) to find it from the last message. The remaining
+        breakpoints go to every CACHE_STABLE_STRIDE-th message, going backwards
+        from the tail: these positions don't move while the conversation grows,
+        so their cache entries keep being hit even if the tail of the
+        conversation is edited. (Stable breakpoints use the long TTL, and the
+        API requires those to precede the ones with a shorter TTL, so they are
+        never placed after a tail breakpoint.)
+        """
+
+        num_messages = len(message_types)
+        budget = cls.CACHE_MAX_BREAKPOINTS - (1 if has_system_prompt else 0)
+        stable = set()
+        tail = set()
+
+        if num_messages == 0 or budget <= 0:
+            return stable, tail
+
+        last = num_messages - 1
+        tail.add(last)
+
+        for i in range(last, 0, -1):
+            if message_types[i] == MessageType.AI and message_types[i - 1] != MessageType.AI:
+                if budget > 1 and last - (i - 1) >= cls.CACHE_LOOKBACK_BLOCKS:
+                    tail.add(i - 1)
 
-            if content is not None:
                 break
 
-        return content
+        stride = cls.CACHE_STABLE_STRIDE
+        position = (min(tail) // stride) * stride - 1
+
+        while position >= 0 and len(tail) + len(stable) < budget:
+            stable.add(position)
+            position -= stride
+
+        return stable, tail
+
+    @classmethod
+    def choose_cache_ttl(cls, seconds_since_last_request: typing.Optional[float]) -> str:
+        """
+        Guess how long the user will think before the next turn based on how
+        long they thought before this one: the 1 hour cache is more expensive
+        to write, so it's only worth it if the short one would expire.
+        """
+
+        if (
+                seconds_since_last_request is not None
+                and cls.CACHE_TTL_SHORT_SECONDS <= seconds_since_last_request < cls.CACHE_TTL_LONG_SECONDS
+        ):
+            return cls.CACHE_TTL_LONG
+
+        return cls.CACHE_TTL_SHORT
+
+    @staticmethod
+    def _wrap_text(text: str, ttl: typing.Optional[str]) -> typing.List:
+        if ttl is not None:
+            return [
+                {
+                    "type": "text",
+                    "text": text,
+                    "cache_control": {
+                        "type": "ephemeral",
+                        "ttl": ttl,
+                    },
+                },
+            ]
+
+        return [{"type": "text", "text": text}]
+
+
+class DeepSeekClient(AiClient):
+    # https://api-docs.deepseek.com/api/create-chat-completion
+
+    URL_CHAT = "https://api.deepseek.com/chat/completions"
+    URL_MODELS = "https://api.deepseek.com/models"
+
+    STATUS_PATHS = StatusPaths(
+        (
+            "created",
+            "finish_reason",
+            "id",
+            "model",
+            "system_fingerprint",
+            "usage.completion_tokens",
+            "usage.completion_tokens_details.reasoning_tokens",
+            "usage.prompt_cache_hit_tokens",
+            "usage.prompt_cache_miss_tokens",
+            "usage.prompt_tokens",
+            "usage.prompt_tokens_details.cached_tokens",
+            "usage.total_tokens",
+        )
+    )
+
+    def list_models(self) -> collections.abc.Sequence[str]:
+        raw_response = self.http_request(
+            "GET",
+            self.URL_MODELS,
+            headers=self._build_request_headers(),
+        )
+        response = json.loads(raw_response)
+
+        return [
+            model["id"]
+            for model in get_item(response, "data", [])
+            if model["object"] == "model"
+        ]
+
+    def respond(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=False,
+            options=options,
+        )
+        response_bytes = self.http_request("POST", self.URL_CHAT, headers, body)
+        status = {}
+
+        try:
+            response = json.loads(response_bytes)
+
+        except json.JSONDecodeError:
+            pass
+
+        else:
+            for choice in get_item(response, "choices", []):
+                if get_item(choice, "message.role") != "assistant":
+                    continue
+
+                reasoning = get_item(choice, "message.reasoning_content")
+                text = get_item(choice, "message.content", "")
+
+                if reasoning is not None:
+                    yield AiResponse(
+                        is_delta=False,
+                        is_reasoning=True,
+                        is_status=False,
+                        text=reasoning,
+                    )
+
+                yield AiResponse(
+                    is_delta=False,
+                    is_reasoning=False,
+                    is_status=False,
+                    text=text,
+                )
+
+                status.update(self.extract_status(choice, self.STATUS_PATHS))
+
+                break
+
+            status.update(self.extract_status(response, self.STATUS_PATHS))
+
+            yield from self.compile_status(status)
+
+    def respond_streaming(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=True,
+            options=options,
+        )
+        status = {}
+
+        for _, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
+            if not self.is_json_event(data_bytes):
+                continue
+
+            has_new_status = self.has_new_status(data_bytes, status)
+
+            try:
+                data = json.loads(data_bytes)
+
+            except json.JSONDecodeError:
+                continue
+
+            if get_item(data, "object") == "chat.completion.chunk":
+                for choice in get_item(data, "choices", []):
+                    reasoning = get_item(choice, "delta.reasoning_content")
+
+                    if reasoning is not None:
+                        yield AiResponse(
+                            is_delta=True,
+                            is_reasoning=True,
+                            is_status=False,
+                            text=reasoning,
+                        )
+
+                    text = get_item(choice, "delta.content")
+
+                    if text is not None:
+                        yield AiResponse(
+                            is_delta=True,
+                            is_reasoning=False,
+                            is_status=False,
+                            text=text,
+                        )
+
+                    if has_new_status:
+                        status.update(self.extract_status(choice, self.STATUS_PATHS))
+
+                    break
+
+                if has_new_status:
+                    status.update(self.extract_status(data, self.STATUS_PATHS))
+
+        yield from self.compile_status(status)
+
+    def _build_request_headers(self):
+        return {
+            "Authorization": "Bearer " + self._api_key,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+
+    def _build_request(self, model, conversation, temperature, reasoning, stream, options=None):
+        body = {
+            "model": model,
+            "temperature": temperature,
+            "messages": self._convert_conversation(conversation),
+            "stream": stream,
+        }
+
+        if reasoning == Reasoning.OFF:
+            body["thinking"] = {"type": "disabled"}
+        elif self.is_reasoning_enabled(reasoning):
+            body["thinking"] = {"type": "enabled"}
+            body["reasoning_effort"] = self.get_reasoning_effort(reasoning, options, "high")
+
+        max_tokens = self.get_max_tokens(options)
+
+        if max_tokens is not None:
+            body["max_tokens"] = max_tokens
+
+        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+
+    def _convert_conversation(self, conversation):
+        roles = {
+            MessageType.SYSTEM: "system",
+            MessageType.USER: "user",
+            MessageType.AI: "assistant",
+        }
+
+        return [
+            {
+                "role": roles.get(message.type, "user"),
+                "content": message.text,
+            }
+            for message in conversation
+        ]
+
+
+class GoogleClient(AiClient):
+    # https://ai.google.dev/gemini-api/docs/text-generation
+    # https://ai.google.dev/api/generate-content#method:-models.generatecontent
+
+    URL_TPL_CHAT = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}"
+    URL_TPL_CHAT_STREAM = "https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent?alt=sse&key={api_key}"
+    URL_TPL_MODELS = "https://generativelanguage.googleapis.com/v1beta/models?pageSize=1000&key={api_key}"
+
+    # https://ai.google.dev/gemini-api/docs/batch-mode
+    URL_TPL_BATCHES = "https://generativelanguage.googleapis.com/v1beta/models/{model}:batchGenerateContent?key={api_key}"
+    URL_TPL_BATCH = "https://generativelanguage.googleapis.com/v1beta/{name}?key={api_key}"
+
+    SUPPORTS_BATCH = True
+
+    BATCH_STATE_SUCCEEDED = "BATCH_STATE_SUCCEEDED"
+    BATCH_STATES_FAILED = frozenset(
+        (
+            "BATCH_STATE_FAILED",
+            "BATCH_STATE_CANCELLED",
+            "BATCH_STATE_EXPIRED",
+        )
+    )
+
+    # https://ai.google.dev/gemini-api/docs/caching
+    URL_TPL_CACHES = "https://generativelanguage.googleapis.com/v1beta/cachedContents?key={api_key}"
+    URL_TPL_CACHE = "https://generativelanguage.googleapis.com/v1beta/{name}?key={api_key}"
+
+    # Explicit caching is used only when the uncached part of the stable prefix
+    # of a conversation is at least this large (estimated). (The API rejects
+    # caches below a model-dependent minimum size anyway.)
+    CACHE_MIN_TOKENS = 4096
+    CACHE_TTL_SECONDS = 60 * 60
+    CACHE_REFRESH_SECONDS = 10 * 60
+    CACHE_EXPIRY_MARGIN_SECONDS = 60
+    CACHE_MAX_RECORDS = 16
+
+    HEADERS = {
+        "Content-Type": "application/json",
+        "Accept": "application/json",
+    }
+
+    STATUS_PATHS = StatusPaths(
+        (
+            "finishReason",
+            "modelVersion",
+            "promptFeedback.blockReason",
+            "responseId",
+            "usageMetadata.cachedContentTokenCount",
+            "usageMetadata.candidatesTokenCount",
+            "usageMetadata.promptTokenCount",
+            "usageMetadata.thoughtsTokenCount",
+            "usageMetadata.toolUsePromptTokenCount",
+            "usageMetadata.totalTokenCount",
+        )
+    )
+
+    def __init__(self, api_key: str):
+        super().__init__(api_key)
+
+        self._caches = []
+        self._output_token_limits = {}
+
+    def get_persistent_state(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "caches": self._caches,
+            "output_token_limits": self._output_token_limits,
+        }
+
+    def set_persistent_state(self, state: typing.Dict[str, typing.Any]):
+        self._output_token_limits = {
+            model: limit
+            for model, limit in get_item(
+                state,
+                "output_token_limits",
+                default={},
+                expect_type=dict,
+            ).items()
+            if isinstance(limit, int)
+        }
+        self._caches = [
+            cache
+            for cache in get_item(state, "caches", default=[], expect_type=list)
+            if (
+                isinstance(get_item(cache, "name"), str)
+                and isinstance(get_item(cache, "model"), str)
+                and isinstance(get_item(cache, "message_count"), int)
+                and isinstance(get_item(cache, "prefix_hash"), str)
+                and isinstance(get_item(cache, "expire_time"), (int, float))
+            )
+        ]
+
+    def list_models(self) -> collections.abc.Sequence[str]:
+        raw_response = self.http_request(
+            "GET",
+            self.URL_TPL_MODELS.format(api_key=self._api_key),
+            headers=self.HEADERS,
+        )
+        response = json.loads(raw_response)
+        models = []
+
+        for model in get_item(response, "models", []):
+            if "generateContent" not in model["supportedGenerationMethods"]:
+                continue
+
+            name = model["name"]
+            name = name.split("/", 1)[-1] if name.startswith("models/") else name
+            output_token_limit = get_item(model, "outputTokenLimit", expect_type=int)
+            models.append(name)
+
+            if output_token_limit is not None:
+                self._output_token_limits[name] = output_token_limit
+
+        return models
+
+    def get_output_token_limit(self, model: str) -> typing.Optional[int]:
+        return self._output_token_limits.get(model)
+
+    def respond(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        url = self.URL_TPL_CHAT.format(model=model, api_key= self._api_key)
+        status = {}
+        citations = []
+        responses = self._send_request(
+            lambda body: iter((self.http_request("POST", url, self.HEADERS, body), )),
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            options,
+            status,
+        )
+
+        for response in responses:
+            yield from self._process_response(response, status, citations, is_delta=True)
+
+        yield from self._compile_status(status, citations)
+
+    def respond_streaming(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        url = self.URL_TPL_CHAT_STREAM.format(model=model, api_key= self._api_key)
+        status = {}
+        citations = []
+        events = self._send_request(
+            lambda body: self.http_sse("POST", url, self.HEADERS, body),
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            options,
+            status,
+        )
+
+        for _, data in events:
+            yield from self._process_response(data, status, citations, is_delta=True)
+
+        yield from self._compile_status(status, citations)
+
+    def submit_batch(self, requests: collections.abc.Sequence[BatchRequest]) -> str:
+        models = set(request.model for request in requests)
+
+        if len(models) != 1:
+            raise ValueError(f"A batch must use exactly one model, got {sorted(models)!r}")
+
+        body = {
+            "batch": {
+                "display_name": "ai-cat",
+                "input_config": {
+                    "requests": {
+                        "requests": [
+                            {
+                                "request": json.loads(
+                                    self._build_request_body(
+                                        request.conversation,
+                                        request.temperature,
+                                        request.reasoning,
+                                        options=request.options,
+                                    )
+                                ),
+                                "metadata": {"key": request.custom_id},
+                            }
+                            for request in requests
+                        ],
+                    },
+                },
+            },
+        }
+        response = json.loads(
+            self.http_request(
+                "POST",
+                self.URL_TPL_BATCHES.format(model=models.pop(), api_key=self._api_key),
+                self.HEADERS,
+                json.dumps(body).encode("utf-8"),
+            )
+        )
+
+        return response["name"]
+
+    def fetch_batch_results(
+            self,
+            batch_id: str,
+    ) -> typing.Optional[typing.Dict[str, typing.Union[typing.List[AiResponse], BatchError]]]:
+        batch = json.loads(
+            self.http_request(
+                "GET",
+                self.URL_TPL_BATCH.format(name=batch_id, api_key=self._api_key),
+                self.HEADERS,
+            )
+        )
+        state = get_item(batch, "metadata.state")
+
+        if state in self.BATCH_STATES_FAILED:
+            message = get_item(batch, "error.message")
+
+            raise BatchError(f"{state}: {message}" if message else state)
+
+        if state != self.BATCH_STATE_SUCCEEDED:
+            return None
+
+        results = {}
+        inlined_responses = get_item(
+            batch,
+            "response.inlinedResponses.inlinedResponses",
+            [],
+        )
+
+        for inlined_response in inlined_responses:
+            custom_id = get_item(inlined_response, "metadata.key")
+
+            if get_item(inlined_response, "error") is not None:
+                results[custom_id] = BatchError(
+                    get_item(inlined_response, "error.message", "request failed")
+                )
+
+                continue
+
+            status = {}
+            citations = []
+            results[custom_id] = list(
+                self._process_response(
+                    json.dumps(get_item(inlined_response, "response", {})),
+                    status,
+                    citations,
+                    is_delta=True,
+                )
+            )
+            results[custom_id].extend(self._compile_status(status, citations))
+
+        return results
+
+    def _send_request(
+            self,
+            send: collections.abc.Callable[[bytes], typing.Iterator],
+            model: str,
+            conversation: collections.abc.Sequence[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions],
+            status: typing.Dict[str, typing.Any],
+    ) -> typing.Iterator:
+        conversation = list(conversation)
+        cache, cached_count = self._find_cache(model, conversation, status)
+        body = self._build_request_body(
+            conversation[cached_count:],
+            temperature,
+            reasoning,
+            cache,
+            options,
+        )
+
+        if cache is None:
+            return send(body)
+
+        # The cache may have been deleted or expired earlier than expected, in
+        # which case the whole conversation needs to be sent.
+        try:
+            responses = send(body)
+            first_response = next(responses, None)
+
+        except HttpError as http_err:
+            if not self._is_cache_unavailable_error(http_err, cache):
+                raise
+
+            self._caches = [c for c in self._caches if c["name"] != cache]
+            status["cachedContent"] = f"{cache} is not available, sent the whole conversation"
+            body = self._build_request_body(conversation, temperature, reasoning, options=options)
+
+            return send(body)
+
+        if first_response is None:
+            return responses
+
+        return itertools.chain((first_response, ), responses)
+
+    @staticmethod
+    def _is_cache_unavailable_error(http_err: HttpError, cache: str) -> bool:
+        # Other errors (e.g. an invalid request or a missing model) would be
+        # repeated or hidden by resending the whole conversation.
+        if http_err.status not in (400, 403, 404):
+            return False
+
+        body = str(http_err.body)
+
+        return cache in body or "cachedcontent" in body.lower().replace(" ", "")
+
+    def _find_cache(
+            self,
+            model: str,
+            conversation: collections.abc.Sequence[Message],
+            status: typing.Dict[str, typing.Any],
+    ) -> tuple[typing.Optional[str], int]:
+        """
+        Find the longest cached prefix of the conversation, or create a new
+        cache if enough of the stable prefix (everything before the last User
+        messages) is not cached yet, and return the name of the cache and the
+        number of messages that it covers.
+        """
+
+        now = time.time()
+        self._caches = [
+            cache
+            for cache in self._caches
+            if cache["expire_time"] > now + self.CACHE_EXPIRY_MARGIN_SECONDS
+        ]
+
+        stable_count = len(conversation)
+
+        while stable_count > 0 and conversation[stable_count - 1].type == MessageType.USER:
+            stable_count -= 1
+
+        best = None
+
+        for cache in self._caches:
+            message_count = cache["message_count"]
+
+            if (
+                    cache["model"] == model
+                    and 0 < message_count <= stable_count
+                    and (best is None or message_count > best["message_count"])
+                    and cache["prefix_hash"] == hash_conversation(conversation[:message_count])
+            ):
+                best = cache
+
+        cached_count = 0 if best is None else best["message_count"]
+        uncached_tokens = sum(
+            estimate_tokens(message.text)
+            for message in conversation[cached_count:stable_count]
+        )
+
+        if uncached_tokens >= self.CACHE_MIN_TOKENS:
+            new_cache = self._create_cache(model, conversation[:stable_count], now, status)
+
+            if new_cache is not None:
+                # Caches which contain only the system prompt may be shared by
+                # multiple conversations, but the rest are not worth keeping
+                # around after being superseded.
+                if best is not None and best["message_count"] > 1:
+                    self._delete_cache(best)
+
+                best = new_cache
+
+        elif (
+                best is not None
+                and best["expire_time"] - now < self.CACHE_REFRESH_SECONDS
+        ):
+            self._refresh_cache(best, now, status)
+
+        if best is None:
+            return None, 0
+
+        status["cachedContent"] = best["name"]
+
+        return best["name"], best["message_count"]
+
+    def _create_cache(
+            self,
+            model: str,
+            conversation: collections.abc.Sequence[Message],
+            now: float,
+            status: typing.Dict[str, typing.Any],
+    ) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        system_prompt, contents = self._convert_conversation(conversation)
+        body = {
+            "model": "models/" + model,
+            "ttl": f"{self.CACHE_TTL_SECONDS}s",
+        }
+
+        if len(contents) > 0:
+            body["contents"] = contents
+
+        if system_prompt is not None:
+            body["system_instruction"] = system_prompt
+
+        try:
+            response = json.loads(
+                self.http_request(
+                    "POST",
+                    self.URL_TPL_CACHES.format(api_key=self._api_key),
+                    self.HEADERS,
+                    json.dumps(body).encode("utf-8"),
+                )
+            )
+
+        except (HttpError, json.JSONDecodeError) as exc:
+            status["cachedContent.error"] = str(exc)
+
+            return None
+
+        name = get_item(response, "name", expect_type=str)
+
+        if not name:
+            return None
+
+        cache = {
+            "name": name,
+            "model": model,
+            "message_count": len(conversation),
+            "prefix_hash": hash_conversation(conversation),
+            "expire_time": now + self.CACHE_TTL_SECONDS,
+        }
+        self._caches.append(cache)
+
+        while len(self._caches) > self.CACHE_MAX_RECORDS:
+            self._delete_cache(min(self._caches, key=lambda c: c["expire_time"]))
+
+        return cache
+
+    def _refresh_cache(
+            self,
+            cache: typing.Dict[str, typing.Any],
+            now: float,
+            status: typing.Dict[str, typing.Any],
+    ):
+        try:
+            self.http_request(
+                "PATCH",
+                self.URL_TPL_CACHE.format(name=cache["name"], api_key=self._api_key),
+                self.HEADERS,
+                json.dumps({"ttl": f"{self.CACHE_TTL_SECONDS}s"}).encode("utf-8"),
+            )
+
+        except HttpError as http_err:
+            status["cachedContent.error"] = str(http_err)
+
+            return
+
+        cache["expire_time"] = now + self.CACHE_TTL_SECONDS
+
+    def _delete_cache(self, cache: typing.Dict[str, typing.Any]):
+        self._caches = [c for c in self._caches if c["name"] != cache["name"]]
+
+        try:
+            self.http_request(
+                "DELETE",
+                self.URL_TPL_CACHE.format(name=cache["name"], api_key=self._api_key),
+                self.HEADERS,
+            )
+
+        except HttpError:
+            pass
+
+    def _build_request_body(self, conversation, temperature, reasoning, cache=None, options=None):
+        system_prompt, contents = self._convert_conversation(conversation)
+
+        body = {
+            "contents": contents,
+            "generationConfig": {
+                "temperature": temperature,
+            },
+        }
+
+        if cache is not None:
+            body["cachedContent"] = cache
+
+        if system_prompt is not None:
+            # As of August, 2025, the official documentation uses snake case,
+            # for example, in the cURL example at
+            # https://ai.google.dev/gemini-api/docs/text-generation#rest_2
+            #
+            # Though camel case also seems to work, let's keep to the format
+            # that is used in the official docs.
+
+            body["system_instruction"] = system_prompt
+
+        if reasoning == Reasoning.OFF:
+            body["generationConfig"]["thinkingConfig"] = {
+                "includeThoughts": False,
+                "thinkingBudget": 0,
+            }
+
+        else:
+            body["generationConfig"]["thinkingConfig"] = {
+                "includeThoughts": True,
+            }
+
+            # Without a budget, the model decides how much to think.
+            thinking_budget = self.get_reasoning_budget(reasoning, options)
+
+            if thinking_budget is not None:
+                body["generationConfig"]["thinkingConfig"]["thinkingBudget"] = thinking_budget
+
+        max_tokens = self.get_max_tokens(options)
+
+        if max_tokens is not None:
+            body["generationConfig"]["maxOutputTokens"] = max_tokens
+
+        return json.dumps(body).encode("utf-8")
+
+    def _convert_conversation(self, conversation):
+        contents = []
+        system_prompt = None
+
+        for message in conversation:
+            if message.type == MessageType.SYSTEM:
+                system_prompt = {"parts": [{"text": message.text}]}
+
+            else:
+                contents.append(
+                    {
+                        "role": "model" if message.type == MessageType.AI else "user",
+                        "parts": [{"text": message.text}],
+                    }
+                )
+
+        return system_prompt, contents
+
+    def _process_response(
+            self,
+            response_bytes: bytes,
+            status: typing.Dict[str, typing.Any],
+            citations: typing.List[str],
+            is_delta: bool,
+    ) -> typing.Iterator[AiResponse]:
+        try:
+            response = json.loads(response_bytes)
+
+        except json.JSONDecodeError:
+            pass
+
+        else:
+            for candidate in get_item(response, "candidates", []):
+                if get_item(candidate, "content.role") != "model":
+                    continue
+
+                for part in get_item(candidate, "content.parts", []):
+                    text = get_item(part, "text")
+
+                    if text is not None:
+                        yield AiResponse(
+                            is_delta=True,
+                            is_reasoning=get_item(part, "thought", False),
+                            is_status=False,
+                            text=text,
+                        )
+
+                status.update(self.extract_status(candidate, self.STATUS_PATHS))
+
+                candidate_citations = get_item(
+                    candidate,
+                    "citationMetadata.citationSources",
+                    [],
+                )
+
+                for candidate_citation in candidate_citations:
+                    uri = get_item(candidate_citation, "uri")
+
+                    if uri:
+                        citations.append(uri)
+
+                break
+
+            status.update(self.extract_status(response, self.STATUS_PATHS))
+
+    def _compile_status(
+            self,
+            status: typing.Dict[str, typing.Any],
+            citations: typing.List[str],
+    ) -> typing.Iterator[AiResponse]:
+        if len(citations) == 0:
+            yield from super().compile_status(status)
+
+        else:
+            # Citations are stored in the status message because they are
+            # usually not directly referenced in the response text.
+            citations_text = (
+                "Citations:\n"
+                + (
+                    "\n".join(
+                        f"{i+1}. {citation}"
+                        for i, citation in enumerate(dict.fromkeys(citations).keys())
+                    )
+                )
+            )
+            responses = list(self.compile_status(status))
+
+            if len(responses) == 0:
+                yield AiResponse(
+                    is_delta=False,
+                    is_reasoning=False,
+                    is_status=True,
+                    text=citations_text,
+                )
+
+            else:
+                responses[0] = AiResponse(
+                    is_delta=False,
+                    is_reasoning=False,
+                    is_status=True,
+                    text=citations_text + "\n\n" + responses[0].text,
+                    status=responses[0].status,
+                )
+
+                yield from responses
+
+
+class MistralClient(AiClient):
+    # https://docs.mistral.ai/api/endpoint/chat
+    # https://docs.mistral.ai/api/endpoint/models
+
+    URL_CHAT = "https://api.mistral.ai/v1/chat/completions"
+    URL_MODELS = "https://api.mistral.ai/v1/models"
+
+    # https://docs.mistral.ai/capabilities/predicted_outputs/
+    SUPPORTS_PREDICTION = True
+
+    STATUS_PATHS = StatusPaths(
+        (
+            "usage.prompt_tokens",
+            "usage.total_tokens",
+            "usage.completion_tokens",
+            "usage.prompt_token_details.cached_tokens",
+            "usage.prompt_tokens_details.cached_tokens",
+            "finish_reason",
+        )
+    )
+
+    def list_models(self) -> collections.abc.Sequence[str]:
+        raw_response = self.http_request(
+            "GET",
+            self.URL_MODELS,
+            headers=self._build_request_headers(),
+        )
+        response = json.loads(raw_response)
+
+        return [
+            model["id"]
+            for model in get_item(response, "data", [])
+        ]
+
+    def respond(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=False,
+            options=options,
+        )
+        response = self.http_request("POST", self.URL_CHAT, headers, body)
+        status = {}
+
+        yield from self._process_response(response, "message", status, is_delta=False)
+        yield from self.compile_status(status)
+
+    def respond_streaming(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=True,
+            options=options,
+        )
+        status = {}
+
+        for event_type, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
+            if not self.is_json_event(data_bytes):
+                continue
+
+            yield from self._process_response(
+                data_bytes,
+                "delta",
+                status,
+                is_delta=True,
+                has_new_status=self.has_new_status(data_bytes, status),
+            )
+
+        yield from self.compile_status(status)
+
+    def _build_request_headers(self):
+        return {
+            "Authorization": "Bearer " + self._api_key,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+
+    def _build_request(self, model, conversation, temperature, reasoning, stream, options=None):
+        body = {
+            "model": model,
+            "temperature": temperature,
+            "messages": self._convert_conversation(conversation),
+            "safe_prompt": False,
+            "stream": stream,
+        }
+
+        if self.is_reasoning_enabled(reasoning):
+            body["reasoning_effort"] = self.get_reasoning_effort(reasoning, options, "high")
+
+        max_tokens = self.get_max_tokens(options)
+
+        if max_tokens is not None:
+            body["max_tokens"] = max_tokens
+
+        if options is not None and options.prediction is not None:
+            body["prediction"] = {"type": "content", "content": options.prediction}
+
+        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+
+    def _convert_conversation(self, conversation):
+        roles = {
+            MessageType.SYSTEM: "system",
+            MessageType.USER: "user",
+            MessageType.AI: "assistant",
+        }
+
+        return [
+            {
+                "role": roles.get(message.type, "user"),
+                "content": message.text,
+            }
+            for message in conversation
+        ]
+
+    def _process_response(
+            self,
+            response_bytes: bytes,
+            path: str,
+            status: typing.Dict[str, typing.Any],
+            is_delta: bool,
+            has_new_status: bool=True,
+    ) -> typing.Iterator[AiResponse]:
+        try:
+            response = json.loads(response_bytes)
+
+        except json.JSONDecodeError:
+            pass
+
+        else:
+            if has_new_status:
+                status.update(self.extract_status(response, self.STATUS_PATHS))
+
+            for output in get_item(response, "choices", []):
+                role = get_item(output, path + ".role", "assistant")
+
+                if role != "assistant":
+                    continue
+
+                content = get_item(output, path + ".content", "")
+
+                if has_new_status:
+                    status.update(self.extract_status(output, self.STATUS_PATHS))
+
+                if isinstance(content, str):
+                    if content != "":
+                        yield AiResponse(
+                            is_delta=is_delta,
+                            is_reasoning=False,
+                            is_status=False,
+                            text=content,
+                        )
+                elif isinstance(content, collections.abc.Sequence):
+                    for item in content:
+                        item_type = get_item(item, "type")
+
+                        if item_type == "text":
+                            text = get_item(item, "text", "")
+
+                            if text != "":
+                                yield AiResponse(
+                                    is_delta=is_delta,
+                                    is_reasoning=False,
+                                    is_status=False,
+                                    text=text,
+                                )
+
+                        elif item_type == "thinking":
+                            for thinking in get_item(item, "thinking", []):
+                                if get_item(thinking, "type", "") == "text":
+                                    text = get_item(thinking, "text", "")
+
+                                    if text != "":
+                                        yield AiResponse(
+                                            is_delta=is_delta,
+                                            is_reasoning=True,
+                                            is_status=False,
+                                            text=text,
+                                        )
+
+class OpenAiClient(AiClient):
+    # https://platform.openai.com/docs/guides/text?api-mode=responses
+    # https://platform.openai.com/docs/api-reference/responses/create
+
+    URL_CHAT = "https://api.openai.com/v1/responses"
+    URL_MODELS = "https://api.openai.com/v1/models"
+
+    # Predicted outputs are available only via the Chat Completions API.
+    # https://platform.openai.com/docs/guides/predicted-outputs
+    URL_CHAT_COMPLETIONS = "https://api.openai.com/v1/chat/completions"
+
+    # https://platform.openai.com/docs/guides/batch
+    URL_FILES = "https://api.openai.com/v1/files"
+    URL_BATCHES = "https://api.openai.com/v1/batches"
+
+    SUPPORTS_SERVER_STATE = True
+    SUPPORTS_PREDICTION = True
+    SUPPORTS_BATCH = True
+
+    # Expired and cancelled batches may still have results for some of the
+    # requests.
+    BATCH_STATUSES_ENDED = frozenset(("completed", "expired", "cancelled"))
+
+    # https://platform.openai.com/docs/api-reference/responses/create#responses-create-service_tier
+    SERVICE_TIERS = {
+        Tier.STANDARD: "default",
+        Tier.PRIORITY: "priority",
+        Tier.FLEX: "flex",
+    }
+
+    STATUS_PATHS = StatusPaths(
+        (
+            "created_at",
+            "error.code",
+            "error.message",
+            "id",
+            "incomplete_details.reason",
+            "max_output_tokens",
+            "max_tool_calls",
+            "model",
+            "prompt_cache_key",
+            "reasoning.effort",
+            "service_tier",
+            "status",
+            "text.format.type",
+            "text.verbosity",
+            "tool_choice",
+            "truncation",
+            "usage.input_tokens",
+            "usage.input_tokens_details.cached_tokens",
+            "usage.output_tokens",
+            "usage.output_tokens_details.reasoning_tokens",
+            "usage.total_tokens",
+        )
+    )
+
+    CHAT_COMPLETIONS_STATUS_PATHS = StatusPaths(
+        (
+            "created",
+            "finish_reason",
+            "id",
+            "message.refusal",
+            "model",
+            "service_tier",
+            "system_fingerprint",
+            "usage.completion_tokens",
+            "usage.completion_tokens_details.accepted_prediction_tokens",
+            "usage.completion_tokens_details.reasoning_tokens",
+            "usage.completion_tokens_details.rejected_prediction_tokens",
+            "usage.prompt_tokens",
+            "usage.prompt_tokens_details.cached_tokens",
+            "usage.total_tokens",
+        )
+    )
+
+    def list_models(self) -> collections.abc.Sequence[str]:
+        raw_response = self.http_request(
+            "GET",
+            self.URL_MODELS,
+            headers=self._build_request_headers(),
+        )
+        response = json.loads(raw_response)
+
+        return [
+            model["id"]
+            for model in get_item(response, "data", [])
+            if model["object"] == "model" and model["owned_by"] != "openai-internal"
+        ]
+
+    def respond(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        status = {}
+
+        if options is not None and options.prediction is not None:
+            responses = self._send_predicted_request(
+                lambda headers, body: iter(
+                    (self.http_request("POST", self.URL_CHAT_COMPLETIONS, headers, body), )
+                ),
+                model,
+                conversation,
+                temperature,
+                reasoning,
+                False,
+                options,
+                status,
+            )
+
+            if responses is not None:
+                for response in responses:
+                    yield from self._process_chat_completion(response, status)
+
+                yield from self.compile_status(status)
+
+                return
+
+            options = dataclasses.replace(options, prediction=None)
+
+        responses = self._send_request(
+            lambda headers, body: iter(
+                (self.http_request("POST", self.URL_CHAT, headers, body), )
+            ),
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            False,
+            options,
+            status,
+        )
+
+        for response in responses:
+            yield from self._process_complete_response(response, ".", status)
+
+        yield from self.compile_status(status)
+
+    def respond_streaming(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        status = {}
+
+        if options is not None and options.prediction is not None:
+            events = self._send_predicted_request(
+                lambda headers, body: self.http_sse(
+                    "POST", self.URL_CHAT_COMPLETIONS, headers, body
+                ),
+                model,
+                conversation,
+                temperature,
+                reasoning,
+                True,
+                options,
+                status,
+            )
+
+            if events is not None:
+                for _, data_bytes in events:
+                    if not self.is_json_event(data_bytes):
+                        continue
+
+                    yield from self._process_chat_completion_chunk(
+                        data_bytes,
+                        status,
+                        self.has_new_status(data_bytes, status),
+                    )
+
+                yield from self.compile_status(status)
+
+                return
+
+            options = dataclasses.replace(options, prediction=None)
+
+        events = self._send_request(
+            lambda headers, body: self.http_sse("POST", self.URL_CHAT, headers, body),
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            True,
+            options,
+            status,
+        )
+
+        for event_type, data_bytes in events:
+            if event_type == "response.output_text.delta":
+                try:
+                    text = get_item(json.loads(data_bytes), "delta", "")
+
+                except json.JSONDecodeError:
+                    pass
+
+                else:
+                    yield AiResponse(
+                        is_delta=True,
+                        is_reasoning=False,
+                        is_status=False,
+                        text=text,
+                    )
+
+            elif event_type == "response.created" or event_type == "response.in_progress":
+                try:
+                    data = get_item(json.loads(data_bytes), "response")
+
+                except json.JSONDecodeError:
+                    pass
+
+                else:
+                    status.update(self.extract_status(data, self.STATUS_PATHS))
+
+            elif event_type == "response.completed":
+                yield from self._process_complete_response(
+                    data_bytes,
+                    "response",
+                    status,
+                )
+
+        yield from self.compile_status(status)
+
+    def submit_batch(self, requests: collections.abc.Sequence[BatchRequest]) -> str:
+        lines = []
+
+        for request in requests:
+            _, body = self._build_request(
+                request.model,
+                request.conversation,
+                request.temperature,
+                request.reasoning,
+                False,
+                request.options,
+            )
+            lines.append(
+                json.dumps(
+                    {
+                        "custom_id": request.custom_id,
+                        "method": "POST",
+                        "url": "/v1/responses",
+                        "body": json.loads(body),
+                    }
+                )
+            )
+
+        input_file_id = self._upload_file(
+            "ai-cat-batch.jsonl",
+            ("\n".join(lines) + "\n").encode("utf-8"),
+            "batch",
+        )
+        response = json.loads(
+            self.http_request(
+                "POST",
+                self.URL_BATCHES,
+                self._build_request_headers(),
+                json.dumps(
+                    {
+                        "input_file_id": input_file_id,
+                        "endpoint": "/v1/responses",
+                        "completion_window": "24h",
+                    }
+                ).encode("utf-8"),
+            )
+        )
+
+        return response["id"]
+
+    def fetch_batch_results(
+            self,
+            batch_id: str,
+    ) -> typing.Optional[typing.Dict[str, typing.Union[typing.List[AiResponse], BatchError]]]:
+        headers = self._build_request_headers()
+        batch = json.loads(
+            self.http_request("GET", self.URL_BATCHES + "/" + batch_id, headers)
+        )
+        batch_status = get_item(batch, "status")
+
+        if batch_status == "failed":
+            messages = [
+                get_item(batch_error, "message", "")
+                for batch_error in get_item(batch, "errors.data", [])
+            ]
+
+            raise BatchError("; ".join(messages) or "failed")
+
+        if batch_status not in self.BATCH_STATUSES_ENDED:
+            return None
+
+        results = {}
+
+        for file_id in (get_item(batch, "output_file_id"), get_item(batch, "error_file_id")):
+            if not file_id:
+                continue
+
+            results_jsonl = self.http_request(
+                "GET",
+                self.URL_FILES + "/" + file_id + "/content",
+                headers,
+            )
+
+            for line in results_jsonl.splitlines():
+                if line.strip() == b"":
+                    continue
+
+                result = json.loads(line)
+                custom_id = get_item(result, "custom_id")
+                status_code = get_item(result, "response.status_code")
+
+                if status_code == 200:
+                    status = {}
+                    results[custom_id] = list(
+                        self._process_complete_response(
+                            json.dumps(get_item(result, "response.body", {})),
+                            ".",
+                            status,
+                        )
+                    )
+                    results[custom_id].extend(self.compile_status(status))
+
+                else:
+                    message = (
+                        get_item(result, "error.message")
+                        or get_item(result, "response.body.error.message")
+                        or f"HTTP {status_code}"
+                    )
+                    results[custom_id] = BatchError(message)
+
+        return results
+
+    def _upload_file(self, file_name: str, content: bytes, purpose: str) -> str:
+        boundary = f"ai-cat-{random.getrandbits(64):016x}"
+        headers = self._build_request_headers()
+        headers["Content-Type"] = "multipart/form-data; boundary=" + boundary
+        body = (
+            (
+                f"--{boundary}\r\n"
+                + 'Content-Disposition: form-data; name="purpose"\r\n\r\n'
+                + f"{purpose}\r\n"
+                + f"--{boundary}\r\n"
+                + f'Content-Disposition: form-data; name="file"; filename="{file_name}"\r\n'
+                + "Content-Type: application/octet-stream\r\n\r\n"
+            ).encode("utf-8")
+            + content
+            + f"\r\n--{boundary}--\r\n".encode("utf-8")
+        )
+        response = json.loads(self.http_request("POST", self.URL_FILES, headers, body))
+
+        return response["id"]
+
+    def _build_request_headers(self):
+        return {
+            "Authorization": "Bearer " + self._api_key,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+
+    def _send_request(
+            self,
+            send: collections.abc.Callable[[typing.Dict[str, str], bytes], typing.Iterator],
+            model: str,
+            conversation: collections.abc.Sequence[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            stream: bool,
+            options: typing.Optional[RequestOptions],
+            status: typing.Dict[str, typing.Any],
+    ) -> typing.Iterator:
+        conversation = list(conversation)
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream,
+            options,
+        )
+        if options is None or options.previous_response_id is None:
+            return send(headers, body)
+
+        # The stored response may have expired or been deleted, in which case
+        # the whole conversation needs to be sent.
+        try:
+            responses = send(headers, body)
+            first_response = next(responses, None)
+
+        except HttpError as http_err:
+            body_lower = str(http_err.body).lower()
+
+            if (
+                    http_err.status not in (400, 404)
+                    or not (
+                        "previous_response" in body_lower
+                        or "previous response" in body_lower
+                    )
+            ):
+                raise
+
+            status["server_state"] = "previous response not found, sent the whole conversation"
+            headers, body = self._build_request(
+                model,
+                conversation,
+                temperature,
+                reasoning,
+                stream,
+                dataclasses.replace(options, previous_response_id=None, previous_message_count=0),
+            )
+
+            return send(headers, body)
+
+        status["server_state"] = (
+            f"sent {len(conversation) - options.previous_message_count}"
+            f" of {len(conversation)} messages"
+        )
+
+        if first_response is None:
+            return responses
+
+        return itertools.chain((first_response, ), responses)
+
+    def _send_predicted_request(
+            self,
+            send: collections.abc.Callable[[typing.Dict[str, str], bytes], typing.Iterator],
+            model: str,
+            conversation: collections.abc.Sequence[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            stream: bool,
+            options: RequestOptions,
+            status: typing.Dict[str, typing.Any],
+    ) -> typing.Optional[typing.Iterator]:
+        """
+        Send the request via the Chat Completions API with the prediction.
+        Return None if the model does not support predicted outputs, so that
+        the request can be sent via the Responses API instead.
+        """
+
+        # https://platform.openai.com/docs/guides/predicted-outputs#limitations
+        if self.get_max_tokens(options) is not None:
+            status["prediction"] = "not supported with max_tokens"
+
+            return None
+
+        headers, body = self._build_chat_completions_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream,
+            options,
+        )
+
+        try:
+            responses = send(headers, body)
+            first_response = next(responses, None)
+
+        except HttpError as http_err:
+            if http_err.status != 400 or "predict" not in str(http_err.body).lower():
+                raise
+
+            status["prediction"] = "not supported by the model"
+
+            return None
+
+        if first_response is None:
+            return responses
+
+        return itertools.chain((first_response, ), responses)
+
+    def _build_chat_completions_request(
+            self,
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream,
+            options,
+    ):
+        conversation = list(conversation)
+        roles = {
+            MessageType.SYSTEM: "developer",
+            MessageType.USER: "user",
+            MessageType.AI: "assistant",
+        }
+        body = {
+            "model": model,
+            "temperature": temperature,
+            "messages": [
+                {
+                    "role": roles.get(message.type, "user"),
+                    "content": message.text,
+                }
+                for message in conversation
+            ],
+            "stream": stream,
+            "prompt_cache_key": self.derive_prompt_cache_key(conversation),
+            "prediction": {"type": "content", "content": options.prediction},
+        }
+
+        if stream:
+            body["stream_options"] = {"include_usage": True}
+
+        if self.is_reasoning_enabled(reasoning):
+            body["reasoning_effort"] = self.get_reasoning_effort(reasoning, options, "medium")
+
+        if options.tier in self.SERVICE_TIERS:
+            body["service_tier"] = self.SERVICE_TIERS[options.tier]
+
+        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+
+    def _process_chat_completion(
+            self,
+            response_bytes: bytes,
+            status: typing.Dict[str, typing.Any],
+    ) -> typing.Iterator[AiResponse]:
+        try:
+            response = json.loads(response_bytes)
+
+        except json.JSONDecodeError:
+            return
+
+        for choice in get_item(response, "choices", []):
+            if get_item(choice, "message.role") != "assistant":
+                continue
+
+            yield AiResponse(
+                is_delta=False,
+                is_reasoning=False,
+                is_status=False,
+                text=get_item(choice, "message.content", ""),
+            )
+
+            status.update(self.extract_status(choice, self.CHAT_COMPLETIONS_STATUS_PATHS))
+
+            break
+
+        status.update(self.extract_status(response, self.CHAT_COMPLETIONS_STATUS_PATHS))
+
+    def _process_chat_completion_chunk(
+            self,
+            data_bytes: bytes,
+            status: typing.Dict[str, typing.Any],
+            has_new_status: bool,
+    ) -> typing.Iterator[AiResponse]:
+        try:
+            data = json.loads(data_bytes)
+
+        except json.JSONDecodeError:
+            return
+
+        for choice in get_item(data, "choices", []):
+            text = get_item(choice, "delta.content")
+
+            if text is not None:
+                yield AiResponse(
+                    is_delta=True,
+                    is_reasoning=False,
+                    is_status=False,
+                    text=text,
+                )
+
+            if has_new_status:
+                status.update(self.extract_status(choice, self.CHAT_COMPLETIONS_STATUS_PATHS))
+
+            break
+
+        if has_new_status:
+            status.update(self.extract_status(data, self.CHAT_COMPLETIONS_STATUS_PATHS))
+
+    def _build_request(self, model, conversation, temperature, reasoning, stream, options=None):
+        conversation = list(conversation)
+        body = {
+            "model": model,
+            "temperature": temperature,
+            "input": self._convert_conversation(conversation),
+            "stream": stream,
+            "prompt_cache_key": self.derive_prompt_cache_key(conversation),
+        }
+
+        if options is not None and options.previous_response_id is not None:
+            body["previous_response_id"] = options.previous_response_id
+            body["input"] = self._convert_conversation(
+                conversation[options.previous_message_count:]
+            )
+
+        if self.is_reasoning_enabled(reasoning):
+            body["reasoning"] = {
+                "effort": self.get_reasoning_effort(reasoning, options, "medium"),
+            }
+
+        max_tokens = self.get_max_tokens(options)
+
+        if max_tokens is not None:
+            body["max_output_tokens"] = max_tokens
+
+        if options is not None and options.tier in self.SERVICE_TIERS:
+            body["service_tier"] = self.SERVICE_TIERS[options.tier]
+
+        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+
+    def _convert_conversation(self, conversation):
+        roles = {
+            MessageType.SYSTEM: "developer",
+            MessageType.USER: "user",
+            MessageType.AI: "assistant",
+        }
+
+        return [
+            {
+                "role": roles.get(message.type, "user"),
+                "content": message.text,
+            }
+            for message in conversation
+        ]
+
+    def _process_complete_response(
+            self,
+            response_bytes: bytes,
+            path: str,
+            status: typing.Dict[str, typing.Any],
+    ) -> typing.Iterator[AiResponse]:
+        try:
+            response = json.loads(response_bytes)
+
+        except json.JSONDecodeError:
+            pass
+
+        else:
+            response = get_item(response, path)
+
+            for output in get_item(response, "output", []):
+                if get_item(output, "type") != "message":
+                    continue
+
+                for content in get_item(output, "content", []):
+                    if get_item(content, "type") != "output_text":
+                        continue
+
+                    text = get_item(content, "text", "")
+
+                    yield AiResponse(
+                        is_delta=False,
+                        is_reasoning=False,
+                        is_status=False,
+                        text=text,
+                    )
+
+            status.update(self.extract_status(response, self.STATUS_PATHS))
+
+
+class ThinkTagScanner:
+    """
+    Split a stream of text into reasoning and response text, where reasoning
+    is whatever is between a leading <think> tag and the first </think> tag.
+    The tags may be split across any number of feed() calls; the incomplete
+    end of a potential tag is held back until the next call decides it.
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    STATE_START = 0
+    STATE_REASONING = 1
+    STATE_TEXT_START = 2
+    STATE_TEXT = 3
+
+    def __init__(self):
+        self._state = self.STATE_START
+        self._pending = ""
+
+    @classmethod
+    def split(cls, text: str) -> tuple[str, str]:
+        scanner = cls()
+        reasoning, response_text = scanner.feed(text)
+        reasoning_end, response_text_end = scanner.finish()
+
+        return reasoning + reasoning_end, response_text + response_text_end
+
+    def feed(self, text: str) -> tuple[str, str]:
+        """
+        Process the next delta, and return the reasoning and the response
+        text that it completes.
+        """
+
+        reasoning = ""
+
+        if self._state == self.STATE_START:
+            text = (self._pending + text).lstrip()
+            self._pending = ""
+
+            if text == "":
+                return "", ""
+
+            if len(text) < len(self.OPEN_TAG) and self.OPEN_TAG.startswith(text):
+                self._pending = text
+
+                return "", ""
+
+            if text.startswith(self.OPEN_TAG):
+                self._state = self.STATE_REASONING
+                text = text[len(self.OPEN_TAG):]
+
+            else:
+                self._state = self.STATE_TEXT
+
+        if self._state == self.STATE_REASONING:
+            text = self._pending + text
+            self._pending = ""
+            close_tag_pos = text.find(self.CLOSE_TAG)
+
+            if close_tag_pos < 0:
+                pending_pos = self._find_partial_tag(text, self.CLOSE_TAG)
+                self._pending = text[pending_pos:]
+
+                return text[:pending_pos], ""
+
+            reasoning = text[:close_tag_pos]
+            text = text[close_tag_pos + len(self.CLOSE_TAG):]
+            self._state = self.STATE_TEXT_START
+
+        if self._state == self.STATE_TEXT_START:
+            text = text.lstrip()
+
+            if text == "":
+                return reasoning, ""
+
+            self._state = self.STATE_TEXT
+
+        return reasoning, text
+
+    def finish(self) -> tuple[str, str]:
+        """
+        Return the held back text at the end of the stream.
+        """
+
+        pending = self._pending
+        self._pending = ""
+
+        if self._state == self.STATE_REASONING:
+            return pending, ""
+
+        return "", pending
+
+    @staticmethod
+    def _find_partial_tag(text: str, tag: str) -> int:
+        # Tags contain "<" only at their beginning, so a suffix of the text
+        # that might be the beginning of the tag must start with the last "<".
+        pos = text.rfind("<", max(0, len(text) - len(tag) + 1))
+
+        if pos >= 0 and tag.startswith(text[pos:]):
+            return pos
+
+        return len(text)
+
+
+class PerplexityClient(AiClient):
+    # https://docs.perplexity.ai/api-reference/chat-completions
+
+    URL_CHAT = "https://api.perplexity.ai/chat/completions"
+
+    STATUS_PATHS = StatusPaths(
+        (
+            "created",
+            "finish_reason",
+            "id",
+            "model",
+            "usage.citation_tokens",
+            "usage.completion_tokens",
+            "usage.num_search_queries",
+            "usage.prompt_tokens",
+            "usage.reasoning_tokens",
+            "usage.search_context_size",
+            "usage.total_tokens",
+        )
+    )
+
+    def list_models(self) -> collections.abc.Sequence[str]:
+        return [
+            "sonar",
+            "sonar-pro",
+            "sonar-reasoning-pro",
+        ]
+
+    def respond(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=False,
+            options=options,
+        )
+        response_bytes = self.http_request("POST", self.URL_CHAT, headers, body)
+
+        try:
+            response = json.loads(response_bytes)
+
+        except json.JSONDecodeError:
+            pass
+
+        else:
+            status = {}
+            content = self._find_content(response, "message", status)
+            status.update(self.extract_status(response, self.STATUS_PATHS))
+            citations = self._format_citations(
+                get_item(response, "citations", []),
+                get_item(response, "search_results", []),
+            )
+            reasoning, text = ThinkTagScanner.split(content or "")
+
+            if reasoning != "":
+                yield AiResponse(
+                    is_delta=False,
+                    is_reasoning=True,
+                    is_status=False,
+                    text=reasoning,
+                )
+
+            # Citations and search results are often referenced in the response
+            # text so we are handling them as an integral part of the text.
+            yield AiResponse(
+                is_delta=False,
+                is_reasoning=False,
+                is_status=False,
+                text=citations + text,
+            )
+
+            yield from self.compile_status(status)
+
+    def respond_streaming(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=True,
+            options=options,
+        )
+
+        scanner = ThinkTagScanner()
+        citations = None
+        status = {}
+
+        for _, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
+            try:
+                data = json.loads(data_bytes)
+
+            except json.JSONDecodeError:
+                continue
+
+            if get_item(data, "object") != "chat.completion":
+                continue
+
+            if citations is None:
+                citations = self._format_citations(
+                    get_item(data, "citations", []),
+                    get_item(data, "search_results", []),
+                )
+
+            content = self._find_content(data, "delta", status)
+            status.update(self.extract_status(data, self.STATUS_PATHS))
+
+            if content is None:
+                continue
+
+            reasoning, text = scanner.feed(content)
+
+            # Citations and search results are emitted right before the first
+            # piece of the response text.
+            if text != "":
+                text, citations = citations + text, ""
+
+            yield from self._generate_deltas(reasoning, text)
+
+        reasoning, text = scanner.finish()
+
+        if text != "":
+            text, citations = (citations or "") + text, ""
+
+        yield from self._generate_deltas(reasoning, text)
+        yield from self.compile_status(status)
+
+    @staticmethod
+    def _generate_deltas(reasoning: str, text: str) -> typing.Iterator[AiResponse]:
+        if reasoning != "":
+            yield AiResponse(
+                is_delta=True,
+                is_reasoning=True,
+                is_status=False,
+                text=reasoning,
+            )
+
+        if text != "":
+            yield AiResponse(
+                is_delta=True,
+                is_reasoning=False,
+                is_status=False,
+                text=text,
+            )
+
+    def _build_request(self, model, conversation, temperature, reasoning, stream, options=None):
+        headers = {
+            "Authorization": "Bearer " + self._api_key,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        body = {
+            "model": model,
+            "temperature": temperature,
+            "messages": self._convert_conversation(conversation),
+            "return_related_questions": False,
+            "stream": stream,
+        }
+
+        max_tokens = self.get_max_tokens(options)
+
+        if max_tokens is not None:
+            body["max_tokens"] = max_tokens
+
+        return headers, json.dumps(body).encode("utf-8")
+
+    def _convert_conversation(self, conversation):
+        roles = {
+            MessageType.SYSTEM: "system",
+            MessageType.USER: "user",
+            MessageType.AI: "assistant",
+        }
+
+        return [
+            {
+                "role": roles.get(message.type, "user"),
+                "content": message.text,
+            }
+            for message in conversation
+        ]
+
+    @staticmethod
+    def _format_citations(citations, search_results):
+        citations_text = ""
+        search_results_text = ""
+
+        if len(citations) > 0:
+            citations_text = (
+                "Citations:\n"
+                + ("\n".join(f"{i + 1}. {url}" for i, url in enumerate(citations)))
+                + "\n\n"
+            )
+
+        if len(search_results) > 0:
+            search_results_text = (
+                "Search results:\n"
+                + (
+                    "\n".join(
+                        f"{i + 1}. {obj['title']} - {obj['url']}"
+                        for i, obj in enumerate(search_results)
+                    )
+                )
+                + "\n\n"
+            )
+
+        return citations_text + search_results_text
+
+    def _find_content(self, response, key, status):
+        content = None
+
+        for choice in get_item(response, "choices", []):
+            if get_item(choice, key + ".role") != "assistant":
+                continue
+
+            content = get_item(choice, key + ".content")
+            status.update(self.extract_status(choice, self.STATUS_PATHS))
+
+            if content is not None:
+                break
+
+        return content
+
+
+class XAiClient(AiClient):
+    # https://docs.x.ai/docs/tutorial
+    # https://docs.x.ai/docs/api-reference#chat-completions
+
+    URL_CHAT = "https://api.x.ai/v1/chat/completions"
+    URL_MODELS = "https://api.x.ai/v1/models"
+
+    STATUS_PATHS = StatusPaths(
+        (
+            "created",
+            "finish_reason",
+            "id",
+            "message.refusal",
+            "model",
+            "system_fingerprint",
+            "usage.completion_tokens",
+            "usage.completion_tokens_details.accepted_prediction_tokens",
+            "usage.completion_tokens_details.audio_tokens",
+            "usage.completion_tokens_details.reasoning_tokens",
+            "usage.completion_tokens_details.rejected_prediction_tokens",
+            "usage.num_sources_used",
+            "usage.prompt_tokens",
+            "usage.prompt_tokens_details.audio_tokens",
+            "usage.prompt_tokens_details.cached_tokens",
+            "usage.prompt_tokens_details.image_tokens",
+            "usage.prompt_tokens_details.text_tokens",
+            "usage.total_tokens",
+        )
+    )
+
+    def list_models(self) -> collections.abc.Sequence[str]:
+        raw_response = self.http_request(
+            "GET",
+            self.URL_MODELS,
+            headers=self._build_request_headers(),
+        )
+        response = json.loads(raw_response)
+
+        return [
+            model["id"]
+            for model in get_item(response, "data", [])
+            if model["object"] == "model"
+        ]
+
+    def respond(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=False,
+            options=options,
+        )
+        response_bytes = self.http_request("POST", self.URL_CHAT, headers, body)
+        status = {}
+
+        try:
+            response = json.loads(response_bytes)
+
+        except json.JSONDecodeError:
+            pass
+
+        else:
+            for choice in get_item(response, "choices", []):
+                if get_item(choice, "message.role") != "assistant":
+                    continue
+
+                reasoning = get_item(choice, "message.reasoning_content")
+                text = get_item(choice, "message.content", "")
+
+                if reasoning is not None:
+                    yield AiResponse(
+                        is_delta=False,
+                        is_reasoning=True,
+                        is_status=False,
+                        text=reasoning,
+                    )
+
+                yield AiResponse(
+                    is_delta=False,
+                    is_reasoning=False,
+                    is_status=False,
+                    text=text,
+                )
+
+                status.update(self.extract_status(choice, self.STATUS_PATHS))
+
+                break
+
+            status.update(self.extract_status(response, self.STATUS_PATHS))
+
+            yield from self.compile_status(status)
+
+    def respond_streaming(
+            self,
+            model: str,
+            conversation: typing.Iterator[Message],
+            temperature: float,
+            reasoning: Reasoning,
+            options: typing.Optional[RequestOptions]=None,
+    ) -> typing.Iterator[AiResponse]:
+        headers, body = self._build_request(
+            model,
+            conversation,
+            temperature,
+            reasoning,
+            stream=True,
+            options=options,
+        )
+        status = {}
+
+        for _, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
+            if not self.is_json_event(data_bytes):
+                continue
+
+            has_new_status = self.has_new_status(data_bytes, status)
+
+            try:
+                data = json.loads(data_bytes)
+
+            except json.JSONDecodeError:
+                continue
+
+            if get_item(data, "object") == "chat.completion.chunk":
+                for choice in get_item(data, "choices", []):
+                    reasoning = get_item(choice, "delta.reasoning_content")
+
+                    if reasoning is not None:
+                        yield AiResponse(
+                            is_delta=True,
+                            is_reasoning=True,
+                            is_status=False,
+                            text=reasoning,
+                        )
+
+                    text = get_item(choice, "delta.content")
+
+                    if text is not None:
+                        yield AiResponse(
+                            is_delta=True,
+                            is_reasoning=False,
+                            is_status=False,
+                            text=text,
+                        )
+
+                    if has_new_status:
+                        status.update(self.extract_status(choice, self.STATUS_PATHS))
+
+                    break
+
+                if has_new_status:
+                    status.update(self.extract_status(data, self.STATUS_PATHS))
+
+        yield from self.compile_status(status)
+
+    def _build_request_headers(self):
+        return {
+            "Authorization": "Bearer " + self._api_key,
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+
+    def _build_request(self, model, conversation, temperature, reasoning, stream, options=None):
+        conversation = list(conversation)
+        headers = self._build_request_headers()
+        body = {
+            "model": model,
+            "temperature": temperature,
+            "messages": self._convert_conversation(conversation),
+            "stream": stream,
+        }
+
+        # https://docs.x.ai/docs/guides/prompt-caching
+        headers["x-grok-conv-id"] = self.derive_prompt_cache_key(conversation)
+
+        if stream:
+            body["stream_options"] = {"include_usage": True}
+
+        if self.is_reasoning_enabled(reasoning):
+            # https://docs.x.ai/docs/guides/reasoning
+            # (Only low and high are supported.)
+            reasoning_effort = self.get_reasoning_effort(reasoning, options, "high")
+            body["reasoning_effort"] = "low" if reasoning_effort == "medium" else reasoning_effort
+
+        max_tokens = self.get_max_tokens(options)
+
+        if max_tokens is not None:
+            body["max_completion_tokens"] = max_tokens
+
+        return headers, json.dumps(body).encode("utf-8")
+
+    def _convert_conversation(self, conversation):
+        roles = {
+            MessageType.SYSTEM: "system",
+            MessageType.USER: "user",
+            MessageType.AI: "assistant",
+        }
+
+        return [
+            {
+                "role": roles.get(message.type, "user"),
+                "content": message.text,
+            }
+            for message in conversation
+        ]
+
+
+def load_state():
+    info(f"Loading {STATE_FILE_NAME!r}...")
+
+    try:
+        with open(STATE_FILE_NAME, "r") as f:
+            state = json.load(f)
+
+        api_keys = get_item(state, "api_keys")
+
+        if not isinstance(api_keys, collections.abc.Mapping):
+            raise TypeError(f"api_keys must be a mapping")
+
+        for key, value in api_keys.items():
+            if not (isinstance(key, str) and isinstance(value, str)):
+                raise TypeError(f"Unexpected API key format, expected string for {key!r}")
+
+        supported_providers = set(ENV_VAR_NAMES.keys())
+        configured_providers = set(api_keys.keys())
+        unknown_providers = configured_providers.difference(supported_providers)
+
+        if len(unknown_providers) > 0:
+            raise ValueError(f"Unkown AI providers: {sorted(unknown_providers)}")
+
+    except Exception as exc:
+        error(f"Unable to read API keys from {STATE_FILE_NAME!r}: {type(exc)}: {exc}")
+        error("")
+        error("""\
+Expected format (omit the API keys that you don't use):
+
+{
+  "api_keys": {
+    "anthropic": "Anthropic Claude API key here (https://console.anthropic.com/settings/keys)",
+    "deepseek": "DeepSeek R1 API key here (https://platform.deepseek.com/api_keys)",
+    "google": "Google Gemini API key here (https://aistudio.google.com/apikey)",
+    "openai": "OpenAI ChatGPT API key here (https://platform.openai.com/settings/organization/api-keys)",
+    "perplexity": "Perplexity API key here (https://www.perplexity.ai/account/api/keys)",
+    "xai": "xAI API key here (https://console.x.ai/team/default/api-keys)"
+  }
+}
+""",
+        )
+
+        return None
+
+    models_cache_updated = int(
+        get_item(state, "models_updated", default=-1, expect_type=(int, float))
+    )
+    models = get_item(state, "models", default={}, expect_type=dict)
+
+    if (
+            not all(
+                (
+                    isinstance(provider, str)
+                    and isinstance(provider_models, list)
+                    and len(provider_models) > 0
+                    and all(isinstance(model, str) for model in provider_models)
+                )
+                for provider, provider_models in models.items()
+            )
+    ):
+        models = {}
+
+    if models_cache_updated is None or len(models) == 0:
+        models = None
+        models_cache_updated = None
+
+    settings = get_item(state, "settings", default={}, expect_type=dict)
+    settings = {
+        "model": get_item(settings, "model", default="", expect_type=str),
+        "reasoning": get_item(settings, "reasoning", default=Reasoning.DEFAULT.value, expect_type=str),
+        "max_tokens": get_item(settings, "max_tokens", default=0, expect_type=int),
+        "tier": get_item(settings, "tier", default=Tier.DEFAULT.value, expect_type=str),
+        "streaming": get_item(settings, "streaming", default=Streaming.OFF.value, expect_type=str),
+        "temperature": float(get_item(settings, "temperature", default=1.0, expect_type=(int, float))),
+        "server_state": get_item(settings, "server_state", default=ServerState.OFF.value, expect_type=str),
+        "cache": get_item(settings, "cache", default=CacheMode.OFF.value, expect_type=str),
+        "hedge": get_item(settings, "hedge", default="off", expect_type=str),
+        "hedge_delay": float(get_item(settings, "hedge_delay", default=AiMessenger.DEFAULT_HEDGE_DELAY, expect_type=(int, float))),
+        "fallback": get_item(settings, "fallback", default="off", expect_type=str),
+        "compare": get_item(settings, "compare", default="off", expect_type=str),
+        "map_reduce": get_item(settings, "map_reduce", default="off", expect_type=str),
+        "cascade": get_item(settings, "cascade", default="off", expect_type=str),
+        "cascade_deadline": float(get_item(settings, "cascade_deadline", default=AiMessenger.DEFAULT_CASCADE_DEADLINE, expect_type=(int, float))),
+        "first_token_timeout": float(get_item(settings, "first_token_timeout", default=AiMessenger.DEFAULT_FIRST_TOKEN_TIMEOUT, expect_type=(int, float))),
+        "connect_timeout": float(get_item(settings, "connect_timeout", default=RequestTimeouts.connect, expect_type=(int, float))),
+        "first_byte_timeout": float(get_item(settings, "first_byte_timeout", default=RequestTimeouts.first_byte, expect_type=(int, float))),
+        "idle_timeout": float(get_item(settings, "idle_timeout", default=RequestTimeouts.idle, expect_type=(int, float))),
+        "total_timeout": float(get_item(settings, "total_timeout", default=RequestTimeouts.total, expect_type=(int, float))),
+    }
+
+    editor = get_item(state, "editor")
+    client_states = get_item(state, "clients", default={}, expect_type=dict)
+
+    system_prompt = None
+
+    if os.path.isfile(SYSTEM_PROMPT_FILE_NAME):
+        info(f"Loading the system prompt from {SYSTEM_PROMPT_FILE_NAME!r}...")
+
+        try:
+            with open(SYSTEM_PROMPT_FILE_NAME, "r") as f:
+                system_prompt = f.read().strip()
+
+        except Exception as exc:
+            info(f"Unable to read the system prompt from {SYSTEM_PROMPT_FILE_NAME!r}: {type(exc)}: {exc}")
+
+    if not system_prompt:
+        info(f"No system prompt found in {SYSTEM_PROMPT_FILE_NAME!r}, using a minimalistic one.")
+
+        system_prompt = DEFAULT_SYSTEM_PROMPT
+
+    return (
+        api_keys,
+        models,
+        models_cache_updated,
+        settings,
+        system_prompt,
+        editor,
+        client_states,
+    )
+
+
+def save_state(
+        api_keys_state_file: typing.Dict[str, str],
+        models: typing.Dict[str, typing.List[str]],
+        models_cache_updated: int,
+        settings: typing.Dict[str, typing.Any],
+        editor_state_file: str,
+        client_states: typing.Dict[str, typing.Dict[str, typing.Any]],
+):
+    info(f"Saving state into {STATE_FILE_NAME}...")
+
+    state = {
+        "api_keys": api_keys_state_file,
+        "settings": settings,
+        "editor": editor_state_file,
+        "models_updated": models_cache_updated,
+        "models": models,
+        "clients": client_states,
+    }
+
+    new_state_file = tempfile.NamedTemporaryFile(
+        prefix="_ai-cat-",
+        dir=os.path.dirname(STATE_FILE_NAME),
+        mode="w+",
+        delete=False,
+    )
+
+    with new_state_file:
+        json.dump(state, new_state_file, indent=2)
+
+    os.replace(new_state_file.name, STATE_FILE_NAME)
+
+
+def collect_api_keys(
+        api_keys_state_file: typing.Dict[str, str],
+) -> typing.Dict[str, str]:
+    api_keys = dict(api_keys_state_file)
+
+    for provider, env_var_name in ENV_VAR_NAMES.items():
+        api_key = os.getenv(env_var_name)
+
+        if api_key is not None:
+            info(f"Using {env_var_name} for {provider}.")
+            api_keys[provider] = api_key
+
+    return api_keys
+
+
+def find_editor(editor_state_file) -> str:
+    default_editor = "vi" if not IS_WINDOWS else "notepad.exe"
+
+    if isinstance(editor_state_file, str) and len(editor_state_file) > 0:
+        default_editor = editor_state_file
+
+    return os.getenv("EDITOR", default_editor)
+
+
+def ensure_up_to_date_models(
+        ai_clients: typing.Dict[str, AiClient],
+        models: typing.Optional[typing.Dict[str, typing.List[str]]],
+        models_cache_updated: typing.Optional[float],
+) -> collections.abc.Sequence[str]:
+    now = int(time.time())
+
+    if (
+            models_cache_updated is None
+            or models is None
+            or abs(now - models_cache_updated) > MODELS_CACHE_TTL_SECONDS
+            or set(ai_clients.keys()) != set(models.keys())
+    ):
+        info(f"Querying models...")
+
+        models_cache_updated = now
+        models = {}
+
+        for provider, ai_client in ai_clients.items():
+            info(f" * {provider}...")
+
+            models[provider] = sorted(ai_client.list_models())
+
+    return models, models_cache_updated
+
+
+class StatusStr(str):
+    pass
+
+
+class AiMessenger:
+    DEFAULT_TEMPERATURE = 1.0
+    DEFAULT_HEDGE_DELAY = 2.0
+    DEFAULT_CASCADE_DEADLINE = 10.0
+    DEFAULT_FIRST_TOKEN_TIMEOUT = 0.0
+
+    # Maximum number of automatic continuation requests for a response which
+    # was cut off by the output token limit.
+    MAX_CONTINUATION_ROUNDS = 3
+
+    MIN_MAP_REDUCE_TOKENS = 256
+    MAP_REDUCE_MAX_CONCURRENT_REQUESTS = 8
+
+
+    NOTES_HEADER = """\
+# === Notes ===
+
+ * Notes blocks are ignored and not preserved.
+ * Only the last System block is kept, and it is moved to the beginning
+   of the conversation.
+ * If the System block is missing or empty, then the default system prompt is
+   used.
+ * AI reasonings are not sent back to the models.
+ * The conversation will be continued only if the last block is a User block.
+ * Responses are generated with the last value of each setting.
+
+Available models:
+
+"""
+
+    BLOCK_HEADER_RE = re.compile(r"^# === (.*) ===$", re.IGNORECASE)
+
+    SERVER_STATE_RESPONSE_ID_RE = re.compile(
+        r"^server_state\.response_id: (\S+)$",
+        re.MULTILINE,
+    )
+    SERVER_STATE_CONVERSATION_HASH_RE = re.compile(
+        r"^server_state\.conversation_hash: ([0-9a-f]+)$",
+        re.MULTILINE,
+    )
+
+    INCOMPLETE_STATUS_RE = re.compile(r"^incomplete: True\n?", re.MULTILINE)
+
+    CONTINUE_PROMPT = (
+        "Your previous response was cut off. Continue it exactly where it"
+        " stopped, without repeating anything and without any introduction."
+    )
+
+    MAP_PROMPT = """\
+The input that the instruction below refers to is too long to be processed at
+once, therefore it was split into {COUNT} parts, and you are given part {INDEX}
+only. Carry out the instruction on this part as well as you can; your answer
+will be combined with the answers for the other parts later.
+
+Instruction:
+
+{INSTRUCTION}
+
+=== BEGIN PART {INDEX} OF {COUNT} ===
+{CHUNK}
+=== END PART {INDEX} OF {COUNT} ===
+"""
+
+    REDUCE_PROMPT = """\
+The input that the instruction below refers to was too long to be processed at
+once, therefore it was split into {COUNT} parts, and the instruction was
+carried out on each part separately. Combine the partial answers below into a
+single, coherent answer to the instruction, as if the whole input had been
+processed at once. Do not mention the parts.
+
+Instruction:
+
+{INSTRUCTION}
+
+{ANSWERS}
+"""
+
+    REDUCE_ANSWER_TPL = """\
+=== BEGIN ANSWER FOR PART {INDEX} OF {COUNT} ===
+{ANSWER}
+=== END ANSWER FOR PART {INDEX} OF {COUNT} ===
+"""
+
+    RELEVANT_MESSAGE_TYPES = frozenset(
+        (
+            MessageType.SYSTEM,
+            MessageType.USER,
+            MessageType.AI,
+        )
+    )
+
+    def __init__(
+            self,
+            ai_clients: typing.Dict[str, AiClient],
+            models: collections.abc.Sequence[str],
+            system_prompt: str,
+            response_cache: typing.Optional["ResponseCache"]=None,
+    ):
+        self._ai_clients = ai_clients
+        self._response_cache = response_cache
+        self._provider = ""
+        self._model = ""
+        self._temperature = self.DEFAULT_TEMPERATURE
+        self._reasoning = Reasoning.DEFAULT
+        self._reasoning_budget = 0
+        self._max_tokens = 0
+        self._tier = Tier.DEFAULT
+        self._prediction = None
+        self._streaming = Streaming.OFF
+        self._server_state = ServerState.OFF
+        self._cache = CacheMode.OFF
+        self._hedge_model = ""
+        self._hedge_delay = self.DEFAULT_HEDGE_DELAY
+        self._fallback_models = []
+        self._compare_models = []
+        self._map_reduce_tokens = 0
+        self._cascade_models = []
+        self._cascade_deadline = self.DEFAULT_CASCADE_DEADLINE
+        self._first_token_timeout = self.DEFAULT_FIRST_TOKEN_TIMEOUT
+        self._timeouts = RequestTimeouts()
+
+        self._system_prompt = str(system_prompt)
+        self._messages = []
+        self._models = self._load_models(models)
+        self._sorted_models = list(sorted(self._models))
+
+        self._select_default_model()
+        self.init_conversation()
+
+    def _load_models(self, models):
+        loaded_models = set()
+
+        for model in models:
+            parts = model.split("/", 1)
+
+            assert len(parts) == 2, \
+                f"Invalid model: {model}, must be in provider/model format!"
+
+            provider = parts[0]
+
+            if provider in self._ai_clients:
+                loaded_models.add(model)
+
+        return loaded_models
+
+    def _select_default_model(self):
+        for default_model_re in DEFAULT_MODEL_RE:
+            for model in self._sorted_models:
+                if default_model_re.match(model):
+                    parts = model.split("/", 1)
+                    self._provider = parts[0]
+                    self._model = parts[1]
+
+        if self._model == "" and len(self._sorted_models) > 0:
+            parts = self._sorted_models[0].split("/", 1)
+            self._provider = parts[0]
+            self._model = parts[1]
+
+    @property
+    def messages(self) -> tuple[Message]:
+        return tuple(Message(type=m.type, text=m.text) for m in self._messages)
+
+    def add_ai_status(self, status: typing.Dict[str, typing.Any]):
+        """
+        Append the given status to the AI Status block of the last response.
+        """
+
+        status_text = AiClient.format_status(status)
+
+        if len(self._messages) > 0 and self._messages[-1].type == MessageType.AI_STATUS:
+            self._messages[-1].text += "\n\n" + status_text
+
+        else:
+            self._messages.append(Message(type=MessageType.AI_STATUS, text=status_text))
+
+    def init_conversation(self):
+        self._messages = [
+            Message(type=MessageType.SYSTEM, text=self._system_prompt),
+        ]
+        self._save_settings_in_history()
+        self._messages.append(Message(type=MessageType.USER, text=""))
+
+    def _save_settings_in_history(self):
+        settings_idx = -1
+
+        if (
+                len(self._messages) >= 2
+                and self._messages[-2].type == MessageType.SETTINGS
+                and self._messages[-1].type == MessageType.USER
+                and self._messages[-1].text.strip() == ""
+        ):
+            settings_idx = -2
+
+        elif (
+                len(self._messages) < 1
+                or self._messages[settings_idx].type != MessageType.SETTINGS
+        ):
+            self._messages.append(Message(type=MessageType.SETTINGS, text=""))
+
+        self._messages[settings_idx].text = "".join(
+            setting_info + "\n" for setting_info in self._get_settings_info()
+        )
+
+    def _get_settings_info(self) -> typing.List[str]:
+        # Optional settings are shown only when they differ from their default
+        # value, in order to keep the Settings blocks short.
+
+        settings_info = [
+            self.get_model_info(),
+            self.get_reasoning_info(),
+            self.get_streaming_info(),
+            self.get_temperature_info(),
+        ]
+
+        if self._max_tokens != 0:
+            settings_info.append(self.get_max_tokens_info())
+
+        if self._tier != Tier.DEFAULT:
+            settings_info.append(self.get_tier_info())
+
+        if self._server_state != ServerState.OFF:
+            settings_info.append(self.get_server_state_info())
+
+        if self._cache != CacheMode.OFF:
+            settings_info.append(self.get_cache_info())
+
+        if self._hedge_model != "":
+            settings_info.append(self.get_hedge_info())
+
+        if self._hedge_delay != self.DEFAULT_HEDGE_DELAY:
+            settings_info.append(self.get_hedge_delay_info())
+
+        if len(self._fallback_models) > 0:
+            settings_info.append(self.get_fallback_info())
+
+        if len(self._compare_models) > 0:
+            settings_info.append(self.get_compare_info())
+
+        if self._map_reduce_tokens > 0:
+            settings_info.append(self.get_map_reduce_info())
+
+        if len(self._cascade_models) > 0:
+            settings_info.append(self.get_cascade_info())
+
+        if self._cascade_deadline != self.DEFAULT_CASCADE_DEADLINE:
+            settings_info.append(self.get_cascade_deadline_info())
+
+        if self._first_token_timeout != self.DEFAULT_FIRST_TOKEN_TIMEOUT:
+            settings_info.append(self.get_first_token_timeout_info())
+
+        default_timeouts = RequestTimeouts()
+
+        if self._timeouts.connect != default_timeouts.connect:
+            settings_info.append(self.get_connect_timeout_info())
+
+        if self._timeouts.first_byte != default_timeouts.first_byte:
+            settings_info.append(self.get_first_byte_timeout_info())
+
+        if self._timeouts.idle != default_timeouts.idle:
+            settings_info.append(self.get_idle_timeout_info())
+
+        if self._timeouts.total != default_timeouts.total:
+            settings_info.append(self.get_total_timeout_info())
+
+        return settings_info
+
+    def get_model_info(self) -> str:
+        return f"Model: {self._provider}/{self._model}"
+
+    def get_reasoning_info(self) -> str:
+        return "Reasoning: " + self.get_reasoning()
+
+    def get_streaming_info(self) -> str:
+        return "Streaming: " + self._streaming.value
+
+    def get_temperature_info(self) -> str:
+        return f"Temperature: {self._temperature}"
+
+    def get_max_tokens_info(self) -> str:
+        return f"Max tokens: {self._max_tokens}"
+
+    def get_tier_info(self) -> str:
+        return "Tier: " + self._tier.value
+
+    def get_server_state_info(self) -> str:
+        return "Server state: " + self._server_state.value
+
+    def get_cache_info(self) -> str:
+        return "Cache: " + self._cache.value
+
+    def get_hedge_info(self) -> str:
+        return "Hedge: " + self.get_hedge()
+
+    def get_hedge_delay_info(self) -> str:
+        return f"Hedge delay: {self._hedge_delay}"
+
+    def get_fallback_info(self) -> str:
+        return "Fallback: " + self.get_fallback()
+
+    def get_compare_info(self) -> str:
+        return "Compare: " + self.get_compare()
+
+    def get_map_reduce_info(self) -> str:
+        return "Map reduce: " + self.get_map_reduce()
+
+    def get_cascade_info(self) -> str:
+        return "Cascade: " + self.get_cascade()
+
+    def get_cascade_deadline_info(self) -> str:
+        return f"Cascade deadline: {self._cascade_deadline}"
+
+    def get_first_token_timeout_info(self) -> str:
+        return f"First token timeout: {self._first_token_timeout}"
+
+    def get_connect_timeout_info(self) -> str:
+        return f"Connect timeout: {self._timeouts.connect}"
+
+    def get_first_byte_timeout_info(self) -> str:
+        return f"First byte timeout: {self._timeouts.first_byte}"
+
+    def get_idle_timeout_info(self) -> str:
+        return f"Idle timeout: {self._timeouts.idle}"
+
+    def get_total_timeout_info(self) -> str:
+        return f"Total timeout: {self._timeouts.total}"
+
+    def clear(self):
+        self._system_prompt = DEFAULT_SYSTEM_PROMPT
+        self.init_conversation()
+
+    def filter_models_by_prefix(
+            self,
+            prefix: str,
+    ) -> collections.abc.Sequence[str]:
+        return sorted([m for m in self._models if m.startswith(prefix)])
+
+    def set_model(self, model: str):
+        if model not in self._models:
+            raise ValueError(f"Unsupported model: {model!r}")
+
+        provider, model = model.split("/", 1)
+        self._provider = provider
+        self._model = model
+
+        self._save_settings_in_history()
+
+    def get_model(self) -> str:
+        return f"{self._provider}/{self._model}"
+
+    def set_reasoning(self, reasoning: str):
+        reasoning_lower = reasoning.strip().lower()
+        reasoning_budget = 0
+
+        if reasoning_lower == Reasoning.DEFAULT.value:
+            self._reasoning = Reasoning.DEFAULT
+
+        elif reasoning_lower == Reasoning.OFF.value:
+            self._reasoning = Reasoning.OFF
+
+        elif reasoning_lower == Reasoning.ON.value:
+            self._reasoning = Reasoning.ON
+
+        elif reasoning_lower == Reasoning.LOW.value:
+            self._reasoning = Reasoning.LOW
+
+        elif reasoning_lower == Reasoning.MEDIUM.value:
+            self._reasoning = Reasoning.MEDIUM
+
+        elif reasoning_lower == Reasoning.HIGH.value:
+            self._reasoning = Reasoning.HIGH
+
+        elif reasoning_lower.isdigit() and int(reasoning_lower) > 0:
+            self._reasoning = Reasoning.ON
+            reasoning_budget = int(reasoning_lower)
+
+        else:
+            raise ValueError(
+                f"Reasoning must be either {Reasoning.DEFAULT.value}, {Reasoning.ON.value}, {Reasoning.OFF.value}, {Reasoning.LOW.value}, {Reasoning.MEDIUM.value}, {Reasoning.HIGH.value}, or a positive number of tokens; got {reasoning!r}"
+            )
+
+        self._reasoning_budget = reasoning_budget
+
+        self._save_settings_in_history()
+
+    def get_reasoning(self) -> str:
+        if self._reasoning_budget > 0:
+            return str(self._reasoning_budget)
+
+        return self._reasoning.value
+
+    def set_max_tokens(self, max_tokens: int):
+        if max_tokens < 0:
+            raise ValueError(
+                f"Max tokens must be a non-negative integer (0 for the default of the model), got {max_tokens!r}."
+            )
+
+        self._max_tokens = int(max_tokens)
+
+        self._save_settings_in_history()
+
+    def get_max_tokens(self) -> int:
+        return self._max_tokens
+
+    def set_tier(self, tier: str):
+        tier_lower = tier.lower()
+
+        if tier_lower == Tier.DEFAULT.value:
+            self._tier = Tier.DEFAULT
+
+        elif tier_lower == Tier.STANDARD.value:
+            self._tier = Tier.STANDARD
+
+        elif tier_lower == Tier.PRIORITY.value:
+            self._tier = Tier.PRIORITY
+
+        elif tier_lower == Tier.FLEX.value:
+            self._tier = Tier.FLEX
+
+        else:
+            raise ValueError(
+                f"Tier must be either {Tier.DEFAULT.value}, {Tier.STANDARD.value}, {Tier.PRIORITY.value}, or {Tier.FLEX.value}; got {tier!r}"
+            )
+
+        self._save_settings_in_history()
+
+    def get_tier(self) -> str:
+        return self._tier.value
+
+    def set_prediction(self, prediction: typing.Optional[str]):
+        """
+        Set a text that the next responses are expected to largely repeat, e.g.
+        the original version of a snippet that is being edited. Providers which
+        support predicted outputs can use it for generating the response
+        faster. Unlike settings, it is not saved in the conversation.
+        """
+
+        self._prediction = prediction
+
+    def set_streaming(self, streaming: str):
+        streaming_lower = streaming.lower()
+
+        if streaming_lower == Streaming.ON.value:
+            self._streaming = Streaming.ON
+
+        elif streaming_lower == Streaming.OFF.value:
+            self._streaming = Streaming.OFF
+
+        else:
+            raise ValueError(f"Streaming must be either {Streaming.ON.value} or {Streaming.OFF.value}, got {streaming!r}")
+
+        self._save_settings_in_history()
+
+    def get_streaming(self) -> str:
+        return self._streaming.value
+
+    def set_temperature(self, temperature: float):
+        if temperature < 0.0 or temperature > 2.0 or not math.isfinite(temperature):
+            raise ValueError(
+                f"Temperature must be a number between 0.0 and 2.0, got {temperature!r}."
+            )
+
+        self._temperature = float(temperature)
+
+        self._save_settings_in_history()
+
+    def get_temperature(self) -> float:
+        return self._temperature
+
+    def set_server_state(self, server_state: str):
+        server_state_lower = server_state.lower()
+
+        if server_state_lower == ServerState.ON.value:
+            self._server_state = ServerState.ON
+
+        elif server_state_lower == ServerState.OFF.value:
+            self._server_state = ServerState.OFF
+
+        else:
+            raise ValueError(f"Server state must be either {ServerState.ON.value} or {ServerState.OFF.value}, got {server_state!r}")
+
+        self._save_settings_in_history()
+
+    def get_server_state(self) -> str:
+        return self._server_state.value
+
+    def set_cache(self, cache: str):
+        cache_lower = cache.lower()
+
+        if cache_lower == CacheMode.OFF.value:
+            self._cache = CacheMode.OFF
+
+        elif cache_lower == CacheMode.READ.value:
+            self._cache = CacheMode.READ
+
+        elif cache_lower == CacheMode.WRITE.value:
+            self._cache = CacheMode.WRITE
+
+        elif cache_lower == CacheMode.ON.value:
+            self._cache = CacheMode.ON
+
+        else:
+            raise ValueError(
+                f"Cache must be either {CacheMode.OFF.value}, {CacheMode.READ.value}, {CacheMode.WRITE.value}, or {CacheMode.ON.value}; got {cache!r}"
+            )
+
+        self._save_settings_in_history()
+
+    def get_cache(self) -> str:
+        return self._cache.value
+
+    def set_hedge(self, hedge: str):
+        if hedge.lower() == "off" or hedge == "":
+            self._hedge_model = ""
+
+        elif hedge not in self._models:
+            raise ValueError(f"Hedge must be either off or a supported model, got {hedge!r}")
+
+        else:
+            self._hedge_model = hedge
+
+        self._save_settings_in_history()
+
+    def get_hedge(self) -> str:
+        return self._hedge_model or "off"
+
+    def set_hedge_delay(self, hedge_delay: float):
+        if hedge_delay < 0.0 or not math.isfinite(hedge_delay):
+            raise ValueError(
+                f"Hedge delay must be a non-negative number of seconds, got {hedge_delay!r}."
+            )
+
+        self._hedge_delay = float(hedge_delay)
+
+        self._save_settings_in_history()
+
+    def get_hedge_delay(self) -> float:
+        return self._hedge_delay
+
+    def set_fallback(self, fallback: str):
+        fallback_models = [
+            model
+            for model in re.split(r"[\s,]+", fallback.strip())
+            if model != ""
+        ]
+
+        if fallback_models == ["off"]:
+            fallback_models = []
+
+        for model in fallback_models:
+            if model not in self._models:
+                raise ValueError(f"Fallback must be either off or a list of supported models, got {model!r}")
+
+        self._fallback_models = fallback_models
+
+        self._save_settings_in_history()
+
+    def get_fallback(self) -> str:
+        return ", ".join(self._fallback_models) or "off"
+
+    def set_compare(self, compare: str):
+        compare_models = [
+            model
+            for model in re.split(r"[\s,]+", compare.strip())
+            if model != ""
+        ]
+
+        if compare_models == ["off"]:
+            compare_models = []
+
+        for model in compare_models:
+            if model not in self._models:
+                raise ValueError(f"Compare must be either off or a list of supported models, got {model!r}")
+
+        self._compare_models = compare_models
+
+        self._save_settings_in_history()
+
+    def get_compare(self) -> str:
+        return ", ".join(self._compare_models) or "off"
+
+    def set_map_reduce(self, map_reduce: str):
+        map_reduce_lower = str(map_reduce).strip().lower()
+
+        if map_reduce_lower == "off":
+            self._map_reduce_tokens = 0
+
+        elif map_reduce_lower.isdigit() and int(map_reduce_lower) >= self.MIN_MAP_REDUCE_TOKENS:
+            self._map_reduce_tokens = int(map_reduce_lower)
+
+        else:
+            raise ValueError(
+                f"Map reduce must be either off or a number of tokens per chunk (at least {self.MIN_MAP_REDUCE_TOKENS}), got {map_reduce!r}"
+            )
+
+        self._save_settings_in_history()
+
+    def get_map_reduce(self) -> str:
+        if self._map_reduce_tokens > 0:
+            return str(self._map_reduce_tokens)
+
+        return "off"
+
+    def set_cascade(self, cascade: str):
+        cascade_models = [
+            model
+            for model in re.split(r"[\s,]+", cascade.strip())
+            if model != ""
+        ]
+
+        if cascade_models == ["off"]:
+            cascade_models = []
+
+        for model in cascade_models:
+            if model not in self._models:
+                raise ValueError(f"Cascade must be either off or a list of supported models, got {model!r}")
+
+        self._cascade_models = cascade_models
+
+        self._save_settings_in_history()
+
+    def get_cascade(self) -> str:
+        return ", ".join(self._cascade_models) or "off"
+
+    def get_cascade_models(self) -> typing.List[str]:
+        """
+        Return the models to try in replace mode, with the selected one being
+        the last.
+        """
+
+        selected_model = self.get_model()
+
+        return [
+            model
+            for model in dict.fromkeys(self._cascade_models)
+            if model != selected_model
+        ] + [selected_model]
+
+    def set_cascade_deadline(self, cascade_deadline: float):
+        if cascade_deadline < 0.0 or not math.isfinite(cascade_deadline):
+            raise ValueError(
+                f"Cascade deadline must be a non-negative number of seconds (0 means no limit), got {cascade_deadline!r}."
+            )
+
+        self._cascade_deadline = float(cascade_deadline)
+
+        self._save_settings_in_history()
+
+    def get_cascade_deadline(self) -> float:
+        return self._cascade_deadline
+
+    def set_first_token_timeout(self, first_token_timeout: float):
+        if first_token_timeout < 0.0 or not math.isfinite(first_token_timeout):
+            raise ValueError(
+                f"First token timeout must be a non-negative number of seconds (0 to disable), got {first_token_timeout!r}."
+            )
+
+        self._first_token_timeout = float(first_token_timeout)
+
+        self._save_settings_in_history()
+
+    def get_first_token_timeout(self) -> float:
+        return self._first_token_timeout
+
+    def set_connect_timeout(self, connect_timeout: float):
+        self._timeouts.connect = self._check_timeout("Connect timeout", connect_timeout)
+
+        self._save_settings_in_history()
+
+    def get_connect_timeout(self) -> float:
+        return self._timeouts.connect
+
+    def set_first_byte_timeout(self, first_byte_timeout: float):
+        self._timeouts.first_byte = self._check_timeout("First byte timeout", first_byte_timeout)
+
+        self._save_settings_in_history()
+
+    def get_first_byte_timeout(self) -> float:
+        return self._timeouts.first_byte
+
+    def set_idle_timeout(self, idle_timeout: float):
+        self._timeouts.idle = self._check_timeout("Idle timeout", idle_timeout)
+
+        self._save_settings_in_history()
+
+    def get_idle_timeout(self) -> float:
+        return self._timeouts.idle
+
+    def set_total_timeout(self, total_timeout: float):
+        self._timeouts.total = self._check_timeout("Total timeout", total_timeout)
+
+        self._save_settings_in_history()
+
+    def get_total_timeout(self) -> float:
+        return self._timeouts.total
+
+    @staticmethod
+    def _check_timeout(name: str, timeout: float) -> float:
+        if timeout < 0.0 or not math.isfinite(timeout):
+            raise ValueError(
+                f"{name} must be a non-negative number of seconds (0 to disable), got {timeout!r}."
+            )
+
+        return float(timeout)
+
+    def conversation_to_str(self) -> str:
+        block_types = {
+            MessageType.SYSTEM: "System",
+            MessageType.SETTINGS: "Settings",
+            MessageType.USER: "User",
+            MessageType.AI: "AI",
+            MessageType.AI_REASONING: "AI Reasoning",
+            MessageType.AI_STATUS: "AI Status",
+        }
+
+        notes = self.NOTES_HEADER
+
+        for model in self._sorted_models:
+            notes += " * " + model + "\n"
+
+        blocks = (
+            [notes[:-1]]
+            + [
+                f"# === {block_types[msg.type]} ===\n\n{msg.text}\n"
+                for msg in self._messages
+            ]
+        )
+
+        return "\n\n".join(blocks)
+
+    def ask(
+            self,
+            question: str,
+            edit_func: collections.abc.Callable[[str], str]=(lambda conversation: conversation),
+    ) -> typing.Iterator[str]:
+        conv_text = self.conversation_to_str()
+
+        if (
+                len(self._messages) == 0
+                or self._messages[-1].type != MessageType.USER
+        ):
+            conv_text += "\n# === User ===\n"
+
+        conv_text += "\n" + question + "\n"
+        conv_text = edit_func(conv_text).strip()
+
+        if conv_text:
+            messages = self._parse_text_blocks(conv_text)
+            system_prompt, *subsequent_messages = messages
+            self._system_prompt = system_prompt.text
+
+            yield from self._process_settings_blocks(subsequent_messages)
+
+            has_user_messages = any(
+                self._is_user_message(msg) for msg in subsequent_messages
+            )
+
+            if has_user_messages:
+                self._messages = messages
+
+                if (
+                        len(subsequent_messages) != 0
+                        and self._is_user_message(subsequent_messages[-1])
+                ):
+                    yield from self._fetch_completion()
+            else:
+                self.init_conversation()
+
+    @classmethod
+    def _parse_text_blocks(cls, text: str) -> typing.List[Message]:
+        system_prompt_lines = []
+        messages = []
+
+        message_types = {
+            "settings": MessageType.SETTINGS,
+            "user": MessageType.USER,
+            "ai reasoning": MessageType.AI_REASONING,
+            "ai": MessageType.AI,
+            "ai status": MessageType.AI_STATUS,
+        }
+
+        action = "skip"
+        inside_code = False
+
+        for line in text.splitlines():
+            new_block_type = None
+
+            if inside_code:
+                if line.strip() == "```":
+                    inside_code = False
+
+            elif line.startswith("```"):
+                # We only care about fenced code blocks for avoiding
+                # accidentally detected block headers. Code blocks that are
+                # nested inside various Markdown elements like indented list
+                # items or block quotes are irrelevant in this case.
+                inside_code = True
+
+            else:
+                block_header_match = cls.BLOCK_HEADER_RE.match(line)
+                new_block_type = (
+                    block_header_match[1].lower() if block_header_match else None
+                )
+
+            if new_block_type == "system":
+                system_prompt_lines = []
+                action = "append_system"
+
+            elif new_block_type == "notes":
+                action = "skip"
+
+            elif new_block_type in message_types:
+                action = "append"
+                messages.append(
+                    Message(type=message_types[new_block_type], text="")
+                )
+
+            elif new_block_type is not None:
+                raise ValueError("Unknown block: " + block_header_match[1])
+
+            elif action == "append_system":
+                system_prompt_lines.append(line)
+
+            elif action == "append":
+                messages[-1].text += line + "\n"
+
+            elif action == "skip":
+                pass
+
+        system_prompt = "\n".join(system_prompt_lines).strip()
+
+        if system_prompt == "":
+            system_prompt = DEFAULT_SYSTEM_PROMPT
+
+        return (
+            [Message(type=MessageType.SYSTEM, text=system_prompt)]
+            + [Message(type=m.type, text=m.text.strip()) for m in messages]
+        )
+
+    def _process_settings_blocks(
+            self,
+            messages: collections.abc.Sequence[Message],
+    ) -> typing.Iterator[str]:
+        for msg in messages:
+            if msg.type != MessageType.SETTINGS:
+                continue
+
+            for line in msg.text.splitlines():
+                line = line.strip()
+                parts = line.split(":", 1)
+
+                if len(parts) != 2:
+                    continue
+
+                key, value = parts
+                key_lower = key.strip().lower()
+                value = value.strip()
+
+                if key_lower == "model":
+                    self.set_model(value)
+
+                    yield StatusStr(self.get_model_info() + "\n")
+
+                elif key_lower == "reasoning":
+                    self.set_reasoning(value)
+
+                    yield StatusStr(self.get_reasoning_info() + "\n")
+
+                elif key_lower == "max tokens":
+                    self.set_max_tokens(int(value))
+
+                    yield StatusStr(self.get_max_tokens_info() + "\n")
+
+                elif key_lower == "tier":
+                    self.set_tier(value)
+
+                    yield StatusStr(self.get_tier_info() + "\n")
+
+                elif key_lower == "streaming":
+                    self.set_streaming(value)
+
+                    yield StatusStr(self.get_streaming_info() + "\n")
+
+                elif key_lower == "temperature":
+                    self.set_temperature(float(value))
+
+                    yield StatusStr(self.get_temperature_info() + "\n")
+
+                elif key_lower == "server state":
+                    self.set_server_state(value)
+
+                    yield StatusStr(self.get_server_state_info() + "\n")
+
+                elif key_lower == "cache":
+                    self.set_cache(value)
+
+                    yield StatusStr(self.get_cache_info() + "\n")
+
+                elif key_lower == "hedge":
+                    self.set_hedge(value)
+
+                    yield StatusStr(self.get_hedge_info() + "\n")
+
+                elif key_lower == "hedge delay":
+                    self.set_hedge_delay(float(value))
+
+                    yield StatusStr(self.get_hedge_delay_info() + "\n")
+
+                elif key_lower == "fallback":
+                    self.set_fallback(value)
+
+                    yield StatusStr(self.get_fallback_info() + "\n")
+
+                elif key_lower == "compare":
+                    self.set_compare(value)
+
+                    yield StatusStr(self.get_compare_info() + "\n")
+
+                elif key_lower == "map reduce":
+                    self.set_map_reduce(value)
+
+                    yield StatusStr(self.get_map_reduce_info() + "\n")
+
+                elif key_lower == "cascade":
+                    self.set_cascade(value)
+
+                    yield StatusStr(self.get_cascade_info() + "\n")
+
+                elif key_lower == "cascade deadline":
+                    self.set_cascade_deadline(float(value))
+
+                    yield StatusStr(self.get_cascade_deadline_info() + "\n")
+
+                elif key_lower == "first token timeout":
+                    self.set_first_token_timeout(float(value))
+
+                    yield StatusStr(self.get_first_token_timeout_info() + "\n")
+
+                elif key_lower == "connect timeout":
+                    self.set_connect_timeout(float(value))
+
+                    yield StatusStr(self.get_connect_timeout_info() + "\n")
+
+                elif key_lower == "first byte timeout":
+                    self.set_first_byte_timeout(float(value))
+
+                    yield StatusStr(self.get_first_byte_timeout_info() + "\n")
+
+                elif key_lower == "idle timeout":
+                    self.set_idle_timeout(float(value))
+
+                    yield StatusStr(self.get_idle_timeout_info() + "\n")
+
+                elif key_lower == "total timeout":
+                    self.set_total_timeout(float(value))
+
+                    yield StatusStr(self.get_total_timeout_info() + "\n")
+
+                else:
+                    raise ValueError(f"Unknown setting: {key!r}")
+
+    @staticmethod
+    def _is_user_message(message: Message) -> bool:
+        return message.type == MessageType.USER and message.text.strip() != ""
+
+    def continue_response(self) -> typing.Iterator[str]:
+        """
+        Ask the model to resume the last AI response from where it stopped
+        (e.g. due to a timeout or a network error), and append the new part to
+        that response.
+        """
+
+        ai_message_idx = self._find_last_ai_response()
+
+        if ai_message_idx is None:
+            raise ValueError("There is no AI response to continue.")
+
+        yield from self._fetch_completion(continue_from=ai_message_idx, continuation_round=1)
+
+    def _find_last_ai_response(self) -> typing.Optional[int]:
+        for i in range(len(self._messages) - 1, -1, -1):
+            if self._messages[i].type == MessageType.AI:
+                return i
+
+            if self._messages[i].type != MessageType.AI_STATUS:
+                return None
+
+        return None
+
+    def load_conversation(self, conv_text: str) -> bool:
+        """
+        Load the conversation and apply its settings without sending it, and
+        tell whether it ends with a question that is waiting for a response.
+        """
+
+        messages = self._parse_text_blocks(conv_text.strip())
+        system_prompt, *subsequent_messages = messages
+        self._system_prompt = system_prompt.text
+
+        for _ in self._process_settings_blocks(subsequent_messages):
+            pass
+
+        if (
+                len(subsequent_messages) == 0
+                or not self._is_user_message(subsequent_messages[-1])
+        ):
+            return False
+
+        self._messages = messages
+
+        return True
+
+    def prepare_batch_request(
+            self,
+            conv_text: str,
+            custom_id: str,
+    ) -> typing.Optional[BatchRequest]:
+        """
+        Load the conversation, and if it ends with a question, then return a
+        request for it that can be submitted to the batch API of the provider.
+        """
+
+        if not self.load_conversation(conv_text):
+            return None
+
+        self._check_output_budget()
+
+        return BatchRequest(
+            custom_id=custom_id,
+            model=self._model,
+            conversation=[
+                msg
+                for msg in self._messages
+                if msg.type in self.RELEVANT_MESSAGE_TYPES
+            ],
+            temperature=self._temperature,
+            reasoning=self._reasoning,
+            options=self._create_request_options(),
+        )
+
+    def complete_batch_request(
+            self,
+            responses: collections.abc.Sequence[AiResponse],
+    ) -> typing.Iterator[str]:
+        """
+        Add the response that the batch API returned for the request which was
+        created by prepare_batch_request() to the conversation.
+        """
+
+        yield from self._fetch_completion(prefetched_responses=responses)
+
+    def _fetch_completion(
+            self,
+            continue_from: typing.Optional[int]=None,
+            continuation_round: int=0,
+            prefetched_responses: typing.Optional[collections.abc.Iterable[AiResponse]]=None,
+            prefetched_conversation: typing.Optional[collections.abc.Sequence[Message]]=None,
+    ) -> typing.Iterator[str]:
+        """
+        Request a response for the conversation and add it to the messages.
+        Prefetched responses may be passed along with the conversation that
+        they were requested for, in case it differs from the messages (e.g.
+        when the responses of other models have been added since then).
+        """
+
+        if (
+                continue_from is None
+                and prefetched_responses is None
+                and len(self._compare_models) > 0
+        ):
+            yield from self._fetch_comparison()
+
+            return
+
+        self._check_output_budget()
+
+        yield StatusStr(f"Waiting for {self._provider}...")
+
+        start_time = time.monotonic()
+
+        reasoning = ""
+        complete_reasoning = None
+        reasoning_header_emitted = False
+        had_reasoning_deltas = False
+
+        response_text = ""
+        complete_response_text = None
+        text_header_emitted = False
+        had_text_deltas = False
+
+        if prefetched_conversation is not None:
+            conversation = list(prefetched_conversation)
+
+        else:
+            conversation = [
+                msg
+                for msg in self._messages
+                if msg.type in self.RELEVANT_MESSAGE_TYPES
+            ]
+
+        is_prefilled = False
+
+        if continue_from is not None:
+            if self._can_prefill(conversation[-1]):
+                # The model will carry on writing the response as if it had
+                # not been interrupted.
+                is_prefilled = True
+                conversation[-1] = Message(
+                    type=MessageType.AI,
+                    text=conversation[-1].text.rstrip(),
+                )
+
+            else:
+                conversation.append(
+                    Message(type=MessageType.USER, text=self.CONTINUE_PROMPT)
+                )
+
+        map_reduce_input = None
+
+        if continue_from is None and prefetched_responses is None:
+            map_reduce_input = self._split_map_reduce_input(conversation)
+
+        # The provider would store the continuation as a separate turn, but
+        # here it is stitched into the previous response. (Map-reduce sends
+        # different conversations.)
+        use_server_state = (
+            continue_from is None
+            and prefetched_responses is None
+            and map_reduce_input is None
+            and self._server_state == ServerState.ON
+            and self._ai_clients[self._provider].SUPPORTS_SERVER_STATE
+            and not self._is_prediction_used()
+        )
+        options = self._create_request_options()
+
+        # A continuation starts somewhere in the middle of the prediction.
+        if continue_from is None and self._is_prediction_used():
+            options.prediction = self._prediction
+
+        if use_server_state:
+            options.previous_response_id, options.previous_message_count = (
+                self._find_server_state()
+            )
+
+        cache_key = None
+        cached_response = None
+
+        if self._response_cache is not None and self._cache != CacheMode.OFF:
+            cache_key = ResponseCache.make_key(
+                self._provider,
+                self._model,
+                self._temperature,
+                self.get_reasoning(),
+                conversation,
+                self._max_tokens,
+            )
+
+            if self._cache in (CacheMode.READ, CacheMode.ON) and prefetched_responses is None:
+                cached_response = self._response_cache.get(cache_key)
+
+        if prefetched_responses is not None:
+            texts = (response for response in prefetched_responses)
+
+        elif cached_response is not None:
+            texts = ResponseCache.replay(cached_response, cache_key)
+
+        elif map_reduce_input is not None:
+            texts = self._respond_map_reduced(conversation, options, *map_reduce_input)
+
+        elif len(self._fallback_models) > 0:
+            texts = self._respond_with_fallback(conversation, options)
+
+        elif self._hedge_model != "":
+            texts = self._respond_hedged(conversation, options)
+
+        else:
+            texts = self._respond_in_thread(
+                (self._provider, self._model, options),
+                conversation,
+                0.0,
+            )
+
+        status = []
+        response_id = None
+        answered_by = self.get_model()
+        is_incomplete = False
+        is_truncated = False
+
+        try:
+            for response in texts:
+                if response.is_status:
+                    status.append(response.text.strip())
+
+                    if response.status is not None:
+                        is_truncated = is_truncated or AiClient.is_length_stop(response.status)
+                        response_id = response.status.get("id", response_id)
+                        answered_by = response.status.get("hedge.winner", answered_by)
+                        answered_by = response.status.get("fallback.answered_by", answered_by)
+                        answered_by = response.status.get("compare.model", answered_by)
+
+                    continue
+
+                if response.is_reasoning:
+                    if response.is_delta:
+                        reasoning += response.text
+                        had_reasoning_deltas = True
+
+                        if not reasoning_header_emitted:
+                            reasoning_header_emitted = True
+                            text_header_emitted = False
+
+                            yield "\n\n# === AI Reasoning ===\n\n"
+
+                        yield response.text
+                    else:
+                        complete_reasoning = response.text
+
+                elif response.is_delta:
+                    if not text_header_emitted:
+                        reasoning_header_emitted = False
+                        text_header_emitted = True
+
+                        yield "\n\n# === AI ===\n\n"
+
+                    response_text += response.text
+                    had_text_deltas = True
+
+                    yield response.text
+
+                else:
+                    complete_response_text = response.text
+
+        except (
+                ConnectionError,
+                TimeoutError,
+                http.client.HTTPException,
+                HttpError,
+                RequestCancelledError,
+                KeyboardInterrupt,
+        ) as exc:
+            # What has been received so far is already paid for, and it can
+            # be continued later. Other errors are bugs which must not be
+            # hidden behind a seemingly incomplete response.
+            if not (had_reasoning_deltas or had_text_deltas):
+                raise
+
+            is_incomplete = True
+
+            if isinstance(exc, KeyboardInterrupt):
+                stop_status = {"stop_reason": "interrupted by user"}
+
+            elif isinstance(exc, RequestTimeoutError):
+                stop_status = {"error": str(exc)}
+
+            else:
+                stop_status = {"error": " ".join(f"{type(exc).__name__}: {exc}".split())}
+
+            stop_status["incomplete"] = True
+            status.append(AiClient.format_status(stop_status))
+
+        finally:
+            # Closing the response source cancels the requests which are
+            # still running, so that the providers stop generating.
+            texts.close()
+
+        if complete_reasoning is not None:
+            reasoning = complete_reasoning
+
+        if complete_response_text is not None:
+            response_text = complete_response_text
+
+        reasoning = reasoning.strip()
+        round_seconds = round(time.monotonic() - start_time, 3)
+
+        if is_truncated and not is_incomplete:
+            status.append(
+                AiClient.format_status({"incomplete": True, "round_seconds": round_seconds})
+            )
+
+        if continue_from is not None:
+            status = self._stitch_response(
+                continue_from,
+                reasoning,
+                response_text,
+                is_prefilled,
+                round_seconds,
+            ) + status
+
+        else:
+            if reasoning:
+                self._messages.append(
+                    Message(type=MessageType.AI_REASONING, text=reasoning)
+                )
+
+            self._messages.append(
+                Message(type=MessageType.AI, text=response_text)
+            )
+
+        if answered_by != self.get_model():
+            # The response is not relevant for the server state of the
+            # selected model, and it must not be cached as if the selected
+            # model had answered.
+            answered_provider, answered_model = answered_by.split("/", 1)
+            use_server_state = use_server_state and answered_provider == self._provider
+
+            if cache_key is not None:
+                cache_key = ResponseCache.make_key(
+                    answered_provider,
+                    answered_model,
+                    self._temperature,
+                    self.get_reasoning(),
+                    conversation,
+                    self._max_tokens,
+                )
+
+        # A response which was cut off would be replayed without being
+        # continued.
+        if (
+                cached_response is None
+                and not is_incomplete
+                and not is_truncated
+                and cache_key is not None
+                and self._cache in (CacheMode.WRITE, CacheMode.ON)
+                and response_text.strip() != ""
+        ):
+            self._response_cache.put(
+                cache_key,
+                {
+                    "provider": self._provider,
+                    "model": self._model,
+                    "reasoning": reasoning,
+                    "text": response_text,
+                    "status": "\n\n".join(status).strip(),
+                },
+            )
+
+        if use_server_state and response_id and not is_incomplete:
+            status.append(
+                self._format_server_state(
+                    response_id,
+                    conversation + [self._messages[-1]],
+                )
+            )
+
+        if (not had_reasoning_deltas) and reasoning:
+            if not reasoning_header_emitted:
+                reasoning_header_emitted = True
+                text_header_emitted = False
+
+                yield "\n\n# === AI Reasoning ===\n\n"
+
+            yield reasoning
+
+        if (not had_text_deltas) and response_text:
+            if not text_header_emitted:
+                reasoning_header_emitted = False
+                text_header_emitted = True
+
+                yield "\n\n# === AI ===\n\n"
+
+            yield response_text
+
+        yield "\n"
+
+        if len(status) > 0:
+            status_text = "\n\n".join(status).strip()
+
+            self._messages.append(
+                Message(type=MessageType.AI_STATUS, text=status_text)
+            )
+
+            yield "\n# === AI Status ===\n\n" + status_text + "\n"
+
+        # Continuations are requested from the selected model, so they would
+        # not fit the response of another one. An explicitly set Max tokens
+        # is meant to be a limit. Prefetched responses (e.g. batch results)
+        # are written back as they are, marked incomplete, since a live
+        # request could fail and lose the answer which is already paid for.
+        if (
+                is_truncated
+                and not is_incomplete
+                and prefetched_responses is None
+                and continuation_round < self.MAX_CONTINUATION_ROUNDS
+                and self._max_tokens == 0
+                and answered_by == self.get_model()
+                and (reasoning or response_text)
+        ):
+            yield from self._fetch_completion(
+                continue_from=self._find_last_ai_response(),
+                continuation_round=continuation_round + 1,
+            )
+
+    def _create_request_options(self) -> RequestOptions:
+        return RequestOptions(
+            max_tokens=self._max_tokens,
+            reasoning_budget=self._reasoning_budget,
+            tier=self._tier,
+        )
+
+    def _is_prediction_used(self) -> bool:
+        # Predicted responses may come from an API which does not store them
+        # on the provider's side.
+        return (
+            self._prediction is not None
+            and self._ai_clients[self._provider].SUPPORTS_PREDICTION
+        )
+
+    def _check_output_budget(self):
+        output_token_limit = self._ai_clients[self._provider].get_output_token_limit(self._model)
+
+        if output_token_limit is not None and self._max_tokens > output_token_limit:
+            raise ValueError(
+                f"Max tokens must not exceed {output_token_limit} for {self.get_model()}, got {self._max_tokens}."
+            )
+
+        if 0 < self._max_tokens <= self._reasoning_budget:
+            raise ValueError(
+                f"The reasoning budget must be less than Max tokens ({self._max_tokens}), got {self._reasoning_budget}."
+            )
+
+        min_reasoning_budget = self._ai_clients[self._provider].MIN_REASONING_BUDGET
+
+        if (
+                AiClient.is_reasoning_enabled(self._reasoning)
+                and 0 < self._max_tokens <= min_reasoning_budget
+        ):
+            raise ValueError(
+                f"Max tokens must be greater than {min_reasoning_budget} when reasoning is enabled for {self.get_model()}, got {self._max_tokens}."
+            )
+
+    def _can_prefill(self, last_message: Message) -> bool:
+        # Models of other providers might be involved in the response when
+        # hedging or falling back.
+        return (
+            last_message.type == MessageType.AI
+            and last_message.text.strip() != ""
+            and len(self._fallback_models) == 0
+            and self._hedge_model == ""
+            and self._ai_clients[self._provider].supports_prefill(self._reasoning)
+        )
+
+    def _stitch_response(
+            self,
+            ai_message_idx: int,
+            reasoning: str,
+            response_text: str,
+            is_prefilled: bool,
+            round_seconds: float,
+    ) -> typing.List[str]:
+        """
+        Append the continuation to the AI response at the given index, and
+        return the status of the previous parts with the incomplete marker
+        removed.
+        """
+
+        ai_message = self._messages[ai_message_idx]
+        ai_text = ai_message.text.rstrip() if is_prefilled else ai_message.text
+        messages = self._messages[:ai_message_idx]
+        status = [
+            self.INCOMPLETE_STATUS_RE.sub("", msg.text)
+            for msg in self._messages[ai_message_idx + 1:]
+        ]
+
+        if reasoning:
+            if len(messages) > 0 and messages[-1].type == MessageType.AI_REASONING:
+                reasoning = messages.pop().text + "\n\n" + reasoning
+
+            messages.append(Message(type=MessageType.AI_REASONING, text=reasoning))
+
+        messages.append(
+            Message(type=MessageType.AI, text=ai_text + response_text)
+        )
+        self._messages = messages
+
+        return status + [
+            AiClient.format_status({"continued": True, "round_seconds": round_seconds})
+        ]
+
+    def _respond(
+            self,
+            provider: str,
+            model: str,
+            conversation: collections.abc.Sequence[Message],
+            options: RequestOptions,
+    ) -> typing.Iterator[AiResponse]:
+        ai_client = self._ai_clients[provider]
+
+        if self._streaming == Streaming.ON:
+            return ai_client.respond_streaming(
+                model,
+                conversation,
+                self._temperature,
+                self._reasoning,
+                options,
+            )
+
+        return ai_client.respond(
+            model,
+            conversation,
+            self._temperature,
+            self._reasoning,
+            options,
+        )
+
+    def _respond_with_fallback(
+            self,
+            conversation: collections.abc.Sequence[Message],
+            options: RequestOptions,
+    ) -> typing.Iterator[AiResponse]:
+        """
+        Try the selected model and then the fallback models in order, and
+        move on to the next one when a model fails with a retryable error, or
+        when it doesn't produce any output within the first token timeout,
+        as long as it hasn't produced any output yet.
+        """
+
+        candidates = [(self._provider, self._model, options)]
+        candidates.extend(
+            (*model.split("/", 1), self._create_request_options())
+            for model in self._fallback_models
+        )
+        skipped = []
+
+        for idx, candidate in enumerate(candidates):
+            provider, model, _ = candidate
+            is_last = idx == len(candidates) - 1
+
+            if idx == 0 and self._hedge_model != "":
+                attempt = self._respond_hedged(conversation, options)
+
+            else:
+                attempt = self._respond_in_thread(
+                    candidate,
+                    conversation,
+                    0.0 if is_last else self._first_token_timeout,
+                )
+
+            answered_by = f"{provider}/{model}"
+            has_output = False
+            buffered_responses = []
+
+            try:
+                for response in attempt:
+                    # The hedge model may answer instead of the selected one.
+                    if response.is_status and response.status is not None:
+                        answered_by = response.status.get("hedge.winner", answered_by)
+
+                    if not has_output:
+                        if response.is_status:
+                            buffered_responses.append(response)
+
+                            continue
+
+                        has_output = True
+
+                        yield from buffered_responses
+
+                    yield response
+
+            except Exception as exc:
+                if has_output or is_last or not is_retryable_error(exc):
+                    raise
+
+                skipped.append(f"{provider}/{model} ({type(exc).__name__}: {exc})")
+
+                continue
+
+            if not has_output:
+                yield from buffered_responses
+
+            break
+
+        status = {"fallback.answered_by": answered_by}
+
+        if len(skipped) > 0:
+            status["fallback.skipped"] = "; ".join(skipped)
+
+        yield from AiClient.compile_status(status)
+
+    def _respond_in_thread(
+            self,
+            candidate: tuple[str, str, RequestOptions],
+            conversation: collections.abc.Sequence[Message],
+            first_token_timeout: float,
+    ) -> typing.Iterator[AiResponse]:
+        responses = queue.Queue()
+        context = self._start_request(0, candidate, conversation, responses)
+        deadline = None
+
+        if first_token_timeout > 0.0:
+            deadline = time.monotonic() + first_token_timeout
+
+        try:
+            while True:
+                timeout = None
+
+                if deadline is not None:
+                    timeout = max(0.0, deadline - time.monotonic())
+
+                try:
+                    _, response, exc = responses.get(timeout=timeout)
+
+                except queue.Empty:
+                    raise RequestTimeoutError("first token", first_token_timeout)
+
+                if exc is not None:
+                    raise exc
+
+                if response is None:
+                    break
+
+                if not response.is_status:
+                    deadline = None
+
+                yield response
+
+        finally:
+            context.cancel()
+
+        yield from AiClient.compile_status(context.get_status())
+
+    def _respond_hedged(
+            self,
+            conversation: collections.abc.Sequence[Message],
+            options: RequestOptions,
+    ) -> typing.Iterator[AiResponse]:
+        """
+        Send the request to the selected model, and if it doesn't produce
+        any output within the hedge delay (or it fails), then send it to the
+        hedge model as well. The first one to produce output wins, and the
+        other one is cancelled.
+        """
+
+        hedge_provider, hedge_model = self._hedge_model.split("/", 1)
+        candidates = [
+            (self._provider, self._model, options),
+            (hedge_provider, hedge_model, self._create_request_options()),
+        ]
+        responses = queue.Queue()
+        contexts = []
+        buffered_responses = [[] for _ in candidates]
+        errors = {}
+        winner = None
+        start_time = time.monotonic()
+        first_output_time = None
+
+        contexts.append(self._start_request(0, candidates[0], conversation, responses))
+
+        try:
+            while True:
+                timeout = None
+
+                if len(contexts) < len(candidates):
+                    timeout = max(0.0, start_time + self._hedge_delay - time.monotonic())
+
+                try:
+                    idx, response, exc = responses.get(timeout=timeout)
+
+                except queue.Empty:
+                    contexts.append(
+                        self._start_request(1, candidates[1], conversation, responses)
+                    )
+
+                    continue
+
+                if winner is not None and idx != winner:
+                    continue
+
+                if exc is not None:
+                    if winner is not None:
+                        raise exc
+
+                    errors[idx] = exc
+
+                    if len(contexts) < len(candidates):
+                        contexts.append(
+                            self._start_request(1, candidates[1], conversation, responses)
+                        )
+
+                    elif len(errors) == len(contexts):
+                        raise errors[0]
+
+                    continue
+
+                if winner is None:
+                    if response is not None and response.is_status:
+                        buffered_responses[idx].append(response)
+
+                        continue
+
+                    winner = idx
+                    first_output_time = time.monotonic()
+
+                    for i, context in enumerate(contexts):
+                        if i != winner:
+                            context.cancel()
+
+                    yield from buffered_responses[winner]
+
+                if response is None:
+                    break
+
+                yield response
+
+        finally:
+            for context in contexts:
+                context.cancel()
+
+        winner_provider, winner_model = candidates[winner][:2]
+
+        yield from AiClient.compile_status(
+            {
+                "hedge.winner": f"{winner_provider}/{winner_model}",
+                "hedge.requests": len(contexts),
+                "hedge.first_output_seconds": round(first_output_time - start_time, 3),
+                **contexts[winner].get_status(),
+            }
+        )
+
+    def _split_map_reduce_input(
+            self,
+            conversation: collections.abc.Sequence[Message],
+    ) -> typing.Optional[tuple[str, typing.List[str]]]:
+        """
+        Split the last User block into the instruction (its first paragraph)
+        and chunks of the rest of it, if map-reduce is on, and the block is
+        too long to be processed at once.
+        """
+
+        if self._map_reduce_tokens == 0 or conversation[-1].type != MessageType.USER:
+            return None
+
+        text = conversation[-1].text.strip()
+
+        if estimate_tokens(text) <= self._map_reduce_tokens:
+            return None
+
+        instruction, _, payload = text.partition("\n\n")
+        chunks = split_into_chunks(payload.strip(), self._map_reduce_tokens)
+
+        if len(chunks) < 2:
+            return None
+
+        return instruction.strip(), chunks
+
+    def _respond_map_reduced(
+            self,
+            conversation: collections.abc.Sequence[Message],
+            options: RequestOptions,
+            instruction: str,
+            chunks: collections.abc.Sequence[str],
+    ) -> typing.Iterator[AiResponse]:
+        """
+        Carry out the instruction on each chunk concurrently (map), then ask
+        the model to combine the partial answers (reduce). Partial answers are
+        cached according to the Cache setting, so that after a failure, only
+        the missing ones are requested again. (Answers which were cut off by
+        the output token limit are not cached.)
+        """
+
+        count = len(chunks)
+        previous_messages = list(conversation[:-1])
+        map_options = dataclasses.replace(options, prediction=None)
+        map_conversations = [
+            previous_messages + [
+                Message(
+                    type=MessageType.USER,
+                    text=self.MAP_PROMPT.format(
+                        INDEX=i + 1,
+                        COUNT=count,
+                        INSTRUCTION=instruction,
+                        CHUNK=chunk,
+                    ),
+                ),
+            ]
+            for i, chunk in enumerate(chunks)
+        ]
+        cache_keys = [
+            ResponseCache.make_key(
+                self._provider,
+                self._model,
+                self._temperature,
+                self.get_reasoning(),
+                map_conversation,
+                self._max_tokens,
+            )
+            for map_conversation in map_conversations
+        ]
+        answers = [None] * count
+        is_truncated = [False] * count
+        start_time = time.monotonic()
+        is_cache_readable = (
+            self._response_cache is not None
+            and self._cache in (CacheMode.READ, CacheMode.ON)
+        )
+        is_cache_writable = (
+            self._response_cache is not None
+            and self._cache in (CacheMode.WRITE, CacheMode.ON)
+        )
+
+        if is_cache_readable:
+            for i, cache_key in enumerate(cache_keys):
+                cached_response = self._response_cache.get(cache_key)
+
+                if cached_response is not None:
+                    answers[i] = get_item(cached_response, "text", default=None, expect_type=str)
+
+        cached_count = sum(1 for answer in answers if answer is not None)
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        responses = queue.Queue()
+        contexts = {}
+        errors = {}
+        running = 0
+
+        try:
+            while len(pending) > 0 or running > 0:
+                while len(pending) > 0 and running < self.MAP_REDUCE_MAX_CONCURRENT_REQUESTS:
+                    i = pending.pop(0)
+                    answers[i] = ""
+                    running += 1
+                    contexts[i] = self._start_request(
+                        i,
+                        (self._provider, self._model, map_options),
+                        map_conversations[i],
+                        responses,
+                    )
+
+                i, response, exc = responses.get()
+
+                if exc is not None:
+                    running -= 1
+                    errors[i] = exc
+
+                elif response is None:
+                    running -= 1
+
+                    if (
+                            is_cache_writable
+                            and not is_truncated[i]
+                            and answers[i].strip() != ""
+                    ):
+                        self._response_cache.put(
+                            cache_keys[i],
+                            {
+                                "provider": self._provider,
+                                "model": self._model,
+                                "reasoning": "",
+                                "text": answers[i],
+                                "status": "",
+                            },
+                        )
+
+                elif response.is_status:
+                    if response.status is not None and AiClient.is_length_stop(response.status):
+                        is_truncated[i] = True
+
+                elif not response.is_reasoning:
+                    if response.is_delta:
+                        answers[i] += response.text
+
+                    else:
+                        answers[i] = response.text
+
+        finally:
+            for context in contexts.values():
+                context.cancel()
+
+        if len(errors) > 0:
+            # The successful parts are already cached, if caching is on.
+            raise errors[min(errors)]
+
+        reduce_conversation = previous_messages + [
+            Message(
+                type=MessageType.USER,
+                text=self.REDUCE_PROMPT.format(
+                    COUNT=count,
+                    INSTRUCTION=instruction,
+                    ANSWERS="\n".join(
+                        self.REDUCE_ANSWER_TPL.format(
+                            INDEX=i + 1,
+                            COUNT=count,
+                            ANSWER=answer.strip(),
+                        )
+                        for i, answer in enumerate(answers)
+                    ),
+                ),
+            ),
+        ]
+
+        yield from AiClient.compile_status(
+            {
+                "map_reduce.chunks": count,
+                "map_reduce.cached_chunks": cached_count,
+                "map_reduce.map_seconds": round(time.monotonic() - start_time, 3),
+            }
+        )
+
+        yield from self._respond_in_thread(
+            (self._provider, self._model, options),
+            reduce_conversation,
+            self._first_token_timeout,
+        )
+
+    def _fetch_comparison(self) -> typing.Iterator[str]:
+        """
+        Send the conversation to the selected model and to the ones that it is
+        compared with at the same time, and add a response from each of them.
+        The output of one model is passed on as it arrives, while the others
+        are buffered until it is finished, so that their streams don't mix.
+        """
+
+        conversation = [
+            msg
+            for msg in self._messages
+            if msg.type in self.RELEVANT_MESSAGE_TYPES
+        ]
+        models = list(dict.fromkeys([self.get_model()] + self._compare_models))
+        queues = [queue.Queue() for _ in models]
+        contexts = []
+
+        try:
+            for model, responses in zip(models, queues):
+                provider, model_name = model.split("/", 1)
+                contexts.append(
+                    self._start_request(
+                        0,
+                        (provider, model_name, self._create_request_options()),
+                        conversation,
+                        responses,
+                    )
+                )
+
+            for model, responses, context in zip(models, queues, contexts):
+                try:
+                    yield from self._fetch_completion(
+                        prefetched_responses=self._receive_compared_responses(
+                            model,
+                            responses,
+                            context,
+                        ),
+                        prefetched_conversation=conversation,
+                    )
+
+                except Exception as exc:
+                    status_text = AiClient.format_status(
+                        {
+                            "compare.model": model,
+                            "error": " ".join(f"{type(exc).__name__}: {exc}".split()),
+                        }
+                    )
+                    self._messages.append(Message(type=MessageType.AI, text=""))
+                    self._messages.append(Message(type=MessageType.AI_STATUS, text=status_text))
+
+                    yield "\n\n# === AI ===\n\n\n# === AI Status ===\n\n" + status_text + "\n"
+
+                # The user has interrupted the comparison.
+                if context.is_cancelled:
+                    break
+
+        finally:
+            for context in contexts:
+                context.cancel()
+
+    @staticmethod
+    def _receive_compared_responses(
+            model: str,
+            responses: queue.Queue,
+            context: RequestContext,
+    ) -> typing.Iterator[AiResponse]:
+        # The label comes first, so that it is kept even if the response
+        # fails midway.
+        yield from AiClient.compile_status({"compare.model": model})
+
+        try:
+            while True:
+                _, response, exc = responses.get()
+
+                if exc is not None:
+                    raise exc
+
+                if response is None:
+                    break
+
+                yield response
+
+        except (GeneratorExit, KeyboardInterrupt):
+            context.cancel()
+
+            raise
+
+        status = {"compare.seconds": round(context.end_time - context.start_time, 3)}
+
+        if context.first_output_time is not None:
+            status["compare.first_output_seconds"] = round(
+                context.first_output_time - context.start_time,
+                3,
+            )
+
+        status.update(context.get_status())
+
+        yield from AiClient.compile_status(status)
+
+    def _start_request(
+            self,
+            idx: int,
+            candidate: tuple[str, str, RequestOptions],
+            conversation: collections.abc.Sequence[Message],
+            responses: queue.Queue,
+    ) -> RequestContext:
+        context = RequestContext()
+        context.timeouts = dataclasses.replace(self._timeouts)
+        thread = threading.Thread(
+            target=self._run_request,
+            args=(idx, candidate, conversation, context, responses),
+            daemon=True,
+        )
+        thread.start()
+
+        return context
+
+    def _run_request(
+            self,
+            idx: int,
+            candidate: tuple[str, str, RequestOptions],
+            conversation: collections.abc.Sequence[Message],
+            context: RequestContext,
+            responses: queue.Queue,
+    ):
+        provider, model, options = candidate
+
+        try:
+            with context:
+                for response in self._respond(provider, model, conversation, options):
+                    if context.is_cancelled:
+                        return
+
+                    if context.first_output_time is None and not response.is_status:
+                        context.first_output_time = time.monotonic()
+
+                    responses.put((idx, response, None))
+
+        except Exception as exc:
+            context.end_time = time.monotonic()
+            responses.put((idx, None, exc))
+
+            return
+
+        context.end_time = time.monotonic()
+        responses.put((idx, None, None))
+
+    def _find_server_state(self) -> tuple[typing.Optional[str], int]:
+        """
+        Find the ID of the last response that is stored on the provider's side,
+        and the number of relevant messages that it covers, unless any of
+        those messages were edited since then.
+        """
+
+        for i in range(len(self._messages) - 1, -1, -1):
+            if self._messages[i].type != MessageType.AI_STATUS:
+                continue
+
+            status_text = self._messages[i].text
+            response_id_match = self.SERVER_STATE_RESPONSE_ID_RE.search(status_text)
+            hash_match = self.SERVER_STATE_CONVERSATION_HASH_RE.search(status_text)
+
+            if response_id_match is None or hash_match is None:
+                break
+
+            stored_conversation = [
+                msg
+                for msg in self._messages[:i]
+                if msg.type in self.RELEVANT_MESSAGE_TYPES
+            ]
+
+            if hash_conversation(stored_conversation) != hash_match[1]:
+                break
+
+            return response_id_match[1], len(stored_conversation)
+
+        return None, 0
+
+    @staticmethod
+    def _format_server_state(
+            response_id: str,
+            conversation: collections.abc.Sequence[Message],
+    ) -> str:
+        return (
+            "```\n"
+            + f"server_state.response_id: {response_id}\n"
+            + f"server_state.conversation_hash: {hash_conversation(conversation)}\n"
+            + "```"
+        )
+
+
+def apply_settings(messenger: AiMessenger, settings: typing.Dict[str, typing.Any]):
+    methods = {
+        "model": (messenger.set_model, messenger.get_model_info),
+        "reasoning": (messenger.set_reasoning, messenger.get_reasoning_info),
+        "max_tokens": (messenger.set_max_tokens, messenger.get_max_tokens_info),
+        "tier": (messenger.set_tier, messenger.get_tier_info),
+        "streaming": (messenger.set_streaming, messenger.get_streaming_info),
+        "temperature": (messenger.set_temperature, messenger.get_temperature_info),
+        "server_state": (messenger.set_server_state, messenger.get_server_state_info),
+        "cache": (messenger.set_cache, messenger.get_cache_info),
+        "hedge": (messenger.set_hedge, messenger.get_hedge_info),
+        "hedge_delay": (messenger.set_hedge_delay, messenger.get_hedge_delay_info),
+        "fallback": (messenger.set_fallback, messenger.get_fallback_info),
+        "compare": (messenger.set_compare, messenger.get_compare_info),
+        "map_reduce": (messenger.set_map_reduce, messenger.get_map_reduce_info),
+        "cascade": (messenger.set_cascade, messenger.get_cascade_info),
+        "cascade_deadline": (messenger.set_cascade_deadline, messenger.get_cascade_deadline_info),
+        "first_token_timeout": (messenger.set_first_token_timeout, messenger.get_first_token_timeout_info),
+        "connect_timeout": (messenger.set_connect_timeout, messenger.get_connect_timeout_info),
+        "first_byte_timeout": (messenger.set_first_byte_timeout, messenger.get_first_byte_timeout_info),
+        "idle_timeout": (messenger.set_idle_timeout, messenger.get_idle_timeout_info),
+        "total_timeout": (messenger.set_total_timeout, messenger.get_total_timeout_info),
+    }
+
+    for key, (setter, info_getter) in methods.items():
+        try:
+            setter(settings[key])
+
+        except ValueError:
+            pass
+
+        info(info_getter())
+
+
+def create_tmp_conv_file(dir: typing.Optional[str]=None, infix: str="") -> str:
+    if infix != "":
+        infix += "-"
+
+    now = datetime.datetime.now()
+    conv_file = tempfile.NamedTemporaryFile(
+        prefix=now.strftime(f"ai-{infix}%Y-%m-%d-%H-%M-%S-"),
+        dir=dir,
+        suffix=".md",
+        mode="w+",
+        delete=False,
+    )
+
+    return conv_file.name
+
+
+def cmd_interactive(
+        messenger: AiMessenger,
+        question_args: typing.List[str],
+        editor: str,
+) -> int:
+    info(f"Using {editor!r} to edit conversations.")
+
+    init_question = " ".join(question_args).strip()
+
+    ai_cmd = AiCmd(editor, messenger)
+
+    if len(init_question) > 0:
+        ai_cmd.do_ask(init_question)
+
+    ai_cmd.cmdloop()
+
+    return 0
+
+
+def cmd_stdio(
+        messenger: AiMessenger,
+        response_only: bool,
+        continue_response: bool=False,
+) -> int:
+    conversation_in = (
+        "\n".join(line.strip("\r\n") for line in sys.stdin.readlines()).strip()
+    )
+    continue_conversation(messenger, conversation_in, continue_response)
+
+    if response_only:
+        ai_response = find_last_ai_response(messenger)
+        print(ai_response.text)
+    else:
+        print(messenger.conversation_to_str())
+
+    return 0
+
+
+def cmd_replace(
+        messenger: AiMessenger,
+        edited_file_name_args: typing.List[str],
+        context_tokens: int=DEFAULT_CONTEXT_TOKENS,
+) -> int:
+    edited_file_name = " ".join(edited_file_name_args).strip()
+
+    if not edited_file_name:
+        edited_file_name = "untitled"
+
+    lines = (
+        "\n".join(line.strip("\r\n") for line in sys.stdin.readlines()).strip()
+    )
+    conversation_in = REPLACE_PROMPT.format(
+        CONTEXT=build_replace_context(edited_file_name, lines, context_tokens),
+        FILE_NAME=edited_file_name,
+        LINES=lines,
+    )
+
+    # Most of the replacement is usually the same as the selection.
+    messenger.set_prediction(REPLACE_PREDICTION.format(LINES=lines))
+
+    replacement = ask_for_replacement_with_cascade(messenger, conversation_in)
+
+    if replacement is None:
+        print(messenger.conversation_to_str())
+
+        return EXIT_CODE_REPLACE_FAIL
+
+    print(replacement)
+
+    return 0
+
+
+def ask_for_replacement_with_cascade(
+        messenger: AiMessenger,
+        conversation_in: str,
+) -> typing.Optional[str]:
+    """
+    Try the models of the cascade one after the other, until one of them
+    produces a replacement, and record each attempt in the AI Status block of
+    the last response. All models but the selected one (which is the last) are
+    subject to the cascade deadline, and their errors are not fatal.
+    """
+
+    models = messenger.get_cascade_models()
+
+    if len(models) == 1:
+        continue_conversation(messenger, conversation_in)
+
+        return find_replacement(find_last_ai_response(messenger))
+
+    selected_model = messenger.get_model()
+    total_timeout = messenger.get_total_timeout()
+    cascade_deadline = messenger.get_cascade_deadline()
+    status = {}
+    replacement = None
+
+    try:
+        for i, model in enumerate(models):
+            is_last = i == len(models) - 1
+            attempt_total_timeout = total_timeout
+
+            if not is_last and cascade_deadline > 0.0:
+                if total_timeout > 0.0:
+                    attempt_total_timeout = min(total_timeout, cascade_deadline)
+
+                else:
+                    attempt_total_timeout = cascade_deadline
+
+            messenger.set_model(model)
+            messenger.set_total_timeout(attempt_total_timeout)
+
+            prefix = f"cascade.{i + 1}."
+            status[prefix + "model"] = model
+            start_time = time.monotonic()
+
+            try:
+                continue_conversation(messenger, conversation_in)
+
+            except Exception as exc:
+                if is_last:
+                    raise
+
+                status[prefix + "seconds"] = round(time.monotonic() - start_time, 3)
+                status[prefix + "result"] = " ".join(f"error: {type(exc).__name__}: {exc}".split())
+
+                continue
+
+            status[prefix + "seconds"] = round(time.monotonic() - start_time, 3)
+            replacement = find_replacement(find_last_ai_response(messenger))
+            status[prefix + "result"] = "replacement" if replacement is not None else "no replacement"
+
+            for message in reversed(messenger.messages):
+                if message.type == MessageType.AI_STATUS:
+                    for match in CASCADE_USAGE_STATUS_RE.finditer(message.text):
+                        status[prefix + match[1]] = match[2]
+
+                    break
+
+                if message.type == MessageType.USER:
+                    break
+
+            if replacement is not None:
+                break
+
+    finally:
+        # The last attempt is made with the original settings, so restoring
+        # them would only add a redundant Settings block after its response.
+        if messenger.get_model() != selected_model:
+            messenger.set_model(selected_model)
+
+        if messenger.get_total_timeout() != total_timeout:
+            messenger.set_total_timeout(total_timeout)
+
+    messenger.add_ai_status(status)
+    info("\n# === AI Status ===\n\n" + AiClient.format_status(status))
+
+    return replacement
+
+
+def find_replacement(ai_response: typing.Optional[Message]) -> typing.Optional[str]:
+    if ai_response is None:
+        return None
+
+    ai_lines = ai_response.text.splitlines()
+    begin_idx = None
+    end_idx = None
+
+    for idx, line in enumerate(ai_lines):
+        line_stripped = line.strip()
+
+        if begin_idx is None and line_stripped == "--- BEGIN REPLACEMENT ---":
+            begin_idx = idx
+
+        elif line_stripped == "--- END REPLACEMENT ---":
+            end_idx = idx
+
+    if begin_idx is None or end_idx is None or begin_idx >= end_idx:
+        return None
+
+    return "\n".join(ai_lines[begin_idx + 1:end_idx])
+
+
+def cmd_index(directory: str) -> int:
+    root_dir = os.path.abspath(directory)
+
+    if not os.path.isdir(root_dir):
+        error(f"Not a directory: {directory!r}")
+
+        return EXIT_CODE_ERROR
+
+    info(f"Indexing {root_dir!r}...")
+
+    with CodeIndex(root_dir) as code_index:
+        added, updated, removed = code_index.update()
+        num_files, num_chunks = code_index.get_size()
+
+    info(
+        f"Added: {added}, updated: {updated}, removed: {removed};"
+        f" indexed files: {num_files}, chunks: {num_chunks}."
+    )
+
+    return 0
 
-    @staticmethod
-    def _extract_response_parts(content, reasoning_started=False, text_started=False):
-        if content is None:
-            return "", "", reasoning_started, text_started
 
-        parts = ["", ""]
-        part_idx = 0 if reasoning_started and not text_started else 1
+def cmd_batch(
+        create_messenger: collections.abc.Callable[[], AiMessenger],
+        ai_clients: typing.Dict[str, AiClient],
+        directory: str,
+        wait: bool=True,
+        poll_seconds: float=DEFAULT_BATCH_POLL_SECONDS,
+) -> int:
+    root_dir = os.path.abspath(directory)
 
-        for line in content.splitlines(keepends=True):
-            line_stripped = line.strip()
+    if not os.path.isdir(root_dir):
+        error(f"Not a directory: {directory!r}")
 
-            if (not (reasoning_started or text_started)) and line_stripped == "":
-                continue
+        return EXIT_CODE_ERROR
 
-            if (not text_started) and line_stripped == "<think>":
-                part_idx = 0
-                reasoning_started = True
+    batch_jobs = BatchJobs(root_dir)
+    exit_code = 0
 
-            parts[part_idx] += line
-            text_started = text_started or (part_idx == 1)
+    if not submit_batch_jobs(create_messenger, ai_clients, root_dir, batch_jobs):
+        exit_code = EXIT_CODE_ERROR
 
-            if (not text_started) and line_stripped == "</think>":
-                part_idx = 1
-                text_started = True
+    poll_seconds = max(0.0, poll_seconds)
 
-        return parts[0], parts[1], reasoning_started, text_started
+    while True:
+        if not collect_batch_results(create_messenger, ai_clients, root_dir, batch_jobs):
+            exit_code = EXIT_CODE_ERROR
 
+        if len(batch_jobs.jobs) == 0:
+            break
 
-class XAiClient(AiClient):
-    # https://docs.x.ai/docs/tutorial
-    # https://docs.x.ai/docs/api-reference#chat-completions
+        if not wait:
+            info(
+                f"{len(batch_jobs.jobs)} batch job(s) are still running;"
+                " run the command again later to collect the results."
+            )
 
-    URL_CHAT = "https://api.x.ai/v1/chat/completions"
-    URL_MODELS = "https://api.x.ai/v1/models"
+            break
 
-    STATUS_PATHS = (
-        "created",
-        "finish_reason",
-        "id",
-        "message.refusal",
-        "model",
-        "system_fingerprint",
-        "usage.completion_tokens",
-        "usage.completion_tokens_details.accepted_prediction_tokens",
-        "usage.completion_tokens_details.audio_tokens",
-        "usage.completion_tokens_details.reasoning_tokens",
-        "usage.completion_tokens_details.rejected_prediction_tokens",
-        "usage.num_sources_used",
-        "usage.prompt_tokens",
-        "usage.prompt_tokens_details.audio_tokens",
-        "usage.prompt_tokens_details.cached_tokens",
-        "usage.prompt_tokens_details.image_tokens",
-        "usage.prompt_tokens_details.text_tokens",
-        "usage.total_tokens",
-    )
+        info(f"Waiting {poll_seconds:.0f}s for {len(batch_jobs.jobs)} batch job(s)...")
+        time.sleep(poll_seconds)
 
-    def list_models(self) -> collections.abc.Sequence[str]:
-        raw_response = self.http_request(
-            "GET",
-            self.URL_MODELS,
-            headers=self._build_request_headers(),
-        )
-        response = json.loads(raw_response)
+        poll_seconds = min(max(1.0, poll_seconds * 2.0), BATCH_MAX_POLL_SECONDS)
 
-        return [
-            model["id"]
-            for model in get_item(response, "data", [])
-            if model["object"] == "model"
-        ]
+    return exit_code
 
-    def respond(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=False,
-        )
-        response_bytes = self.http_request("POST", self.URL_CHAT, headers, body)
-        status = {}
 
-        try:
-            response = json.loads(response_bytes)
+def submit_batch_jobs(
+        create_messenger: collections.abc.Callable[[], AiMessenger],
+        ai_clients: typing.Dict[str, AiClient],
+        root_dir: str,
+        batch_jobs: "BatchJobs",
+) -> bool:
+    """
+    Submit the conversations which are waiting for a response and which are
+    not part of a running batch job, one job per model. Return False if any
+    of them could not be submitted.
+    """
 
-        except json.JSONDecodeError:
-            pass
+    submitted_file_names = batch_jobs.get_file_names()
+    requests_by_model = {}
+    is_success = True
 
-        else:
-            for choice in get_item(response, "choices", []):
-                if get_item(choice, "message.role") != "assistant":
-                    continue
+    for file_name in sorted(os.listdir(root_dir)):
+        path = os.path.join(root_dir, file_name)
 
-                reasoning = get_item(choice, "message.reasoning_content")
-                text = get_item(choice, "message.content", "")
+        if (
+                not file_name.endswith(".md")
+                or file_name in submitted_file_names
+                or not os.path.isfile(path)
+        ):
+            continue
 
-                if reasoning is not None:
-                    yield AiResponse(
-                        is_delta=False,
-                        is_reasoning=True,
-                        is_status=False,
-                        text=reasoning,
-                    )
+        try:
+            conv_text = read_batch_file(path)
+            messenger = create_messenger()
+            request = messenger.prepare_batch_request(
+                conv_text,
+                BatchJobs.make_custom_id(file_name),
+            )
 
-                yield AiResponse(
-                    is_delta=False,
-                    is_reasoning=False,
-                    is_status=False,
-                    text=text,
-                )
+        except (OSError, ValueError) as exc:
+            error(f"Skipping {file_name!r}: {exc}")
+            is_success = False
 
-                status.update(self.extract_status(choice, self.STATUS_PATHS))
+            continue
 
-                break
+        if request is None:
+            continue
 
-            status.update(self.extract_status(response, self.STATUS_PATHS))
+        model = messenger.get_model()
+        provider = model.split("/", 1)[0]
 
-            yield from self.compile_status(status)
+        if provider not in ai_clients or not ai_clients[provider].SUPPORTS_BATCH:
+            error(f"Skipping {file_name!r}: batches are not supported for {provider!r}")
+            is_success = False
 
-    def respond_streaming(
-            self,
-            model: str,
-            conversation: typing.Iterator[Message],
-            temperature: float,
-            reasoning: Reasoning,
-    ) -> typing.Iterator[AiResponse]:
-        headers, body = self._build_request(
-            model,
-            conversation,
-            temperature,
-            reasoning,
-            stream=True,
+            continue
+
+        requests_by_model.setdefault(model, []).append(
+            (file_name, BatchJobs.hash_text(conv_text), request)
         )
-        status = {}
 
-        for _, data_bytes in self.http_sse("POST", self.URL_CHAT, headers, body):
-            try:
-                data = json.loads(data_bytes)
+    for model, requests in requests_by_model.items():
+        provider = model.split("/", 1)[0]
 
-            except json.JSONDecodeError:
-                continue
+        try:
+            batch_id = ai_clients[provider].submit_batch(
+                [request for _, _, request in requests]
+            )
 
-            if get_item(data, "object") == "chat.completion.chunk":
-                for choice in get_item(data, "choices", []):
-                    reasoning = get_item(choice, "delta.reasoning_content")
+        except Exception as exc:
+            error(f"Unable to submit a batch for {model}: {type(exc)}: {exc}")
+            is_success = False
 
-                    if reasoning is not None:
-                        yield AiResponse(
-                            is_delta=True,
-                            is_reasoning=True,
-                            is_status=False,
-                            text=reasoning,
-                        )
+            continue
 
-                    text = get_item(choice, "delta.content")
+        batch_jobs.add(
+            provider,
+            batch_id,
+            {
+                request.custom_id: {"file_name": file_name, "sha256": digest}
+                for file_name, digest, request in requests
+            },
+        )
+        batch_jobs.save()
 
-                    if text is not None:
-                        yield AiResponse(
-                            is_delta=True,
-                            is_reasoning=False,
-                            is_status=False,
-                            text=text,
-                        )
+        info(f"Submitted {len(requests)} conversation(s) to {model}: {batch_id}")
 
-                    status.update(self.extract_status(choice, self.STATUS_PATHS))
+    return is_success
 
-                    break
 
-                status.update(self.extract_status(data, self.STATUS_PATHS))
+def collect_batch_results(
+        create_messenger: collections.abc.Callable[[], AiMessenger],
+        ai_clients: typing.Dict[str, AiClient],
+        root_dir: str,
+        batch_jobs: "BatchJobs",
+) -> bool:
+    """
+    Write the responses of the finished batch jobs into the conversation
+    files. Return False if any of the jobs or requests failed.
+    """
 
-        yield from self.compile_status(status)
+    is_success = True
 
-    def _build_request_headers(self):
-        return {
-            "Authorization": "Bearer " + self._api_key,
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-        }
+    for job in list(batch_jobs.jobs):
+        provider = job["provider"]
+        batch_id = job["batch_id"]
 
-    def _build_request(self, model, conversation, temperature, reasoning, stream):
-        body = {
-            "model": model,
-            "temperature": temperature,
-            "messages": self._convert_conversation(conversation),
-            "stream": stream,
-        }
+        if provider not in ai_clients:
+            error(f"Unable to check batch {batch_id}: no API key for {provider!r}")
+            is_success = False
 
-        if stream:
-            body["stream_options"] = {"include_usage": True}
+            continue
 
-        if reasoning == Reasoning.ON:
-            body["reasoning_effort"] = "high"
+        try:
+            results = ai_clients[provider].fetch_batch_results(batch_id)
 
-        return self._build_request_headers(), json.dumps(body).encode("utf-8")
+        except BatchError as exc:
+            results = {custom_id: exc for custom_id in job["requests"].keys()}
 
-    def _convert_conversation(self, conversation):
-        roles = {
-            MessageType.SYSTEM: "system",
-            MessageType.USER: "user",
-            MessageType.AI: "assistant",
-        }
+        except Exception as exc:
+            error(f"Unable to check batch {batch_id}: {type(exc)}: {exc}")
+            is_success = False
 
-        return [
-            {
-                "role": roles.get(message.type, "user"),
-                "content": message.text,
-            }
-            for message in conversation
-        ]
+            continue
 
+        if results is None:
+            continue
 
-def load_state():
-    info(f"Loading {STATE_FILE_NAME!r}...")
+        for custom_id, request in job["requests"].items():
+            file_name = request["file_name"]
+            result = results.get(custom_id, BatchError("missing from the results"))
 
-    try:
-        with open(STATE_FILE_NAME, "r") as f:
-            state = json.load(f)
+            if isinstance(result, BatchError):
+                error(f"No response for {file_name!r}: {result}")
+                is_success = False
 
-        api_keys = get_item(state, "api_keys")
+                continue
 
-        if not isinstance(api_keys, collections.abc.Mapping):
-            raise TypeError(f"api_keys must be a mapping")
+            try:
+                if not write_batch_result(
+                        create_messenger(),
+                        os.path.join(root_dir, file_name),
+                        custom_id,
+                        request["sha256"],
+                        result,
+                ):
+                    error(f"{file_name!r} has changed since it was submitted, discarding the response.")
+                    is_success = False
 
-        for key, value in api_keys.items():
-            if not (isinstance(key, str) and isinstance(value, str)):
-                raise TypeError(f"Unexpected API key format, expected string for {key!r}")
+            except Exception as exc:
+                error(f"Unable to update {file_name!r}: {type(exc)}: {exc}")
+                is_success = False
 
-        supported_providers = set(ENV_VAR_NAMES.keys())
-        configured_providers = set(api_keys.keys())
-        unknown_providers = configured_providers.difference(supported_providers)
+        # Unanswered conversations will be submitted again by the next run.
+        batch_jobs.remove(job)
+        batch_jobs.save()
 
-        if len(unknown_providers) > 0:
-            raise ValueError(f"Unkown AI providers: {sorted(unknown_providers)}")
+        info(f"Batch {batch_id} finished.")
 
-    except Exception as exc:
-        error(f"Unable to read API keys from {STATE_FILE_NAME!r}: {type(exc)}: {exc}")
-        error("")
-        error("""\
-Expected format (omit the API keys that you don't use):
+    return is_success
 
-{
-  "api_keys": {
-    "anthropic": "Anthropic Claude API key here (https://console.anthropic.com/settings/keys)",
-    "deepseek": "DeepSeek R1 API key here (https://platform.deepseek.com/api_keys)",
-    "google": "Google Gemini API key here (https://aistudio.google.com/apikey)",
-    "openai": "OpenAI ChatGPT API key here (https://platform.openai.com/settings/organization/api-keys)",
-    "perplexity": "Perplexity API key here (https://www.perplexity.ai/account/api/keys)",
-    "xai": "xAI API key here (https://console.x.ai/team/default/api-keys)"
-  }
-}
-""",
-        )
 
-        return None
+def write_batch_result(
+        messenger: AiMessenger,
+        path: str,
+        custom_id: str,
+        expected_sha256: str,
+        responses: collections.abc.Sequence[AiResponse],
+) -> bool:
+    conv_text = read_batch_file(path)
 
-    models_cache_updated = int(
-        get_item(state, "models_updated", default=-1, expect_type=(int, float))
-    )
-    models = get_item(state, "models", default={}, expect_type=dict)
+    if BatchJobs.hash_text(conv_text) != expected_sha256:
+        return False
 
-    if (
-            not all(
-                (
-                    isinstance(provider, str)
-                    and isinstance(provider_models, list)
-                    and len(provider_models) > 0
-                    and all(isinstance(model, str) for model in provider_models)
-                )
-                for provider, provider_models in models.items()
-            )
-    ):
-        models = {}
+    messenger.prepare_batch_request(conv_text, custom_id)
 
-    if models_cache_updated is None or len(models) == 0:
-        models = None
-        models_cache_updated = None
+    for _ in messenger.complete_batch_request(responses):
+        pass
 
-    settings = get_item(state, "settings", default={}, expect_type=dict)
-    settings = {
-        "model": get_item(settings, "model", default="", expect_type=str),
-        "reasoning": get_item(settings, "reasoning", default=Reasoning.DEFAULT.value, expect_type=str),
-        "streaming": get_item(settings, "streaming", default=Streaming.OFF.value, expect_type=str),
-        "temperature": float(get_item(settings, "temperature", default=1.0, expect_type=(int, float))),
-    }
+    write_conversation_file(path, messenger.conversation_to_str())
 
-    editor = get_item(state, "editor")
+    return True
 
-    system_prompt = None
 
-    if os.path.isfile(SYSTEM_PROMPT_FILE_NAME):
-        info(f"Loading the system prompt from {SYSTEM_PROMPT_FILE_NAME!r}...")
+def read_batch_file(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
 
-        try:
-            with open(SYSTEM_PROMPT_FILE_NAME, "r") as f:
-                system_prompt = f.read().strip()
 
-        except Exception as exc:
-            info(f"Unable to read the system prompt from {SYSTEM_PROMPT_FILE_NAME!r}: {type(exc)}: {exc}")
+def write_conversation_file(path: str, conv_text: str):
+    """
+    Replace the contents of the file in a single step, so that an interrupted
+    run never leaves a half-written conversation behind.
+    """
 
-    if not system_prompt:
-        info(f"No system prompt found in {SYSTEM_PROMPT_FILE_NAME!r}, using a minimalistic one.")
+    with tempfile.NamedTemporaryFile(
+            mode="w",
+            encoding="utf-8",
+            dir=os.path.dirname(path),
+            suffix=".tmp",
+            delete=False,
+    ) as f:
+        f.write(conv_text + "\n")
 
-        system_prompt = DEFAULT_SYSTEM_PROMPT
+    os.replace(f.name, path)
 
-    return api_keys, models, models_cache_updated, settings, system_prompt, editor
 
+def cmd_parallel(
+        create_messenger: collections.abc.Callable[[], AiMessenger],
+        directory: str,
+        jobs: int=DEFAULT_PARALLEL_JOBS,
+        provider_jobs: typing.Optional[typing.Dict[str, int]]=None,
+) -> int:
+    root_dir = os.path.abspath(directory)
 
-def save_state(
-        api_keys_state_file: typing.Dict[str, str],
-        models: typing.Dict[str, typing.List[str]],
-        models_cache_updated: int,
-        settings: typing.Dict[str, typing.Any],
-        editor_state_file: str,
-):
-    info(f"Saving state into {STATE_FILE_NAME}...")
+    if not os.path.isdir(root_dir):
+        error(f"Not a directory: {directory!r}")
 
-    state = {
-        "api_keys": api_keys_state_file,
-        "settings": settings,
-        "editor": editor_state_file,
-        "models_updated": models_cache_updated,
-        "models": models,
-    }
+        return EXIT_CODE_ERROR
+
+    jobs = max(1, jobs)
+    provider_jobs = provider_jobs or {}
+    exit_code = 0
 
-    new_state_file = tempfile.NamedTemporaryFile(
-        prefix="_ai-cat-",
-        dir=os.path.dirname(STATE_FILE_NAME),
-        mode="w+",
-        delete=False,
-    )
+    # Conversations which have already been answered (e.g. by a previous,
+    # interrupted run) are skipped.
+    pending_by_provider = {}
+    total = 0
 
-    with new_state_file:
-        json.dump(state, new_state_file, indent=2)
+    for file_name in sorted(os.listdir(root_dir)):
+        path = os.path.join(root_dir, file_name)
 
-    os.replace(new_state_file.name, STATE_FILE_NAME)
+        if not file_name.endswith(".md") or not os.path.isfile(path):
+            continue
 
+        try:
+            conv_text = read_batch_file(path)
+            messenger = create_messenger()
 
-def collect_api_keys(
-        api_keys_state_file: typing.Dict[str, str],
-) -> typing.Dict[str, str]:
-    api_keys = dict(api_keys_state_file)
+            if not messenger.load_conversation(conv_text):
+                continue
 
-    for provider, env_var_name in ENV_VAR_NAMES.items():
-        api_key = os.getenv(env_var_name)
+        except (OSError, ValueError) as exc:
+            error(f"Skipping {file_name!r}: {exc}")
+            exit_code = EXIT_CODE_ERROR
 
-        if api_key is not None:
-            info(f"Using {env_var_name} for {provider}.")
-            api_keys[provider] = api_key
+            continue
 
-    return api_keys
+        provider = messenger.get_model().split("/", 1)[0]
+        pending_by_provider.setdefault(provider, collections.deque()).append(file_name)
+        total += 1
 
+    info(f"Answering {total} conversation(s) with up to {jobs} concurrent request(s)...")
 
-def find_editor(editor_state_file) -> str:
-    default_editor = "vi" if not IS_WINDOWS else "notepad.exe"
+    start_time = time.monotonic()
+    running = {}
+    running_by_provider = {provider: 0 for provider in pending_by_provider.keys()}
+    answered = 0
+    failed = 0
 
-    if isinstance(editor_state_file, str) and len(editor_state_file) > 0:
-        default_editor = editor_state_file
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            # Fill the free slots in a round-robin fashion, so that a provider
+            # with a lot of conversations does not hold up the others.
+            is_submitted = True
 
-    return os.getenv("EDITOR", default_editor)
+            while is_submitted and len(running) < jobs:
+                is_submitted = False
 
+                for provider, pending in pending_by_provider.items():
+                    if len(running) >= jobs:
+                        break
 
-def ensure_up_to_date_models(
-        ai_clients: typing.Dict[str, AiClient],
-        models: typing.Optional[typing.Dict[str, typing.List[str]]],
-        models_cache_updated: typing.Optional[float],
-) -> collections.abc.Sequence[str]:
-    now = int(time.time())
+                    if (
+                            len(pending) == 0
+                            or running_by_provider[provider] >= provider_jobs.get(provider, jobs)
+                    ):
+                        continue
 
-    if (
-            models_cache_updated is None
-            or models is None
-            or abs(now - models_cache_updated) > MODELS_CACHE_TTL_SECONDS
-            or set(ai_clients.keys()) != set(models.keys())
-    ):
-        info(f"Querying models...")
+                    file_name = pending.popleft()
+                    future = executor.submit(
+                        answer_conversation_file,
+                        create_messenger(),
+                        os.path.join(root_dir, file_name),
+                    )
+                    running[future] = (provider, file_name)
+                    running_by_provider[provider] += 1
+                    is_submitted = True
 
-        models_cache_updated = now
-        models = {}
+            if len(running) == 0:
+                break
 
-        for provider, ai_client in ai_clients.items():
-            info(f" * {provider}...")
+            done, _ = concurrent.futures.wait(
+                running.keys(),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
 
-            models[provider] = sorted(ai_client.list_models())
+            for future in done:
+                provider, file_name = running.pop(future)
+                running_by_provider[provider] -= 1
 
-    return models, models_cache_updated
+                try:
+                    seconds = future.result()
 
+                except Exception as exc:
+                    error(f"Unable to answer {file_name!r}: {type(exc)}: {exc}")
+                    failed += 1
+                    exit_code = EXIT_CODE_ERROR
 
-class StatusStr(str):
-    pass
+                    continue
 
+                answered += 1
+                info(f"[{answered + failed}/{total}] {file_name}: {seconds:.1f}s")
 
-class AiMessenger:
-    DEFAULT_TEMPERATURE = 1.0
+    elapsed = time.monotonic() - start_time
+    per_minute = answered * 60.0 / elapsed if elapsed > 0.0 else 0.0
 
+    info(
+        f"Answered: {answered}, failed: {failed}, elapsed: {elapsed:.1f}s,"
+        f" throughput: {per_minute:.1f} conversation(s)/minute."
+    )
 
-    NOTES_HEADER = """\
-# === Notes ===
+    return exit_code
 
- * Notes blocks are ignored and not preserved.
- * Only the last System block is kept, and it is moved to the beginning
-   of the conversation.
- * If the System block is missing or empty, then the default system prompt is
-   used.
- * AI reasonings are not sent back to the models.
- * The conversation will be continued only if the last block is a User block.
- * Responses are generated with the last value of each setting.
 
-Available models:
+def answer_conversation_file(messenger: AiMessenger, path: str) -> float:
+    """
+    Send the conversation in the file, write the response back into it, and
+    return the number of seconds it took.
+    """
 
-"""
+    start_time = time.monotonic()
+    conv_text = read_batch_file(path)
 
-    BLOCK_HEADER_RE = re.compile(r"^# === (.*) ===$", re.IGNORECASE)
+    for _ in messenger.ask("", lambda conversation: conv_text):
+        pass
 
-    RELEVANT_MESSAGE_TYPES = frozenset(
-        (
-            MessageType.SYSTEM,
-            MessageType.USER,
-            MessageType.AI,
-        )
-    )
+    # The file may have been edited while waiting for the response.
+    if read_batch_file(path) != conv_text:
+        raise ValueError("the file has changed since it was read, discarding the response")
 
-    def __init__(
-            self,
-            ai_clients: typing.Dict[str, AiClient],
-            models: collections.abc.Sequence[str],
-            system_prompt: str,
-    ):
-        self._ai_clients = ai_clients
-        self._provider = ""
-        self._model = ""
-        self._temperature = self.DEFAULT_TEMPERATURE
-        self._reasoning = Reasoning.DEFAULT
-        self._streaming = Streaming.OFF
+    write_conversation_file(path, messenger.conversation_to_str())
 
-        self._system_prompt = str(system_prompt)
-        self._messages = []
-        self._models = self._load_models(models)
-        self._sorted_models = list(sorted(self._models))
+    return time.monotonic() - start_time
 
-        self._select_default_model()
-        self.init_conversation()
 
-    def _load_models(self, models):
-        loaded_models = set()
+def build_replace_context(
+        edited_file_name: str,
+        lines: str,
+        context_tokens: int,
+) -> str:
+    if context_tokens <= 0 or lines == "":
+        return ""
 
-        for model in models:
-            parts = model.split("/", 1)
+    start_dirs = [
+        os.path.dirname(os.path.abspath(edited_file_name)),
+        os.getcwd(),
+    ]
+    root_dir = None
 
-            assert len(parts) == 2, \
-                f"Invalid model: {model}, must be in provider/model format!"
+    for start_dir in start_dirs:
+        root_dir = CodeIndex.find_root(start_dir)
 
-            provider = parts[0]
+        if root_dir is not None:
+            break
 
-            if provider in self._ai_clients:
-                loaded_models.add(model)
+    if root_dir is None:
+        return ""
 
-        return loaded_models
+    info(f"Searching {os.path.join(root_dir, INDEX_FILE_NAME)!r}...")
 
-    def _select_default_model(self):
-        for default_model_re in DEFAULT_MODEL_RE:
-            for model in self._sorted_models:
-                if default_model_re.match(model):
-                    parts = model.split("/", 1)
-                    self._provider = parts[0]
-                    self._model = parts[1]
+    try:
+        with CodeIndex(root_dir) as code_index:
+            snippets = code_index.search(lines, CodeIndex.MAX_SEARCH_RESULTS)
 
-        if self._model == "" and len(self._sorted_models) > 0:
-            parts = self._sorted_models[0].split("/", 1)
-            self._provider = parts[0]
-            self._model = parts[1]
+    except sqlite3.Error as exc:
+        info(f"Unable to search the index: {type(exc)}: {exc}")
 
-    @property
-    def messages(self) -> tuple[Message]:
-        return tuple(Message(type=m.type, text=m.text) for m in self._messages)
+        return ""
 
-    def init_conversation(self):
-        self._messages = [
-            Message(type=MessageType.SYSTEM, text=self._system_prompt),
-        ]
-        self._save_settings_in_history()
-        self._messages.append(Message(type=MessageType.USER, text=""))
+    selected = []
+    remaining_tokens = context_tokens
+    min_score = (
+        snippets[0].score * CodeIndex.MIN_RELATIVE_SCORE if len(snippets) > 0 else 0.0
+    )
 
-    def _save_settings_in_history(self):
-        settings_idx = -1
+    for snippet in snippets:
+        text = snippet.text.strip("\n")
 
         if (
-                len(self._messages) >= 2
-                and self._messages[-2].type == MessageType.SETTINGS
-                and self._messages[-1].type == MessageType.USER
-                and self._messages[-1].text.strip() == ""
-        ):
-            settings_idx = -2
-
-        elif (
-                len(self._messages) < 1
-                or self._messages[settings_idx].type != MessageType.SETTINGS
+                snippet.score < min_score
+                or text.strip() in lines
+                or lines in text
+                or any(line.lstrip().startswith("```") for line in text.splitlines())
         ):
-            self._messages.append(Message(type=MessageType.SETTINGS, text=""))
+            continue
 
-        self._messages[settings_idx].text = (
-            self.get_model_info() + "\n"
-            + self.get_reasoning_info() + "\n"
-            + self.get_streaming_info() + "\n"
-            + self.get_temperature_info() + "\n"
+        formatted = REPLACE_CONTEXT_SNIPPET.format(
+            PATH=snippet.path,
+            FIRST_LINE=snippet.first_line,
+            LAST_LINE=snippet.last_line,
+            TEXT=text,
         )
+        tokens = estimate_tokens(formatted)
 
-    def get_model_info(self) -> str:
-        return f"Model: {self._provider}/{self._model}"
+        if tokens > remaining_tokens:
+            continue
 
-    def get_reasoning_info(self) -> str:
-        return "Reasoning: " + self._reasoning.value
+        selected.append(formatted)
+        remaining_tokens -= tokens
 
-    def get_streaming_info(self) -> str:
-        return "Streaming: " + self._streaming.value
+    if len(selected) == 0:
+        return ""
 
-    def get_temperature_info(self) -> str:
-        return f"Temperature: {self._temperature}"
+    info(f"Adding {len(selected)} snippet(s) as context.")
 
-    def clear(self):
-        self._system_prompt = DEFAULT_SYSTEM_PROMPT
-        self.init_conversation()
+    return REPLACE_CONTEXT_PROMPT.format(SNIPPETS="\n\n".join(selected))
 
-    def filter_models_by_prefix(
-            self,
-            prefix: str,
-    ) -> collections.abc.Sequence[str]:
-        return sorted([m for m in self._models if m.startswith(prefix)])
 
-    def set_model(self, model: str):
-        if model not in self._models:
-            raise ValueError(f"Unsupported model: {model!r}")
+def continue_conversation(
+        messenger: AiMessenger,
+        conversation_in: str,
+        continue_response: bool=False,
+):
+    def ask_and_continue():
+        yield from messenger.ask("", lambda conversation: conversation_in)
 
-        provider, model = model.split("/", 1)
-        self._provider = provider
-        self._model = model
+        if continue_response:
+            yield from messenger.continue_response()
 
-        self._save_settings_in_history()
+    generator = ask_and_continue()
 
-    def get_model(self) -> str:
-        return f"{self._provider}/{self._model}"
+    if is_quiet:
+        for _ in generator:
+            pass
 
-    def set_reasoning(self, reasoning: str):
-        reasoning_lower = reasoning.lower()
+        return
 
-        if reasoning_lower == Reasoning.DEFAULT.value:
-            self._reasoning = Reasoning.DEFAULT
+    printer = WrappingPrinter()
+    printer.set_width(WrappingPrinter.get_wrapping_width())
 
-        elif reasoning_lower == Reasoning.OFF.value:
-            self._reasoning = Reasoning.OFF
+    print_response(
+        generator,
+        lambda chunk: printer.print(chunk, end="", file=sys.stderr),
+    )
 
-        elif reasoning_lower == Reasoning.ON.value:
-            self._reasoning = Reasoning.ON
+    printer.print("", file=sys.stderr)
 
-        else:
-            raise ValueError(
-                f"Reasoning must be either {Reasoning.DEFAULT.value}, {Reasoning.ON.value}, or {Reasoning.OFF.value}; got {reasoning!r}"
-            )
 
-        self._save_settings_in_history()
+def print_response(
+        chunks: typing.Generator[str, None, None],
+        print_chunk: collections.abc.Callable[[str], None],
+):
+    """
+    Print the chunks of a response. If Ctrl-C is pressed while a chunk is
+    being printed, then the interruption is passed on to the generator, so
+    that it can stop the request and keep what has been received so far.
+    """
 
-    def get_reasoning(self) -> str:
-        return self._reasoning.value
+    interruption = None
 
-    def set_streaming(self, streaming: str):
-        streaming_lower = streaming.lower()
+    while True:
+        try:
+            if interruption is None:
+                chunk = next(chunks)
+            else:
+                chunk = chunks.throw(interruption)
+                interruption = None
 
-        if streaming_lower == Streaming.ON.value:
-            self._streaming = Streaming.ON
+        except StopIteration:
+            return
 
-        elif streaming_lower == Streaming.OFF.value:
-            self._streaming = Streaming.OFF
+        try:
+            print_chunk(chunk)
 
-        else:
-            raise ValueError(f"Streaming must be either {Streaming.ON.value} or {Streaming.OFF.value}, got {streaming!r}")
+        except KeyboardInterrupt as exc:
+            interruption = exc
 
-        self._save_settings_in_history()
 
-    def get_streaming(self) -> str:
-        return self._streaming.value
+def find_last_ai_response(messenger: AiMessenger) -> typing.Optional[Message]:
+    messages = messenger.messages
 
-    def set_temperature(self, temperature: float):
-        if temperature < 0.0 or temperature > 2.0 or not math.isfinite(temperature):
-            raise ValueError(
-                f"Temperature must be a number between 0.0 and 2.0, got {temperature!r}."
-            )
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i].type == MessageType.AI:
+            return messages[i]
 
-        self._temperature = float(temperature)
+    return None
 
-        self._save_settings_in_history()
 
-    def get_temperature(self) -> float:
-        return self._temperature
+@dataclasses.dataclass
+class CodeSnippet:
+    path: str
+    first_line: int
+    last_line: int
+    text: str
+    score: float
 
-    def conversation_to_str(self) -> str:
-        block_types = {
-            MessageType.SYSTEM: "System",
-            MessageType.SETTINGS: "Settings",
-            MessageType.USER: "User",
-            MessageType.AI: "AI",
-            MessageType.AI_REASONING: "AI Reasoning",
-            MessageType.AI_STATUS: "AI Status",
-        }
 
-        notes = self.NOTES_HEADER
+class CodeIndex:
+    """
+    Incremental BM25 full-text index over the text files of a project tree,
+    stored in an SQLite database in the root directory of the project. Files
+    are re-indexed only when their modification time or size changes. See
+    TestCodeIndex for examples.
+    """
 
-        for model in self._sorted_models:
-            notes += " * " + model + "\n"
+    CHUNK_LINES = 40
+    CHUNK_BREAK_LOOKBACK_LINES = 10
+    MAX_FILE_SIZE = 1024 * 1024
+    MAX_SEARCH_RESULTS = 20
 
-        blocks = (
-            [notes[:-1]]
-            + [
-                f"# === {block_types[msg.type]} ===\n\n{msg.text}\n"
-                for msg in self._messages
-            ]
+    # Snippets which score lower than this fraction of the best match are
+    # considered to be noise (e.g. matching only on common keywords).
+    MIN_RELATIVE_SCORE = 0.2
+
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    IGNORED_DIR_NAMES = frozenset(
+        (
+            ".git",
+            ".hg",
+            ".mypy_cache",
+            ".pytest_cache",
+            ".svn",
+            ".tox",
+            ".venv",
+            "__pycache__",
+            "node_modules",
+            "venv",
         )
+    )
 
-        return "\n\n".join(blocks)
+    TOKEN_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|[0-9]+")
+    SUBTOKEN_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+    SCHEMA = """\
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    first_line INTEGER NOT NULL,
+    last_line INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    chunk_id INTEGER NOT NULL,
+    tf INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+CREATE INDEX IF NOT EXISTS postings_chunk_id ON postings (chunk_id);
+"""
 
-    def ask(
-            self,
-            question: str,
-            edit_func: collections.abc.Callable[[str], str]=(lambda conversation: conversation),
-    ) -> typing.Iterator[str]:
-        conv_text = self.conversation_to_str()
+    @classmethod
+    def find_root(cls, start_dir: str) -> typing.Optional[str]:
+        directory = os.path.abspath(start_dir)
 
-        if (
-                len(self._messages) == 0
-                or self._messages[-1].type != MessageType.USER
-        ):
-            conv_text += "\n# === User ===\n"
+        while True:
+            if os.path.isfile(os.path.join(directory, INDEX_FILE_NAME)):
+                return directory
 
-        conv_text += "\n" + question + "\n"
-        conv_text = edit_func(conv_text).strip()
+            parent = os.path.dirname(directory)
 
-        if conv_text:
-            messages = self._parse_text_blocks(conv_text)
-            system_prompt, *subsequent_messages = messages
-            self._system_prompt = system_prompt.text
+            if parent == directory:
+                return None
 
-            yield from self._process_settings_blocks(subsequent_messages)
+            directory = parent
 
-            has_user_messages = any(
-                self._is_user_message(msg) for msg in subsequent_messages
-            )
+    def __init__(self, root_dir: str):
+        self._root_dir = os.path.abspath(root_dir)
+        self._db = sqlite3.connect(os.path.join(self._root_dir, INDEX_FILE_NAME))
+        self._db.executescript(self.SCHEMA)
 
-            if has_user_messages:
-                self._messages = messages
+    def __enter__(self):
+        return self
 
-                if (
-                        len(subsequent_messages) != 0
-                        and self._is_user_message(subsequent_messages[-1])
-                ):
-                    yield from self._fetch_completion()
-            else:
-                self.init_conversation()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    @classmethod
-    def _parse_text_blocks(cls, text: str) -> typing.List[Message]:
-        system_prompt_lines = []
-        messages = []
+    def close(self):
+        self._db.close()
 
-        message_types = {
-            "settings": MessageType.SETTINGS,
-            "user": MessageType.USER,
-            "ai reasoning": MessageType.AI_REASONING,
-            "ai": MessageType.AI,
-            "ai status": MessageType.AI_STATUS,
-        }
+    def get_size(self) -> tuple[int, int]:
+        num_files = self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        num_chunks = self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
 
-        action = "skip"
-        inside_code = False
+        return num_files, num_chunks
 
-        for line in text.splitlines():
-            new_block_type = None
+    def update(self) -> tuple[int, int, int]:
+        """
+        Bring the index up to date with the project tree, and return the
+        number of added, updated, and removed files.
+        """
 
-            if inside_code:
-                if line.strip() == "```":
-                    inside_code = False
+        indexed = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self._db.execute(
+                "SELECT path, mtime_ns, size FROM files"
+            )
+        }
+        added = 0
+        updated = 0
+        seen = set()
 
-            elif line.startswith("```"):
-                # We only care about fenced code blocks for avoiding
-                # accidentally detected block headers. Code blocks that are
-                # nested inside various Markdown elements like indented list
-                # items or block quotes are irrelevant in this case.
-                inside_code = True
+        with self._db:
+            for path, abs_path, stat in self._walk():
+                seen.add(path)
+                old = indexed.get(path)
 
-            else:
-                block_header_match = cls.BLOCK_HEADER_RE.match(line)
-                new_block_type = (
-                    block_header_match[1].lower() if block_header_match else None
-                )
+                if old == (stat.st_mtime_ns, stat.st_size):
+                    continue
 
-            if new_block_type == "system":
-                system_prompt_lines = []
-                action = "append_system"
+                text = self._read_text(abs_path)
 
-            elif new_block_type == "notes":
-                action = "skip"
+                if text is None:
+                    # A file which became binary or undecodable is removed
+                    # from the index along with the deleted ones.
+                    seen.discard(path)
 
-            elif new_block_type in message_types:
-                action = "append"
-                messages.append(
-                    Message(type=message_types[new_block_type], text="")
-                )
+                    continue
 
-            elif new_block_type is not None:
-                raise ValueError("Unknown block: " + block_header_match[1])
+                if old is None:
+                    added += 1
+                else:
+                    updated += 1
+                    self._remove(path)
 
-            elif action == "append_system":
-                system_prompt_lines.append(line)
+                self._add(path, stat, text)
 
-            elif action == "append":
-                messages[-1].text += line + "\n"
+            removed = [path for path in indexed.keys() if path not in seen]
 
-            elif action == "skip":
-                pass
+            for path in removed:
+                self._remove(path)
 
-        system_prompt = "\n".join(system_prompt_lines).strip()
+        return added, updated, len(removed)
 
-        if system_prompt == "":
-            system_prompt = DEFAULT_SYSTEM_PROMPT
+    def _walk(self) -> typing.Iterator[tuple[str, str, os.stat_result]]:
+        """
+        Yield the files of the project tree, except for hidden ones (which
+        often contain secrets, e.g. .env files), and the ones that are
+        ignored by .gitignore files.
+        """
 
-        return (
-            [Message(type=MessageType.SYSTEM, text=system_prompt)]
-            + [Message(type=m.type, text=m.text.strip()) for m in messages]
-        )
+        ignore_rules_by_dir = {}
 
-    def _process_settings_blocks(
-            self,
-            messages: collections.abc.Sequence[Message],
-    ) -> typing.Iterator[str]:
-        for msg in messages:
-            if msg.type != MessageType.SETTINGS:
-                continue
+        for dir_path, dir_names, file_names in os.walk(self._root_dir):
+            rel_dir = os.path.relpath(dir_path, self._root_dir).replace(os.sep, "/")
+            rel_dir = "" if rel_dir == "." else rel_dir + "/"
+            ignore_rules = (
+                ignore_rules_by_dir.get(os.path.dirname(dir_path), [])
+                + self._read_gitignore(dir_path, rel_dir)
+            )
+            ignore_rules_by_dir[dir_path] = ignore_rules
 
-            for line in msg.text.splitlines():
-                line = line.strip()
-                parts = line.split(":", 1)
+            dir_names[:] = sorted(
+                name
+                for name in dir_names
+                if (
+                    name not in self.IGNORED_DIR_NAMES
+                    and not name.startswith(".")
+                    and not self._is_ignored(ignore_rules, rel_dir + name, True)
+                )
+            )
 
-                if len(parts) != 2:
+            for file_name in sorted(file_names):
+                if (
+                        file_name == INDEX_FILE_NAME
+                        or file_name.startswith(INDEX_FILE_NAME + "-")
+                        or file_name.startswith(".")
+                        or self._is_ignored(ignore_rules, rel_dir + file_name, False)
+                ):
                     continue
 
-                key, value = parts
-                key_lower = key.strip().lower()
-                value = value.strip()
+                abs_path = os.path.join(dir_path, file_name)
 
-                if key_lower == "model":
-                    self.set_model(value)
+                try:
+                    stat = os.stat(abs_path)
 
-                    yield StatusStr(self.get_model_info() + "\n")
+                except OSError:
+                    continue
 
-                elif key_lower == "reasoning":
-                    self.set_reasoning(value)
+                if stat.st_size > self.MAX_FILE_SIZE or not os.path.isfile(abs_path):
+                    continue
 
-                    yield StatusStr(self.get_reasoning_info() + "\n")
+                path = os.path.relpath(abs_path, self._root_dir).replace(os.sep, "/")
 
-                elif key_lower == "streaming":
-                    self.set_streaming(value)
+                yield path, abs_path, stat
 
-                    yield StatusStr(self.get_streaming_info() + "\n")
+    @staticmethod
+    def _read_gitignore(
+            dir_path: str,
+            rel_dir: str,
+    ) -> typing.List[tuple[str, str, bool, bool, bool]]:
+        """
+        Parse the .gitignore file of a directory into (base directory,
+        pattern, is negated, is directory only, is anchored) rules. (Only
+        the commonly used subset of the syntax is supported.)
+        """
 
-                elif key_lower == "temperature":
-                    self.set_temperature(float(value))
+        try:
+            with open(os.path.join(dir_path, ".gitignore"), "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
 
-                    yield StatusStr(self.get_temperature_info() + "\n")
+        except (OSError, UnicodeDecodeError):
+            return []
 
-                else:
-                    raise ValueError(f"Unknown setting: {key!r}")
+        rules = []
 
-    @staticmethod
-    def _is_user_message(message: Message) -> bool:
-        return message.type == MessageType.USER and message.text.strip() != ""
+        for line in lines:
+            line = line.rstrip()
 
-    def _fetch_completion(self) -> typing.Iterator[str]:
-        yield StatusStr(f"Waiting for {self._provider}...")
+            if line == "" or line.startswith("#"):
+                continue
 
-        ai_client = self._ai_clients[self._provider]
+            is_negated = line.startswith("!")
 
-        reasoning = ""
-        complete_reasoning = None
-        reasoning_header_emitted = False
-        had_reasoning_deltas = False
+            if is_negated:
+                line = line[1:]
 
-        response_text = ""
-        complete_response_text = None
-        text_header_emitted = False
-        had_text_deltas = False
+            is_dir_only = line.endswith("/")
+            line = line.rstrip("/")
 
-        conversation = [
-            msg
-            for msg in self._messages
-            if msg.type in self.RELEVANT_MESSAGE_TYPES
-        ]
+            if line.startswith("**/"):
+                line = line[3:]
 
-        if self._streaming == Streaming.ON:
-            texts = ai_client.respond_streaming(
-                self._model,
-                conversation,
-                self._temperature,
-                self._reasoning,
-            )
-        else:
-            texts = ai_client.respond(
-                self._model,
-                conversation,
-                self._temperature,
-                self._reasoning,
-            )
+            is_anchored = "/" in line
+            line = line.lstrip("/")
 
-        status = []
+            if line != "":
+                rules.append((rel_dir, line, is_negated, is_dir_only, is_anchored))
 
-        for response in texts:
-            if response.is_status:
-                status.append(response.text.strip())
+        return rules
+
+    @staticmethod
+    def _is_ignored(
+            ignore_rules: collections.abc.Sequence[tuple[str, str, bool, bool, bool]],
+            path: str,
+            is_dir: bool,
+    ) -> bool:
+        is_ignored = False
 
+        for base_dir, pattern, is_negated, is_dir_only, is_anchored in ignore_rules:
+            if (is_dir_only and not is_dir) or not path.startswith(base_dir):
                 continue
 
-            if response.is_reasoning:
-                if response.is_delta:
-                    reasoning += response.text
-                    had_reasoning_deltas = True
+            rel_path = path[len(base_dir):]
 
-                    if not reasoning_header_emitted:
-                        reasoning_header_emitted = True
-                        text_header_emitted = False
+            if not is_anchored:
+                rel_path = rel_path.rsplit("/", 1)[-1]
 
-                        yield "\n\n# === AI Reasoning ===\n\n"
+            if fnmatch.fnmatchcase(rel_path, pattern):
+                is_ignored = not is_negated
 
-                    yield response.text
-                else:
-                    complete_reasoning = response.text
+        return is_ignored
 
-            elif response.is_delta:
-                if not text_header_emitted:
-                    reasoning_header_emitted = False
-                    text_header_emitted = True
+    @staticmethod
+    def _read_text(abs_path: str) -> typing.Optional[str]:
+        try:
+            with open(abs_path, "rb") as f:
+                raw = f.read()
 
-                    yield "\n\n# === AI ===\n\n"
+        except OSError:
+            return None
 
-                response_text += response.text
-                had_text_deltas = True
+        if b"\0" in raw[:8192]:
+            return None
 
-                yield response.text
+        try:
+            return raw.decode("utf-8")
 
-            else:
-                complete_response_text = response.text
+        except UnicodeDecodeError:
+            return None
 
-        if complete_reasoning is not None:
-            reasoning = complete_reasoning
+    def _add(self, path: str, stat: os.stat_result, text: str):
+        self._db.execute(
+            "INSERT INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+            (path, stat.st_mtime_ns, stat.st_size),
+        )
 
-        if complete_response_text is not None:
-            response_text = complete_response_text
+        for first_line, last_line, chunk_text in self._split(text):
+            terms = collections.Counter(self.tokenize(chunk_text))
 
-        reasoning = reasoning.strip()
+            if len(terms) == 0:
+                continue
 
-        if reasoning:
-            self._messages.append(
-                Message(type=MessageType.AI_REASONING, text=reasoning)
+            cursor = self._db.execute(
+                "INSERT INTO chunks (path, first_line, last_line, length, text)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (path, first_line, last_line, sum(terms.values()), chunk_text),
+            )
+            self._db.executemany(
+                "INSERT INTO postings (term, chunk_id, tf) VALUES (?, ?, ?)",
+                ((term, cursor.lastrowid, tf) for term, tf in terms.items()),
             )
 
-        self._messages.append(
-            Message(type=MessageType.AI, text=response_text)
+    def _remove(self, path: str):
+        self._db.execute(
+            "DELETE FROM postings WHERE chunk_id IN (SELECT id FROM chunks WHERE path = ?)",
+            (path, ),
         )
+        self._db.execute("DELETE FROM chunks WHERE path = ?", (path, ))
+        self._db.execute("DELETE FROM files WHERE path = ?", (path, ))
 
-        if (not had_reasoning_deltas) and reasoning:
-            if not reasoning_header_emitted:
-                reasoning_header_emitted = True
-                text_header_emitted = False
+    @classmethod
+    def _split(cls, text: str) -> typing.Iterator[tuple[int, int, str]]:
+        """
+        Split the text into chunks of at most CHUNK_LINES lines, preferably
+        at blank lines.
+        """
 
-                yield "\n\n# === AI Reasoning ===\n\n"
+        lines = text.splitlines()
+        begin = 0
 
-            yield reasoning
+        while begin < len(lines):
+            end = min(len(lines), begin + cls.CHUNK_LINES)
 
-        if (not had_text_deltas) and response_text:
-            if not text_header_emitted:
-                reasoning_header_emitted = False
-                text_header_emitted = True
+            if end < len(lines):
+                lookback_limit = max(begin + 1, end - cls.CHUNK_BREAK_LOOKBACK_LINES)
 
-                yield "\n\n# === AI ===\n\n"
+                for i in range(end, lookback_limit - 1, -1):
+                    if lines[i].strip() == "":
+                        end = i
+                        break
 
-            yield response_text
+            yield begin + 1, end, "\n".join(lines[begin:end])
 
-        yield "\n"
+            begin = end
 
-        if len(status) > 0:
-            status_text = "\n\n".join(status).strip()
+            while begin < len(lines) and lines[begin].strip() == "":
+                begin += 1
 
-            self._messages.append(
-                Message(type=MessageType.AI_STATUS, text=status_text)
+    @classmethod
+    def tokenize(cls, text: str) -> typing.Iterator[str]:
+        """
+        Yield lowercase identifiers and numbers, and for compound identifiers
+        (snake_case, camelCase, etc.), their parts as well.
+        """
+
+        for token in cls.TOKEN_RE.findall(text):
+            if len(token) > 1:
+                yield token.lower()
+
+            parts = cls.SUBTOKEN_RE.findall(token)
+
+            if len(parts) > 1:
+                for part in parts:
+                    if len(part) > 1:
+                        yield part.lower()
+
+    def search(self, query: str, limit: int) -> typing.List[CodeSnippet]:
+        num_chunks, avg_length = self._db.execute(
+            "SELECT COUNT(*), AVG(length) FROM chunks"
+        ).fetchone()
+
+        if num_chunks == 0:
+            return []
+
+        k1 = self.BM25_K1
+        b = self.BM25_B
+        scores = collections.defaultdict(float)
+
+        for term in set(self.tokenize(query)):
+            postings = self._db.execute(
+                "SELECT postings.chunk_id, postings.tf, chunks.length"
+                " FROM postings JOIN chunks ON chunks.id = postings.chunk_id"
+                " WHERE postings.term = ?",
+                (term, ),
+            ).fetchall()
+
+            if len(postings) == 0:
+                continue
+
+            df = len(postings)
+            idf = math.log(1.0 + (num_chunks - df + 0.5) / (df + 0.5))
+
+            for chunk_id, tf, length in postings:
+                scores[chunk_id] += (
+                    idf * tf * (k1 + 1.0)
+                    / (tf + k1 * (1.0 - b + b * length / avg_length))
+                )
+
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        snippets = []
+
+        for chunk_id, score in best:
+            path, first_line, last_line, text = self._db.execute(
+                "SELECT path, first_line, last_line, text FROM chunks WHERE id = ?",
+                (chunk_id, ),
+            ).fetchone()
+            snippets.append(
+                CodeSnippet(
+                    path=path,
+                    first_line=first_line,
+                    last_line=last_line,
+                    text=text,
+                    score=score,
+                )
             )
 
-            yield "\n# === AI Status ===\n\n" + status_text + "\n"
+        return snippets
 
 
-def apply_settings(messenger: AiMessenger, settings: typing.Dict[str, typing.Any]):
-    methods = {
-        "model": (messenger.set_model, messenger.get_model_info),
-        "reasoning": (messenger.set_reasoning, messenger.get_reasoning_info),
-        "streaming": (messenger.set_streaming, messenger.get_streaming_info),
-        "temperature": (messenger.set_temperature, messenger.get_temperature_info),
-    }
+class BatchJobs:
+    """
+    Keep track of the batch jobs that were submitted for the conversations in
+    a directory, so that their results can be collected by a later run,
+    instead of submitting the conversations again.
+    """
 
-    for key, (setter, info_getter) in methods.items():
-        try:
-            setter(settings[key])
+    def __init__(self, directory: str):
+        self._path = os.path.join(directory, BATCH_STATE_FILE_NAME)
+        self.jobs = self._load()
 
-        except ValueError:
-            pass
+    @staticmethod
+    def make_custom_id(file_name: str) -> str:
+        return "conv-" + hashlib.sha256(file_name.encode("utf-8")).hexdigest()[:32]
 
-        info(info_getter())
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_file_names(self) -> typing.Set[str]:
+        return set(
+            request["file_name"]
+            for job in self.jobs
+            for request in job["requests"].values()
+        )
+
+    def add(
+            self,
+            provider: str,
+            batch_id: str,
+            requests: typing.Dict[str, typing.Dict[str, str]],
+    ):
+        self.jobs.append(
+            {
+                "provider": provider,
+                "batch_id": batch_id,
+                "submitted_at": time.time(),
+                "requests": requests,
+            }
+        )
 
+    def remove(self, job: typing.Dict[str, typing.Any]):
+        self.jobs.remove(job)
 
-def create_tmp_conv_file(dir: typing.Optional[str]=None, infix: str="") -> str:
-    if infix != "":
-        infix += "-"
+    def save(self):
+        if len(self.jobs) == 0:
+            try:
+                os.remove(self._path)
 
-    now = datetime.datetime.now()
-    conv_file = tempfile.NamedTemporaryFile(
-        prefix=now.strftime(f"ai-{infix}%Y-%m-%d-%H-%M-%S-"),
-        dir=dir,
-        suffix=".md",
-        mode="w+",
-        delete=False,
-    )
+            except FileNotFoundError:
+                pass
 
-    return conv_file.name
+            return
 
+        with tempfile.NamedTemporaryFile(
+                mode="w",
+                encoding="utf-8",
+                dir=os.path.dirname(self._path),
+                suffix=".tmp",
+                delete=False,
+        ) as f:
+            json.dump({"jobs": self.jobs}, f, indent=2)
 
-def cmd_interactive(
-        messenger: AiMessenger,
-        question_args: typing.List[str],
-        editor: str,
-) -> int:
-    info(f"Using {editor!r} to edit conversations.")
+        os.replace(f.name, self._path)
 
-    init_question = " ".join(question_args).strip()
+    def _load(self) -> typing.List[typing.Dict[str, typing.Any]]:
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                state = json.load(f)
 
-    ai_cmd = AiCmd(editor, messenger)
+        except FileNotFoundError:
+            return []
 
-    if len(init_question) > 0:
-        ai_cmd.do_ask(init_question)
+        return [
+            job
+            for job in get_item(state, "jobs", default=[], expect_type=list)
+            if (
+                isinstance(get_item(job, "provider"), str)
+                and isinstance(get_item(job, "batch_id"), str)
+                and isinstance(get_item(job, "requests"), dict)
+                and all(
+                    isinstance(get_item(request, "file_name"), str)
+                    and isinstance(get_item(request, "sha256"), str)
+                    for request in job["requests"].values()
+                )
+            )
+        ]
 
-    ai_cmd.cmdloop()
 
-    return 0
+class ResponseCache:
+    """
+    Store complete responses in a directory, one JSON file per request, named
+    after a hash of everything that the response depends on. Files are
+    touched when they are read, and the least recently used ones are evicted
+    when the total size of the cache exceeds the limit.
+    """
 
+    FILE_NAME_SUFFIX = ".json"
 
-def cmd_stdio(messenger: AiMessenger, response_only: bool) -> int:
-    conversation_in = (
-        "\n".join(line.strip("\r\n") for line in sys.stdin.readlines()).strip()
-    )
-    continue_conversation(messenger, conversation_in)
+    def __init__(self, directory: str, max_bytes: int=RESPONSE_CACHE_MAX_BYTES):
+        self._directory = directory
+        self._max_bytes = max_bytes
 
-    if response_only:
-        ai_response = find_last_ai_response(messenger)
-        print(ai_response.text)
-    else:
-        print(messenger.conversation_to_str())
+    @staticmethod
+    def make_key(
+            provider: str,
+            model: str,
+            temperature: float,
+            reasoning: str,
+            conversation: collections.abc.Sequence[Message],
+            max_tokens: int=0,
+    ) -> str:
+        params = [provider, model, float(temperature), reasoning]
 
-    return 0
+        if max_tokens > 0:
+            params.append(max_tokens)
 
+        params = json.dumps(params)
+        digest = hashlib.sha256(params.encode("utf-8") + b"\0")
+        digest.update(hash_conversation(conversation).encode("utf-8"))
 
-def cmd_replace(
-        messenger: AiMessenger,
-        edited_file_name_args: typing.List[str],
-) -> int:
-    edited_file_name = " ".join(edited_file_name_args).strip()
+        return digest.hexdigest()
 
-    if not edited_file_name:
-        edited_file_name = "untitled"
+    @staticmethod
+    def replay(
+            cached_response: typing.Dict[str, typing.Any],
+            cache_key: str,
+    ) -> typing.Iterator[AiResponse]:
+        reasoning = get_item(cached_response, "reasoning", default="", expect_type=str)
+        text = get_item(cached_response, "text", default="", expect_type=str)
+        status = get_item(cached_response, "status", default="", expect_type=str)
 
-    lines = (
-        "\n".join(line.strip("\r\n") for line in sys.stdin.readlines()).strip()
-    )
-    conversation_in = REPLACE_PROMPT.format(
-        FILE_NAME=edited_file_name,
-        LINES=lines,
-    )
-    continue_conversation(messenger, conversation_in)
-    ai_response = find_last_ai_response(messenger)
+        if reasoning:
+            yield AiResponse(is_delta=True, is_reasoning=True, is_status=False, text=reasoning)
 
-    if ai_response is None:
-        print(messenger.conversation_to_str())
+        yield AiResponse(is_delta=True, is_reasoning=False, is_status=False, text=text)
 
-        return EXIT_CODE_REPLACE_FAIL
+        yield from AiClient.compile_status({"response_cache": f"hit {cache_key[:16]}"})
 
-    ai_lines = ai_response.text.splitlines()
-    begin_idx = None
-    end_idx = None
+        if status:
+            yield AiResponse(is_delta=False, is_reasoning=False, is_status=True, text=status)
 
-    for idx, line in enumerate(ai_lines):
-        line_stripped = line.strip()
+    def get(self, key: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        path = self._get_path(key)
 
-        if begin_idx is None and line_stripped == "--- BEGIN REPLACEMENT ---":
-            begin_idx = idx
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                cached_response = json.load(f)
 
-        elif line_stripped == "--- END REPLACEMENT ---":
-            end_idx = idx
+            os.utime(path)
 
-    if begin_idx is None or end_idx is None or begin_idx >= end_idx:
-        print(messenger.conversation_to_str())
+        except (OSError, ValueError):
+            return None
 
-        return EXIT_CODE_REPLACE_FAIL
+        if not isinstance(cached_response, dict):
+            return None
 
-    print("\n".join(ai_lines[begin_idx + 1:end_idx]))
+        return cached_response
 
-    return 0
+    def put(self, key: str, cached_response: typing.Dict[str, typing.Any]):
+        try:
+            os.makedirs(self._directory, exist_ok=True)
 
+            with tempfile.NamedTemporaryFile(
+                    mode="w",
+                    encoding="utf-8",
+                    dir=self._directory,
+                    suffix=".tmp",
+                    delete=False,
+            ) as f:
+                json.dump(cached_response, f)
 
-def continue_conversation(messenger: AiMessenger, conversation_in: str):
-    generator = messenger.ask("", lambda conversation: conversation_in)
+            os.replace(f.name, self._get_path(key))
+            self._evict()
 
-    if is_quiet:
-        for _ in generator:
-            pass
+        except OSError as exc:
+            error(f"Unable to write response cache in {self._directory!r}: {type(exc)}: {exc}")
 
-        return
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self._directory, key + self.FILE_NAME_SUFFIX)
 
-    printer = WrappingPrinter()
-    printer.set_width(WrappingPrinter.get_wrapping_width())
+    def _evict(self):
+        entries = []
+        total_size = 0
 
-    for chunk in generator:
-        printer.print(chunk, end="", file=sys.stderr)
+        with os.scandir(self._directory) as dir_entries:
+            for dir_entry in dir_entries:
+                if not dir_entry.name.endswith(self.FILE_NAME_SUFFIX):
+                    continue
 
-    printer.print("", file=sys.stderr)
+                stat = dir_entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+                total_size += stat.st_size
 
+        entries.sort()
 
-def find_last_ai_response(messenger: AiMessenger) -> typing.Optional[Message]:
-    messages = messenger.messages
+        for _, size, path in entries:
+            if total_size <= self._max_bytes:
+                break
 
-    for i in range(len(messages) - 1, -1, -1):
-        if messages[i].type == MessageType.AI:
-            return messages[i]
+            try:
+                os.remove(path)
+                total_size -= size
 
-    return None
+            except OSError:
+                pass
 
 
 class AiCmd(cmd.Cmd):
@@ -2924,7 +8498,7 @@ class AiCmd(cmd.Cmd):
         print(os.linesep.join(self._ai_messenger.filter_models_by_prefix("")))
 
     def do_reasoning(self, arg):
-        "Turn reasoning on or off, or use the default behavior of the model. (Ignored for some providers.)"
+        "Turn reasoning on or off, select a reasoning level (low, medium, high) or a thinking budget in tokens, or use the default behavior of the model. (Ignored for some providers.)"
 
         arg = arg.strip()
 
@@ -2938,7 +8512,47 @@ class AiCmd(cmd.Cmd):
         print(self._ai_messenger.get_reasoning_info())
 
     def complete_reasoning(self, text, line, begidx, endidx):
-        options = [Reasoning.DEFAULT, Reasoning.OFF, Reasoning.ON]
+        options = [
+            Reasoning.DEFAULT,
+            Reasoning.OFF,
+            Reasoning.ON,
+            Reasoning.LOW,
+            Reasoning.MEDIUM,
+            Reasoning.HIGH,
+        ]
+
+        return [o for o in options if o.value.startswith(text.strip())]
+
+    def do_max_tokens(self, arg):
+        "Show or set the maximum number of tokens to generate. (0 means the default of the model.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_max_tokens(int(arg))
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_max_tokens_info())
+
+    def do_tier(self, arg):
+        "Show or set the service tier: priority for lower latency, flex for lower cost. (Ignored for some providers.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_tier(arg)
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_tier_info())
+
+    def complete_tier(self, text, line, begidx, endidx):
+        options = [Tier.DEFAULT, Tier.STANDARD, Tier.PRIORITY, Tier.FLEX]
 
         return [o for o in options if o.value.startswith(text.strip())]
 
@@ -2975,6 +8589,227 @@ class AiCmd(cmd.Cmd):
 
         print(self._ai_messenger.get_temperature_info())
 
+    def do_server_state(self, arg):
+        "Turn server-side conversation state on or off. (Ignored for some providers.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_server_state(arg)
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_server_state_info())
+
+    def complete_server_state(self, text, line, begidx, endidx):
+        options = [ServerState.OFF, ServerState.ON]
+
+        return [o for o in options if o.value.startswith(text.strip())]
+
+    def do_cache(self, arg):
+        "Turn the local response cache on or off, or use it only for reading or only for writing."
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_cache(arg)
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_cache_info())
+
+    def complete_cache(self, text, line, begidx, endidx):
+        options = [CacheMode.OFF, CacheMode.READ, CacheMode.WRITE, CacheMode.ON]
+
+        return [o for o in options if o.value.startswith(text.strip())]
+
+    def do_hedge(self, arg):
+        "Show or set the model which also gets the request when the selected one is slow to respond, or turn hedging off."
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_hedge(arg)
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_hedge_info())
+
+    def complete_hedge(self, text, line, begidx, endidx):
+        return [o for o in ["off"] if o.startswith(text)] + self._ai_messenger.filter_models_by_prefix(text)
+
+    def do_fallback(self, arg):
+        "Show or set the comma-separated list of models to try when the selected one fails, or turn fallback off."
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_fallback(arg)
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_fallback_info())
+
+    def complete_fallback(self, text, line, begidx, endidx):
+        return [o for o in ["off"] if o.startswith(text)] + self._ai_messenger.filter_models_by_prefix(text)
+
+    def do_compare(self, arg):
+        "Show or set the comma-separated list of models to send each question to, along with the selected one, or turn comparison off."
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_compare(arg)
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_compare_info())
+
+    def complete_compare(self, text, line, begidx, endidx):
+        return [o for o in ["off"] if o.startswith(text)] + self._ai_messenger.filter_models_by_prefix(text)
+
+    def do_map_reduce(self, arg):
+        "Show or set the number of tokens per chunk for splitting inputs which are too long to be processed at once, or turn map-reduce off."
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_map_reduce(arg)
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_map_reduce_info())
+
+    def complete_map_reduce(self, text, line, begidx, endidx):
+        return [o for o in ["off"] if o.startswith(text.strip())]
+
+    def do_cascade(self, arg):
+        "Show or set the comma-separated list of cheaper models to try before the selected one in replace mode, or turn the cascade off."
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_cascade(arg)
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_cascade_info())
+
+    def complete_cascade(self, text, line, begidx, endidx):
+        return [o for o in ["off"] if o.startswith(text)] + self._ai_messenger.filter_models_by_prefix(text)
+
+    def do_cascade_deadline(self, arg):
+        "Show or set the number of seconds that a model in the cascade may take before moving on to the next one. (0 disables it.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_cascade_deadline(float(arg))
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_cascade_deadline_info())
+
+    def do_first_token_timeout(self, arg):
+        "Show or set the number of seconds to wait for the first output before falling back to the next model. (0 disables it.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_first_token_timeout(float(arg))
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_first_token_timeout_info())
+
+    def do_connect_timeout(self, arg):
+        "Show or set the number of seconds to wait for connecting to a provider. (0 disables it.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_connect_timeout(float(arg))
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_connect_timeout_info())
+
+    def do_first_byte_timeout(self, arg):
+        "Show or set the number of seconds to wait for the first byte of a response. (0 disables it.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_first_byte_timeout(float(arg))
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_first_byte_timeout_info())
+
+    def do_idle_timeout(self, arg):
+        "Show or set the maximum number of seconds between two parts of a response. (0 disables it.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_idle_timeout(float(arg))
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_idle_timeout_info())
+
+    def do_total_timeout(self, arg):
+        "Show or set the maximum number of seconds that a request may take. (0 disables it.)"
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_total_timeout(float(arg))
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_total_timeout_info())
+
+    def do_hedge_delay(self, arg):
+        "Show or set the number of seconds to wait for the first output before hedging."
+
+        arg = arg.strip()
+
+        if arg:
+            try:
+                self._ai_messenger.set_hedge_delay(float(arg))
+
+            except ValueError as err:
+                self._print_error(err)
+
+        print(self._ai_messenger.get_hedge_delay_info())
+
     def do_clear(self, arg):
         "Start a new conversation"
 
@@ -3029,21 +8864,32 @@ class AiCmd(cmd.Cmd):
     def do_ask(self, arg):
         "Ask the AI."
 
+        self._print_response(
+            self._ai_messenger.ask(arg.strip(), self._edit_conversation)
+        )
+
+    def do_continue(self, arg):
+        "Ask the AI to continue its last response from where it stopped."
+
+        self._print_response(self._ai_messenger.continue_response())
+
+    def _print_response(self, response_chunks: typing.Iterator[str]):
         self._printer.set_width(WrappingPrinter.get_wrapping_width())
 
         try:
-            response_chunks = self._ai_messenger.ask(
-                arg.strip(),
-                self._edit_conversation,
-            )
-
             self._printer.print("")
 
-            for chunk in response_chunks:
-                self._printer.print(chunk, end="", flush=True)
+            print_response(
+                response_chunks,
+                lambda chunk: self._printer.print(chunk, end="", flush=True),
+            )
 
             self._printer.print("")
 
+        except KeyboardInterrupt:
+            print("")
+            self._print_error("interrupted")
+
         except ValueError as value_err:
             print("")
             self._print_error(value_err)
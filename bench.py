@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+# BSD 3-Clause License
+#
+# Copyright (c) 2025, Attila Magyar
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Micro-benchmarks for the hot paths of ai-cat.py that do not need network
+access. Streams are replayed from events which follow the formats that the
+providers are documented to send.
+
+Usage: python3 bench.py [rounds]
+"""
+
+import importlib
+import json
+import sys
+import time
+
+
+ai_cat = importlib.import_module("ai-cat")
+
+
+EVENTS_PER_STREAM = 2000
+
+
+def record_anthropic_stream():
+    events = [
+        {
+            "type": "message_start",
+            "message": {
+                "id": "msg_1",
+                "model": "claude",
+                "role": "assistant",
+                "usage": {"input_tokens": 1000, "output_tokens": 1},
+            },
+        },
+    ]
+    events.extend(
+        {
+            "type": "content_block_delta",
+            "index": 0,
+            "delta": {"type": "text_delta", "text": "token "},
+        }
+        for _ in range(EVENTS_PER_STREAM)
+    )
+    events.append(
+        {
+            "type": "message_delta",
+            "delta": {"stop_reason": "end_turn"},
+            "usage": {"output_tokens": EVENTS_PER_STREAM},
+        }
+    )
+
+    return ai_cat.AnthropicClient, events, lambda event: event
+
+
+def record_chat_completions_stream(ai_client_cls):
+    events = [
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "model",
+            "choices": [{"index": 0, "delta": {"content": "token "}, "finish_reason": None}],
+        }
+        for _ in range(EVENTS_PER_STREAM)
+    ]
+    events[-1]["choices"][0]["finish_reason"] = "stop"
+    events[-1]["usage"] = {"prompt_tokens": 1000, "completion_tokens": EVENTS_PER_STREAM}
+
+    return ai_client_cls, events, lambda event: event["choices"][0]
+
+
+def record_google_stream():
+    events = [
+        {
+            "candidates": [
+                {
+                    "content": {"role": "model", "parts": [{"text": "token "}]},
+                    "index": 0,
+                },
+            ],
+            "usageMetadata": {"promptTokenCount": 1000, "totalTokenCount": 1000 + i},
+            "modelVersion": "gemini",
+            "responseId": "resp_1",
+        }
+        for i in range(EVENTS_PER_STREAM)
+    ]
+
+    return ai_cat.GoogleClient, events, lambda event: event["candidates"][0]
+
+
+def record_anthropic_sse():
+    _, events, _ = record_anthropic_stream()
+    sse_events = [("message_start", json.dumps(events[0]))]
+    sse_events.append(
+        (
+            "content_block_start",
+            json.dumps(
+                {
+                    "type": "content_block_start",
+                    "index": 0,
+                    "content_block": {"type": "text", "text": ""},
+                }
+            ),
+        )
+    )
+
+    for i, event in enumerate(events[1:-1]):
+        sse_events.append(("content_block_delta", json.dumps(event)))
+
+        if i % 10 == 0:
+            sse_events.append(("ping", json.dumps({"type": "ping"})))
+
+    sse_events.append(
+        ("content_block_stop", json.dumps({"type": "content_block_stop", "index": 0}))
+    )
+    sse_events.append(("message_delta", json.dumps(events[-1])))
+    sse_events.append(("message_stop", json.dumps({"type": "message_stop"})))
+
+    return ai_cat.AnthropicClient, sse_events
+
+
+def record_chat_completions_sse(ai_client_cls):
+    _, events, _ = record_chat_completions_stream(ai_client_cls)
+    sse_events = [("", json.dumps(event)) for event in events]
+    sse_events.append(("", "[DONE]"))
+
+    return ai_client_cls, sse_events
+
+
+def bench_respond_streaming(rounds):
+    streams = [
+        record_anthropic_sse(),
+        record_chat_completions_sse(ai_cat.DeepSeekClient),
+        record_chat_completions_sse(ai_cat.MistralClient),
+        record_chat_completions_sse(ai_cat.XAiClient),
+    ]
+    conversation = [ai_cat.Message(type=ai_cat.MessageType.USER, text="Hello")]
+
+    for ai_client_cls, sse_events in streams:
+        class ReplayingAiClient(ai_client_cls):
+            def http_sse(self, method, url, headers=None, body=None, bufsize=4096):
+                return iter(sse_events)
+
+        ai_client = ReplayingAiClient("api-key")
+
+        def consume(_):
+            for _ in ai_client.respond_streaming(
+                    "model",
+                    conversation,
+                    1.0,
+                    ai_cat.Reasoning.DEFAULT,
+            ):
+                pass
+
+        streams_per_second = measure(rounds, [None], consume)
+
+        print(
+            f"respond_streaming {ai_client_cls.__name__:>13}:"
+            f" {streams_per_second * len(sse_events):>10.0f} events/s"
+        )
+
+
+def extract_status_linearly(data, paths):
+    # The implementation of AiClient.extract_status() before StatusPaths.
+    status = {}
+
+    for path in paths:
+        value = ai_cat.get_item(data, path)
+
+        if value is not None and value != "":
+            status[path] = value
+
+    return status
+
+
+def bench_extract_status(rounds):
+    streams = [
+        record_anthropic_stream(),
+        record_chat_completions_stream(ai_cat.DeepSeekClient),
+        record_chat_completions_stream(ai_cat.MistralClient),
+        record_chat_completions_stream(ai_cat.XAiClient),
+        record_google_stream(),
+    ]
+
+    for ai_client_cls, events, get_inner in streams:
+        events = [json.loads(json.dumps(event)) for event in events]
+        paths = ai_client_cls.STATUS_PATHS
+        linear_paths = tuple(paths)
+
+        for event in events:
+            assert paths.extract(event) == extract_status_linearly(event, linear_paths)
+
+        before = measure(
+            rounds,
+            events,
+            lambda event: (
+                extract_status_linearly(get_inner(event), linear_paths),
+                extract_status_linearly(event, linear_paths),
+            ),
+        )
+        after = measure(
+            rounds,
+            events,
+            lambda event: (paths.extract(get_inner(event)), paths.extract(event)),
+        )
+
+        print(
+            f"extract_status {ai_client_cls.__name__:>16}:"
+            f" before: {before:>10.0f} events/s,"
+            f" after: {after:>10.0f} events/s,"
+            f" speedup: {after / before:.2f}x"
+        )
+
+
+def measure(rounds, events, func):
+    best = None
+
+    for _ in range(rounds):
+        start = time.perf_counter()
+
+        for event in events:
+            func(event)
+
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return len(events) / best
+
+
+def main(argv):
+    rounds = int(argv[1]) if len(argv) > 1 else 5
+
+    bench_extract_status(rounds)
+    bench_respond_streaming(rounds)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
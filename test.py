@@ -30,9 +30,17 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import collections.abc
+import email
+import email.policy
+import http.server
 import importlib
+import json
 import os
+import re
 import sys
+import tempfile
+import threading
+import time
 import typing
 import unittest
 
@@ -58,6 +66,38 @@ class TestGetItem(unittest.TestCase):
         )
 
 
+class TestStatusPaths(unittest.TestCase):
+    def test_extract_finds_the_same_fields_as_get_item(self):
+        paths = (
+            "choices.0.finish_reason",
+            "id",
+            "usage",
+            "usage.completion_tokens",
+            "usage.prompt_tokens_details.cached_tokens",
+            "usage.missing",
+        )
+        data = {
+            "id": "chatcmpl-1",
+            "choices": [{"finish_reason": "stop"}],
+            "usage": {
+                "completion_tokens": 42,
+                "prompt_tokens_details": {"cached_tokens": 0},
+                "total_tokens": "",
+            },
+            "model": "model1",
+        }
+        expected = {
+            path: ai_cat.get_item(data, path)
+            for path in paths
+            if ai_cat.get_item(data, path) is not None
+        }
+
+        status = ai_cat.StatusPaths(paths).extract(data)
+
+        self.assertEqual(expected, status)
+        self.assertEqual({}, ai_cat.StatusPaths(paths).extract([1, 2, 3]))
+
+
 class TestAiMessenger(unittest.TestCase):
     NOTES = ai_cat.AiMessenger.NOTES_HEADER + """\
  * fake/model1
@@ -106,12 +146,14 @@ And what is The Answer?"""
     @staticmethod
     def create_messenger(
             responses: collections.abc.Sequence[collections.abc.Sequence[ai_cat.AiResponse]]=[],
+            response_cache: typing.Optional[ai_cat.ResponseCache]=None,
     ) -> tuple[ai_cat.AiMessenger, ai_cat.AiClient]:
         ai_client = FakeAiClient(responses)
         ai_messenger = ai_cat.AiMessenger(
             {"fake": ai_client},
             [f"fake/{model}" for model in ai_client.list_models()],
             system_prompt="Please act as a helpful AI assistant.",
+            response_cache=response_cache,
         )
 
         return (ai_messenger, ai_client)
@@ -1055,115 +1097,2587 @@ Temperature: 0.0
         self.assertEqual(expected_conversation + expected_settings_3, conv_3)
         self.assertEqual(expected_conversation + expected_settings_4, conv_4)
 
-    def test_parsing_keeps_blocks_boundaries_as_they_were_supplied_except_for_multiple_system_prompts(self):
+    def test_server_state_is_used_until_the_conversation_is_edited(self):
+        status = {"id": "resp_1"}
+        responses = [
+            [
+                ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=False, text="A sentence."),
+                ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=True, text="id: resp_1", status=status),
+            ],
+            [
+                ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=False, text="42."),
+            ],
+            [
+                ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=False, text="43."),
+            ],
+        ]
+        ai_messenger, ai_client = self.create_messenger(responses)
+        ai_client.SUPPORTS_SERVER_STATE = True
         conversation = """\
-# === System ===
+# === Settings ===
 
-System 2
+Server state: on
+
+# === User ===
+
+What is a question?
+"""
+        list(ai_messenger.ask("", lambda conversation_text: conversation))
+        first_conversation = ai_messenger.conversation_to_str()
+        next_question = "\n# === User ===\n\nAnd what is The Answer?\n"
+
+        list(ai_messenger.ask("", lambda conversation_text: first_conversation + next_question))
+        second_options = ai_client.options
+
+        edited_conversation = first_conversation.replace("A sentence.", "Edited.") + next_question
+        list(ai_messenger.ask("", lambda conversation_text: edited_conversation))
+        edited_options = ai_client.options
+
+        self.assertIn("Server state: on\n", first_conversation)
+        self.assertIn("server_state.response_id: resp_1\n", first_conversation)
+        self.assertEqual("resp_1", second_options.previous_response_id)
+        self.assertEqual(3, second_options.previous_message_count)
+        self.assertIsNone(edited_options.previous_response_id)
+
+    def test_cached_response_is_replayed_for_identical_conversation(self):
+        responses = [
+            [
+                ai_cat.AiResponse(is_delta=True, is_reasoning=True, is_status=False, text="Thinking."),
+                ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="42."),
+            ],
+        ]
+        conversation = """\
+# === Settings ===
+
+Cache: on
+
+# === User ===
+
+What is The Answer?
+"""
 
+        with tempfile.TemporaryDirectory() as cache_dir:
+            ai_messenger, ai_client = self.create_messenger(responses, ai_cat.ResponseCache(cache_dir))
+            list(ai_messenger.ask("", lambda conversation_text: conversation))
+            first_conversation = ai_messenger.conversation_to_str()
 
+            ai_messenger, ai_client = self.create_messenger([], ai_cat.ResponseCache(cache_dir))
+            list(ai_messenger.ask("", lambda conversation_text: conversation))
+            second_conversation = ai_messenger.conversation_to_str()
+
+        self.assertIsNone(ai_client.conversation)
+        self.assertIn("Thinking.", second_conversation)
+        self.assertIn("42.", second_conversation)
+        self.assertIn("response_cache: hit ", second_conversation)
+        self.assertNotIn("response_cache", first_conversation)
+
+    def test_hedge_model_answers_when_selected_model_is_slow(self):
+        class SlowAiClient(FakeAiClient):
+            def __init__(self):
+                super().__init__([])
+
+                self.release = threading.Event()
+
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                if model == "model1":
+                    self.release.wait(5.0)
+
+                    yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="Slow.")
+
+                else:
+                    yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="Fast.")
+
+        ai_client = SlowAiClient()
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+        conversation = """\
 # === Settings ===
 
 Model: fake/model1
+Hedge: fake/model2
+Hedge delay: 0.01
+
+# === User ===
 
+What is The Answer?
+"""
+
+        try:
+            list(ai_messenger.ask("", lambda conversation_text: conversation))
+
+        finally:
+            ai_client.release.set()
+
+        conversation = ai_messenger.conversation_to_str()
+
+        self.assertIn("Hedge: fake/model2\nHedge delay: 0.01\n", conversation)
+        self.assertIn("# === AI ===\n\nFast.\n", conversation)
+        self.assertNotIn("Slow.", conversation)
+        self.assertIn("hedge.winner: fake/model2\n", conversation)
+        self.assertIn("hedge.requests: 2\n", conversation)
+
+    def test_winning_hedge_model_is_recorded_when_fallback_is_set(self):
+        class SlowAiClient(FakeAiClient):
+            def __init__(self):
+                super().__init__([])
+
+                self.release = threading.Event()
 
+            def list_models(self):
+                return ["model1", "model2", "model3"]
+
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                if model == "model1":
+                    self.release.wait(5.0)
+
+                    yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="Slow.")
+
+                else:
+                    yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="Fast.")
+
+        conversation = """\
 # === Settings ===
 
-Model: fake/model2
+Model: fake/model1
+Hedge: fake/model2
+Hedge delay: 0.01
+Fallback: fake/model3
+Cache: on
+
+# === User ===
+
+What is The Answer?
+"""
+        messages = [
+            ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="Please act as a helpful AI assistant."),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?"),
+        ]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            response_cache = ai_cat.ResponseCache(cache_dir)
+            ai_client = SlowAiClient()
+            ai_messenger = ai_cat.AiMessenger(
+                {"fake": ai_client},
+                [f"fake/{model}" for model in ai_client.list_models()],
+                system_prompt="Please act as a helpful AI assistant.",
+                response_cache=response_cache,
+            )
+
+            try:
+                list(ai_messenger.ask("", lambda conversation_text: conversation))
+
+            finally:
+                ai_client.release.set()
+
+            selected_model_response = response_cache.get(
+                ai_cat.ResponseCache.make_key("fake", "model1", 1.0, "default", messages)
+            )
+            hedge_model_response = response_cache.get(
+                ai_cat.ResponseCache.make_key("fake", "model2", 1.0, "default", messages)
+            )
+
+        conversation = ai_messenger.conversation_to_str()
+
+        self.assertIn("hedge.winner: fake/model2\n", conversation)
+        self.assertIn("fallback.answered_by: fake/model2\n", conversation)
+        self.assertIsNone(selected_model_response)
+        self.assertEqual("Fast.", hedge_model_response["text"])
+
+    def test_fallback_model_answers_when_selected_model_is_overloaded(self):
+        class OverloadedAiClient(FakeAiClient):
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                if model == "model1":
+                    raise ai_cat.HttpError(529, "Overloaded", "")
+
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="42.")
+
+        ai_client = OverloadedAiClient([])
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+        conversation = """\
+# === Settings ===
 
+Model: fake/model1
+Fallback: fake/model2
 
 # === User ===
 
-User 1
+What is The Answer?
+"""
+
+        list(ai_messenger.ask("", lambda conversation_text: conversation))
+        conversation = ai_messenger.conversation_to_str()
+
+        self.assertIn("Model: fake/model1\n", conversation)
+        self.assertIn("Fallback: fake/model2\n", conversation)
+        self.assertIn("# === AI ===\n\n42.\n", conversation)
+        self.assertIn("fallback.answered_by: fake/model2\n", conversation)
+        self.assertIn("fallback.skipped: fake/model1 (HttpError: HTTP error: 529", conversation)
+
+    def test_partial_response_is_kept_when_stream_times_out(self):
+        class StallingAiClient(FakeAiClient):
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="The Answer is")
+
+                raise ai_cat.RequestTimeoutError("idle", 0.5)
+
+        ai_client = StallingAiClient([])
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+        conversation = """\
+# === Settings ===
 
+Idle timeout: 0.5
 
 # === User ===
 
-User 2
+What is The Answer?
+"""
 
+        list(ai_messenger.ask("", lambda conversation_text: conversation))
+        conversation = ai_messenger.conversation_to_str()
 
-# === AI Reasoning ===
+        self.assertIn("Idle timeout: 0.5\n", conversation)
+        self.assertIn("# === AI ===\n\nThe Answer is\n", conversation)
+        self.assertIn("error: Idle timeout (0.5s) exceeded\nincomplete: True\n", conversation)
 
-Reasoning 1
+    def test_partial_response_can_be_continued_after_stream_fails(self):
+        class FlakyAiClient(FakeAiClient):
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                self.conversation = conversation
 
+                if conversation[-1].text == ai_cat.AiMessenger.CONTINUE_PROMPT:
+                    yield ai_cat.AiResponse(is_delta=True, is_reasoning=True, is_status=False, text="Resuming.")
+                    yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text=" 42.")
 
-# === AI Reasoning ===
+                    return
 
-Reasoning 2
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=True, is_status=False, text="Thinking.")
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="The Answer is")
 
+                raise ConnectionResetError("Connection reset by peer")
 
-# === AI ===
+        ai_client = FlakyAiClient([])
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
 
-AI 1
+        list(ai_messenger.ask("What is The Answer?"))
+        conversation = ai_messenger.conversation_to_str()
 
+        self.assertIn("# === AI ===\n\nThe Answer is\n", conversation)
+        self.assertIn(
+            "error: ConnectionResetError: Connection reset by peer\nincomplete: True\n",
+            conversation,
+        )
 
-# === AI ===
+        list(ai_messenger.continue_response())
+        conversation = ai_messenger.conversation_to_str()
 
-AI 2
+        self.assertEqual(ai_cat.MessageType.AI, ai_client.conversation[-2].type)
+        self.assertEqual("The Answer is", ai_client.conversation[-2].text)
+        self.assertIn("# === AI Reasoning ===\n\nThinking.\n\nResuming.\n", conversation)
+        self.assertIn("# === AI ===\n\nThe Answer is 42.\n", conversation)
+        self.assertIn("error: ConnectionResetError: Connection reset by peer\n", conversation)
+        self.assertIn("continued: True\n", conversation)
+        self.assertNotIn("incomplete: True", conversation)
+        self.assertNotIn(ai_cat.AiMessenger.CONTINUE_PROMPT, conversation)
+        self.assertEqual(1, conversation.count("# === AI ===\n"))
+        self.assertEqual(1, conversation.count("# === AI Status ===\n"))
 
+    def test_errors_other_than_transport_failures_are_not_turned_into_incomplete_responses(self):
+        class BuggyAiClient(FakeAiClient):
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="The Answer is")
 
-# === AI Status ===
+                raise KeyError("candidates")
 
-Status 1
+        ai_client = BuggyAiClient([])
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
 
+        with self.assertRaises(KeyError):
+            list(ai_messenger.ask("What is The Answer?"))
 
-# === AI Status ===
+    def test_response_cut_off_by_output_token_limit_is_continued_automatically(self):
+        def truncated(text):
+            return [
+                ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text=text),
+                ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=True, text="```\nfinish_reason: length\n```", status={"finish_reason": "length"}),
+            ]
 
-Status 2
+        responses = [
+            truncated("The Answer "),
+            [
+                ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="is 42."),
+                ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=True, text="```\nfinish_reason: stop\n```", status={"finish_reason": "stop"}),
+            ],
+        ]
+        ai_messenger, ai_client = self.create_messenger(responses)
 
+        list(ai_messenger.ask("What is The Answer?"))
+        conversation = ai_messenger.conversation_to_str()
 
-# === User ===
+        self.assertEqual(ai_cat.AiMessenger.CONTINUE_PROMPT, ai_client.conversation[-1].text)
+        self.assertIn("# === AI ===\n\nThe Answer is 42.\n", conversation)
+        self.assertIn("finish_reason: length\n```\n\n```\nround_seconds: ", conversation)
+        self.assertIn("continued: True\nround_seconds: ", conversation)
+        self.assertIn("finish_reason: stop\n", conversation)
+        self.assertNotIn("incomplete: True", conversation)
+        self.assertEqual(1, conversation.count("# === AI ===\n"))
 
-User 3
-"""
-        edited_conversation = f"""
-# === System ===
+        responses = [truncated(f"Part {i}. ") for i in range(ai_cat.AiMessenger.MAX_CONTINUATION_ROUNDS + 2)]
+        ai_messenger, ai_client = self.create_messenger(responses)
 
-System 1
+        list(ai_messenger.ask("What is The Answer?"))
+        conversation = ai_messenger.conversation_to_str()
 
+        self.assertEqual(1, len(responses))
+        self.assertIn("# === AI ===\n\nPart 0. Part 1. Part 2. Part 3. \n", conversation)
+        self.assertEqual(1, conversation.count("incomplete: True\n"))
 
-# === Notes ===
+        responses = [truncated("The Answer "), truncated("is 42.")]
+        ai_messenger, ai_client = self.create_messenger(responses)
+        ai_messenger.set_max_tokens(50)
 
-Note 1
+        list(ai_messenger.ask("What is The Answer?"))
+        conversation = ai_messenger.conversation_to_str()
 
+        self.assertEqual(1, len(responses))
+        self.assertIn("# === AI ===\n\nThe Answer \n", conversation)
+        self.assertEqual(1, conversation.count("incomplete: True\n"))
 
-# === Notes ===
+    def test_response_cut_off_by_output_token_limit_is_not_cached(self):
+        responses = [
+            [
+                ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="The Answer "),
+                ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=True, text="```\nfinish_reason: length\n```", status={"finish_reason": "length"}),
+            ],
+            [ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="is 42.")],
+        ]
+        conversation = """\
+# === Settings ===
 
-Note 2
+Cache: on
 
+# === User ===
 
-{conversation}\
+What is The Answer?
 """
 
-        ai_messenger, ai_client, response_chunks = self.ask(
-            conversation,
+        with tempfile.TemporaryDirectory() as cache_dir:
+            ai_messenger, ai_client = self.create_messenger(responses, ai_cat.ResponseCache(cache_dir))
+            list(ai_messenger.ask("", lambda conversation_text: conversation))
+
+            ai_messenger, ai_client = self.create_messenger(
+                [[ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="The Answer is 42.")]],
+                ai_cat.ResponseCache(cache_dir),
+            )
+            list(ai_messenger.ask("", lambda conversation_text: conversation))
+            second_conversation = ai_messenger.conversation_to_str()
+
+        self.assertEqual([], ai_client.responses)
+        self.assertIn("# === AI ===\n\nThe Answer is 42.\n", second_conversation)
+        self.assertNotIn("response_cache", second_conversation)
+
+    def test_continuation_uses_prefill_when_supported(self):
+        class PrefillingAiClient(FakeAiClient):
+            def supports_prefill(self, reasoning):
+                return True
+
+        ai_client = PrefillingAiClient(
             [
                 [
-                    ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=False, text="AI 3"),
+                    ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="The Answer is "),
+                    ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=True, text="```\nstop_reason: max_tokens\n```", status={"stop_reason": "max_tokens"}),
                 ],
-            ],
+                [
+                    ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text=" 42."),
+                ],
+            ]
+        )
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
         )
 
-        expected_conversation = self.NOTES + "\n\n" + conversation + """
+        list(ai_messenger.ask("What is The Answer?"))
+        conversation = ai_messenger.conversation_to_str()
 
-# === AI ===
+        self.assertEqual(ai_cat.MessageType.AI, ai_client.conversation[-1].type)
+        self.assertEqual("The Answer is", ai_client.conversation[-1].text)
+        self.assertIn("# === AI ===\n\nThe Answer is 42.\n", conversation)
 
-AI 3
-"""
+    def test_output_budget_settings_are_passed_to_the_client(self):
+        ai_messenger, ai_client, response_chunks = self.ask(
+            """\
+# === Settings ===
 
-        self.assertEqual("model2", ai_client.model)
+Max tokens: 2000
+Reasoning: 1500
+
+# === User ===
+
+What is The Answer?
+""",
+            [[ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="42.")]],
+        )
+        conversation = ai_messenger.conversation_to_str()
+
+        self.assertEqual(ai_cat.Reasoning.ON, ai_client.reasoning)
+        self.assertEqual(2000, ai_client.options.max_tokens)
+        self.assertEqual(1500, ai_client.options.reasoning_budget)
+        self.assertIn("Reasoning: 1500\n", conversation)
+        self.assertIn("Max tokens: 2000\n", conversation)
+
+        ai_messenger.set_reasoning("high")
+
+        self.assertEqual("high", ai_messenger.get_reasoning())
+
+        with self.assertRaises(ValueError):
+            ai_messenger.set_reasoning("-1")
+
+        with self.assertRaises(ValueError):
+            ai_messenger.set_max_tokens(-1)
+
+        ai_messenger.set_reasoning("3000")
+
+        with self.assertRaises(ValueError):
+            list(ai_messenger.ask("And what is the question?"))
+
+    def test_max_tokens_is_validated_against_the_limit_of_the_model(self):
+        class LimitedAiClient(FakeAiClient):
+            def get_output_token_limit(self, model):
+                return 1000 if model == "model1" else None
+
+        ai_client = LimitedAiClient([[], []])
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+        ai_messenger.set_model("fake/model1")
+        ai_messenger.set_max_tokens(2000)
+
+        with self.assertRaisesRegex(ValueError, "must not exceed 1000"):
+            list(ai_messenger.ask("What is The Answer?"))
+
+        ai_messenger.set_model("fake/model2")
+        list(ai_messenger.ask("What is The Answer?"))
+
+        self.assertEqual(2000, ai_client.options.max_tokens)
+
+    def test_comparison_sends_the_question_to_all_models_at_the_same_time(self):
+        class SlowAiClient(FakeAiClient):
+            def list_models(self):
+                return ["model1", "model2", "model3"]
+
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                time.sleep(0.2)
+
+                if model == "model3":
+                    raise ai_cat.HttpError(400, "Bad Request", "")
+
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text=f"{model}: 42.")
+                yield from ai_cat.AiClient.compile_status({"usage.output_tokens": 3})
+
+        ai_client = SlowAiClient([])
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+        ai_messenger.set_model("fake/model1")
+        ai_messenger.set_compare("fake/model2, fake/model3")
+
+        start_time = time.monotonic()
+        list(ai_messenger.ask("What is The Answer?"))
+        elapsed = time.monotonic() - start_time
+        conversation = ai_messenger.conversation_to_str()
+
+        self.assertLess(elapsed, 0.5)
+        self.assertIn("Compare: fake/model2, fake/model3\n", conversation)
+        self.assertIn("# === AI ===\n\nmodel1: 42.\n", conversation)
+        self.assertIn("# === AI ===\n\nmodel2: 42.\n", conversation)
+        self.assertLess(conversation.index("model1: 42."), conversation.index("model2: 42."))
+        self.assertIn("compare.model: fake/model2\n", conversation)
+        self.assertIn("compare.model: fake/model3\nerror: HttpError", conversation)
+        self.assertEqual(2, conversation.count("usage.output_tokens: 3\n"))
+        self.assertEqual(2, conversation.count("compare.seconds: "))
+
+        with self.assertRaises(ValueError):
+            ai_messenger.set_compare("fake/model4")
+
+    def test_map_reduce_splits_long_input_and_caches_partial_answers(self):
+        class MapReduceAiClient(FakeAiClient):
+            def __init__(self, failing_part=None, truncated_part=None):
+                super().__init__([])
+
+                self.failing_part = failing_part
+                self.truncated_part = truncated_part
+                self.requests = []
+                self.lock = threading.Lock()
+
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                text = conversation[-1].text
+                part = None
+
+                with self.lock:
+                    self.requests.append(text)
+
+                if "Combine the partial answers" in text:
+                    answer = "Total: " + ", ".join(re.findall(r"Words: \d+", text))
+
+                else:
+                    part = int(re.search(r"=== BEGIN PART (\d+) OF", text).group(1))
+
+                    if part == self.failing_part:
+                        raise ai_cat.HttpError(500, "Internal Server Error", "")
+
+                    answer = f"Words: {len(text.split())}"
+
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text=answer)
+
+                if part is not None and part == self.truncated_part:
+                    yield from ai_cat.AiClient.compile_status({"stop_reason": "max_tokens"})
+
+        def create_messenger(ai_client, cache_dir):
+            return ai_cat.AiMessenger(
+                {"fake": ai_client},
+                [f"fake/{model}" for model in ai_client.list_models()],
+                system_prompt="Please act as a helpful AI assistant.",
+                response_cache=ai_cat.ResponseCache(cache_dir),
+            )
+
+        paragraphs = [
+            " ".join(f"word{i}" for i in range(150)),
+            "```\n" + "\n\n".join(f"line{i}" for i in range(100)) + "\n```",
+            " ".join(f"word{i}" for i in range(150)),
+        ]
+        conversation = """\
+# === Settings ===
+
+Map reduce: 300
+Cache: on
+
+# === User ===
+
+Count the words.
+
+""" + "\n\n".join(paragraphs) + "\n"
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            ai_client = MapReduceAiClient(failing_part=2, truncated_part=3)
+            ai_messenger = create_messenger(ai_client, cache_dir)
+
+            with self.assertRaises(ai_cat.HttpError):
+                list(ai_messenger.ask("", lambda conversation_text: conversation))
+
+            self.assertEqual(3, len(ai_client.requests))
+            self.assertTrue(any("line0\n\nline1" in text for text in ai_client.requests))
+            self.assertTrue(all(text.startswith("The input that") for text in ai_client.requests))
+
+            ai_client = MapReduceAiClient()
+            ai_messenger = create_messenger(ai_client, cache_dir)
+            list(ai_messenger.ask("", lambda conversation_text: conversation))
+            result = ai_messenger.conversation_to_str()
+
+        self.assertEqual(3, len(ai_client.requests))
         self.assertEqual(
-            [
-                ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="System 2"),
-                ai_cat.Message(type=ai_cat.MessageType.USER, text="User 1"),
-                ai_cat.Message(type=ai_cat.MessageType.USER, text="User 2"),
-                ai_cat.Message(type=ai_cat.MessageType.AI, text="AI 1"),
-                ai_cat.Message(type=ai_cat.MessageType.AI, text="AI 2"),
-                ai_cat.Message(type=ai_cat.MessageType.USER, text="User 3"),
-            ],
-            ai_client.conversation,
+            ["=== BEGIN PART 2 OF 3 ===", "=== BEGIN PART 3 OF 3 ==="],
+            sorted(re.search(r"=== BEGIN PART . OF 3 ===", text)[0] for text in ai_client.requests[:2]),
         )
-        self.assertEqual(expected_conversation, ai_messenger.conversation_to_str())
+        self.assertIn("Combine the partial answers", ai_client.requests[2])
+        self.assertIn("# === AI ===\n\nTotal: Words: ", result)
+        self.assertIn("map_reduce.chunks: 3\n", result)
+        self.assertIn("map_reduce.cached_chunks: 1\n", result)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            ai_client = MapReduceAiClient(failing_part=2)
+            ai_messenger = create_messenger(ai_client, cache_dir)
+
+            with self.assertRaises(ai_cat.HttpError):
+                list(
+                    ai_messenger.ask(
+                        "",
+                        lambda conversation_text: conversation.replace("Cache: on\n", ""),
+                    )
+                )
+
+            self.assertEqual([], os.listdir(cache_dir))
+
+        with self.assertRaises(ValueError):
+            ai_messenger.set_map_reduce("10")
+
+    def test_cascade_escalates_until_a_model_produces_a_replacement(self):
+        class CascadeAiClient(FakeAiClient):
+            def __init__(self):
+                super().__init__([])
+
+                self.models = []
+
+            def list_models(self):
+                return ["cheap", "failing", "large"]
+
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                self.models.append(model)
+
+                if model == "failing":
+                    raise ai_cat.HttpError(500, "Internal Server Error", "")
+
+                if model == "cheap":
+                    text = "What do you mean?"
+
+                else:
+                    text = "--- BEGIN REPLACEMENT ---\n42\n--- END REPLACEMENT ---"
+
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text=text)
+                yield from ai_cat.AiClient.compile_status({"usage.output_tokens": len(text)})
+
+        ai_client = CascadeAiClient()
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+        ai_messenger.set_model("fake/large")
+        ai_messenger.set_cascade("fake/cheap, fake/failing, fake/large")
+        ai_messenger.set_cascade_deadline(5.0)
+
+        replacement = ai_cat.ask_for_replacement_with_cascade(
+            ai_messenger,
+            "# === User ===\n\nWhat is The Answer?\n",
+        )
+        conversation = ai_messenger.conversation_to_str()
+
+        self.assertEqual("42", replacement)
+        self.assertEqual(["cheap", "failing", "large"], ai_client.models)
+        self.assertEqual("fake/large", ai_messenger.get_model())
+        self.assertEqual(0.0, ai_messenger.get_total_timeout())
+        self.assertNotIn("What do you mean?", conversation)
+        self.assertIn("cascade.1.model: fake/cheap\n", conversation)
+        self.assertIn("cascade.1.result: no replacement\n", conversation)
+        self.assertIn("cascade.1.usage.output_tokens: 17\n", conversation)
+        self.assertIn("cascade.2.result: error: HttpError", conversation)
+        self.assertIn("cascade.3.model: fake/large\n", conversation)
+        self.assertIn("cascade.3.result: replacement\n", conversation)
+        self.assertIn("cascade.3.seconds: ", conversation)
+
+        with self.assertRaises(ValueError):
+            ai_messenger.set_cascade("fake/unknown")
+
+    def test_split_into_chunks(self):
+        text = "aaaa aaaa\n\n```\nbbbb\n\nbbbb\n```\n\n" + "c" * 30
+
+        self.assertEqual(
+            ["aaaa aaaa", "```\nbbbb\n\nbbbb\n```", "c" * 20, "c" * 10],
+            ai_cat.split_into_chunks(text, 5),
+        )
+        self.assertEqual(
+            ["aaaa aaaa\n\n```\nbbbb\n\nbbbb\n```"],
+            ai_cat.split_into_chunks("aaaa aaaa\n\n```\nbbbb\n\nbbbb\n```", 10),
+        )
+
+        # Indented fences are not fences for the conversation parser either.
+        self.assertEqual(
+            ["aaaa", "  ```", "bbbb", "cccc"],
+            ai_cat.split_into_chunks("aaaa\n\n  ```\n\nbbbb\n\ncccc", 2),
+        )
+
+    def test_compared_responses_are_cached_for_the_original_conversation(self):
+        class CountingAiClient(FakeAiClient):
+            def __init__(self):
+                super().__init__([])
+
+                self.models = []
+
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                self.models.append(model)
+
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text=f"{model}: 42.")
+
+        conversation = """\
+# === Settings ===
+
+Model: fake/model1
+Compare: fake/model2
+Cache: on
+
+# === User ===
+
+What is The Answer?
+"""
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            ai_client = CountingAiClient()
+            ai_messenger = ai_cat.AiMessenger(
+                {"fake": ai_client},
+                [f"fake/{model}" for model in ai_client.list_models()],
+                system_prompt="Please act as a helpful AI assistant.",
+                response_cache=ai_cat.ResponseCache(cache_dir),
+            )
+            list(ai_messenger.ask("", lambda conversation_text: conversation))
+
+            self.assertEqual(["model1", "model2"], sorted(ai_client.models))
+
+            ai_client = CountingAiClient()
+            ai_messenger = ai_cat.AiMessenger(
+                {"fake": ai_client},
+                [f"fake/{model}" for model in ai_client.list_models()],
+                system_prompt="Please act as a helpful AI assistant.",
+                response_cache=ai_cat.ResponseCache(cache_dir),
+            )
+            list(
+                ai_messenger.ask(
+                    "",
+                    lambda conversation_text: conversation.replace(
+                        "Model: fake/model1\nCompare: fake/model2\n",
+                        "Model: fake/model2\n",
+                    ),
+                )
+            )
+            result = ai_messenger.conversation_to_str()
+
+        self.assertEqual([], ai_client.models)
+        self.assertIn("# === AI ===\n\nmodel2: 42.\n", result)
+        self.assertIn("response_cache: hit ", result)
+
+    def test_continue_requires_an_ai_response(self):
+        ai_messenger, ai_client = self.create_messenger([])
+
+        with self.assertRaises(ValueError):
+            list(ai_messenger.continue_response())
+
+    def test_partial_response_is_kept_when_interrupted_by_user(self):
+        class EndlessAiClient(FakeAiClient):
+            def __init__(self):
+                super().__init__([])
+
+                self.context = None
+
+            def _respond(self, model, conversation, temperature, reasoning, options, streaming):
+                self.context = ai_cat.RequestContext.get_current()
+
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=True, is_status=False, text="Thinking...")
+                yield ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="The Answer is")
+
+                while not self.context.is_cancelled:
+                    time.sleep(0.01)
+
+        ai_client = EndlessAiClient()
+        ai_messenger = ai_cat.AiMessenger(
+            {"fake": ai_client},
+            [f"fake/{model}" for model in ai_client.list_models()],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+        printed = []
+
+        def print_chunk(chunk):
+            printed.append(chunk)
+
+            if chunk == "The Answer is":
+                raise KeyboardInterrupt()
+
+        ai_cat.print_response(
+            ai_messenger.ask("What is The Answer?"),
+            print_chunk,
+        )
+        conversation = ai_messenger.conversation_to_str()
+
+        self.assertTrue(ai_client.context.is_cancelled)
+        self.assertIn("The Answer is", printed)
+        self.assertIn("# === AI Reasoning ===\n\nThinking...\n", conversation)
+        self.assertIn("# === AI ===\n\nThe Answer is\n", conversation)
+        self.assertIn("stop_reason: interrupted by user\nincomplete: True\n", conversation)
+
+    def test_parsing_keeps_blocks_boundaries_as_they_were_supplied_except_for_multiple_system_prompts(self):
+        conversation = """\
+# === System ===
+
+System 2
+
+
+# === Settings ===
+
+Model: fake/model1
+
+
+# === Settings ===
+
+Model: fake/model2
+
+
+# === User ===
+
+User 1
+
+
+# === User ===
+
+User 2
+
+
+# === AI Reasoning ===
+
+Reasoning 1
+
+
+# === AI Reasoning ===
+
+Reasoning 2
+
+
+# === AI ===
+
+AI 1
+
+
+# === AI ===
+
+AI 2
+
+
+# === AI Status ===
+
+Status 1
+
+
+# === AI Status ===
+
+Status 2
+
+
+# === User ===
+
+User 3
+"""
+        edited_conversation = f"""
+# === System ===
+
+System 1
+
+
+# === Notes ===
+
+Note 1
+
+
+# === Notes ===
+
+Note 2
+
+
+{conversation}\
+"""
+
+        ai_messenger, ai_client, response_chunks = self.ask(
+            conversation,
+            [
+                [
+                    ai_cat.AiResponse(is_delta=False, is_reasoning=False, is_status=False, text="AI 3"),
+                ],
+            ],
+        )
+
+        expected_conversation = self.NOTES + "\n\n" + conversation + """
+
+# === AI ===
+
+AI 3
+"""
+
+        self.assertEqual("model2", ai_client.model)
+        self.assertEqual(
+            [
+                ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="System 2"),
+                ai_cat.Message(type=ai_cat.MessageType.USER, text="User 1"),
+                ai_cat.Message(type=ai_cat.MessageType.USER, text="User 2"),
+                ai_cat.Message(type=ai_cat.MessageType.AI, text="AI 1"),
+                ai_cat.Message(type=ai_cat.MessageType.AI, text="AI 2"),
+                ai_cat.Message(type=ai_cat.MessageType.USER, text="User 3"),
+            ],
+            ai_client.conversation,
+        )
+        self.assertEqual(expected_conversation, ai_messenger.conversation_to_str())
+
+
+class TestCodeIndex(unittest.TestCase):
+    FILES = {
+        "geometry.py": """\
+def rectangle_area(width, height):
+    return width * height
+
+
+def circle_area(radius):
+    return 3.14159 * radius * radius
+""",
+        "shop/cart.py": """\
+class ShoppingCart:
+    def __init__(self):
+        self.items = []
+
+    def add_item(self, item):
+        self.items.append(item)
+""",
+        "notes.txt": "Nothing to see here.\n",
+        "image.bin": "\0\1\2 binary shoppingcart",
+    }
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root_dir = self.tmp_dir.name
+
+        for path, text in self.FILES.items():
+            self.write_file(path, text)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_file(self, path: str, text: str):
+        abs_path = os.path.join(self.root_dir, *path.split("/"))
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+
+        with open(abs_path, "w") as f:
+            f.write(text)
+
+    def test_tokenizer_splits_compound_identifiers(self):
+        self.assertEqual(
+            ["shoppingcart", "shopping", "cart", "add_item", "add", "item", "42"],
+            list(ai_cat.CodeIndex.tokenize("ShoppingCart.add_item(42, x)")),
+        )
+
+    def test_search_ranks_matching_chunks_first(self):
+        with ai_cat.CodeIndex(self.root_dir) as code_index:
+            self.assertEqual((3, 0, 0), code_index.update())
+
+            snippets = code_index.search("cart.add_item(book)", 10)
+
+        self.assertEqual("shop/cart.py", snippets[0].path)
+        self.assertEqual(1, snippets[0].first_line)
+        self.assertEqual(6, snippets[0].last_line)
+        self.assertNotIn("image.bin", [snippet.path for snippet in snippets])
+
+    def test_update_is_incremental(self):
+        with ai_cat.CodeIndex(self.root_dir) as code_index:
+            code_index.update()
+
+        self.write_file("geometry.py", "def triangle_area(base, height):\n    pass\n")
+        os.remove(os.path.join(self.root_dir, "notes.txt"))
+
+        with ai_cat.CodeIndex(self.root_dir) as code_index:
+            self.assertEqual((0, 1, 1), code_index.update())
+            self.assertEqual((0, 0, 0), code_index.update())
+            self.assertEqual([], code_index.search("circle radius", 10))
+            self.assertEqual(
+                "geometry.py",
+                code_index.search("triangle", 10)[0].path,
+            )
+
+    def test_hidden_and_ignored_files_are_not_indexed(self):
+        self.write_file(".env", "API_KEY=secretvalue\n")
+        self.write_file(".config/settings.txt", "secretvalue\n")
+        self.write_file(".gitignore", "secrets/\n*.log\n!keep.log\n/build\n")
+        self.write_file("secrets/key.txt", "secretvalue\n")
+        self.write_file("debug.log", "secretvalue\n")
+        self.write_file("keep.log", "keepvalue\n")
+        self.write_file("build/output.txt", "secretvalue\n")
+        self.write_file("shop/build/output.py", "buildvalue\n")
+        self.write_file("shop/.gitignore", "*.txt\n")
+        self.write_file("shop/readme.txt", "secretvalue\n")
+
+        with ai_cat.CodeIndex(self.root_dir) as code_index:
+            self.assertEqual((5, 0, 0), code_index.update())
+            self.assertEqual([], code_index.search("secretvalue", 10))
+            self.assertEqual(
+                "keep.log",
+                code_index.search("keepvalue", 10)[0].path,
+            )
+            self.assertEqual(
+                "shop/build/output.py",
+                code_index.search("buildvalue", 10)[0].path,
+            )
+
+    def test_file_which_becomes_binary_is_removed_from_the_index(self):
+        with ai_cat.CodeIndex(self.root_dir) as code_index:
+            code_index.update()
+
+        self.write_file("notes.txt", "\0\1\2 binary nothing to see here")
+
+        with ai_cat.CodeIndex(self.root_dir) as code_index:
+            self.assertEqual((0, 0, 1), code_index.update())
+            self.assertEqual([], code_index.search("nothing", 10))
+
+    def test_replace_context_excludes_the_selection(self):
+        with ai_cat.CodeIndex(self.root_dir) as code_index:
+            code_index.update()
+
+        selection = "def circle_area(radius):\n    return 3.14159 * radius * radius"
+        context = ai_cat.build_replace_context(
+            os.path.join(self.root_dir, "shop", "new.py"),
+            "cart = ShoppingCart()\n# TODO: add an item",
+            1000,
+        )
+        selection_context = ai_cat.build_replace_context(
+            os.path.join(self.root_dir, "geometry.py"),
+            selection,
+            1000,
+        )
+        disabled_context = ai_cat.build_replace_context(
+            os.path.join(self.root_dir, "shop", "new.py"),
+            "cart = ShoppingCart()\n# TODO: add an item",
+            0,
+        )
+
+        self.assertIn("`shop/cart.py` (lines 1-6):", context)
+        self.assertIn("class ShoppingCart:", context)
+        self.assertEqual("", selection_context)
+        self.assertEqual("", disabled_context)
+
+
+class TestAnthropicClient(unittest.TestCase):
+    @staticmethod
+    def conversation_types(num_turns: int) -> typing.List[ai_cat.MessageType]:
+        return (
+            [ai_cat.MessageType.USER, ai_cat.MessageType.AI] * num_turns
+            + [ai_cat.MessageType.USER]
+        )
+
+    def test_short_conversation_has_only_tail_breakpoint(self):
+        self.assertEqual(
+            (set(), {2}),
+            ai_cat.AnthropicClient.plan_cache_breakpoints(self.conversation_types(1), True),
+        )
+
+    def test_long_conversation_has_stable_breakpoints(self):
+        plan = ai_cat.AnthropicClient.plan_cache_breakpoints
+
+        self.assertEqual(({31, 15}, {40}), plan(self.conversation_types(20), True))
+        self.assertEqual(({31, 15}, {42}), plan(self.conversation_types(21), True))
+        self.assertEqual(({47, 31, 15}, {48}), plan(self.conversation_types(24), False))
+
+    def test_previous_turn_is_marked_when_lookback_cannot_reach_it(self):
+        message_types = (
+            self.conversation_types(3)
+            + [ai_cat.MessageType.AI]
+            + [ai_cat.MessageType.USER] * 25
+        )
+
+        self.assertEqual(
+            (set(), {6, 32}),
+            ai_cat.AnthropicClient.plan_cache_breakpoints(message_types, True),
+        )
+
+    def test_cache_ttl_depends_on_the_time_since_the_last_request(self):
+        choose = ai_cat.AnthropicClient.choose_cache_ttl
+
+        self.assertEqual("5m", choose(None))
+        self.assertEqual("5m", choose(60.0))
+        self.assertEqual("1h", choose(15 * 60.0))
+        self.assertEqual("5m", choose(3 * 60 * 60.0))
+
+
+    def test_thinking_budget_fits_into_max_tokens(self):
+        conversation = [ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?")]
+        anthropic_client = ai_cat.AnthropicClient("api-key")
+
+        def build_body(reasoning, max_tokens=0, reasoning_budget=0):
+            options = ai_cat.RequestOptions(max_tokens=max_tokens, reasoning_budget=reasoning_budget)
+
+            return json.loads(
+                anthropic_client._build_request("claude", conversation, 1.0, reasoning, False, options)[1]
+            )
+
+        body = build_body(ai_cat.Reasoning.DEFAULT)
+        self.assertEqual(32000, body["max_tokens"])
+        self.assertNotIn("thinking", body)
+
+        body = build_body(ai_cat.Reasoning.ON)
+        self.assertEqual({"type": "enabled", "budget_tokens": 16000}, body["thinking"])
+
+        body = build_body(ai_cat.Reasoning.LOW, max_tokens=4000)
+        self.assertEqual(4000, body["max_tokens"])
+        self.assertEqual({"type": "enabled", "budget_tokens": 2048}, body["thinking"])
+
+        body = build_body(ai_cat.Reasoning.HIGH, max_tokens=4000)
+        self.assertEqual({"type": "enabled", "budget_tokens": 3999}, body["thinking"])
+
+        body = build_body(ai_cat.Reasoning.ON, reasoning_budget=5000)
+        self.assertEqual({"type": "enabled", "budget_tokens": 5000}, body["thinking"])
+
+        body = build_body(ai_cat.Reasoning.ON, max_tokens=1024)
+        self.assertEqual(1024, body["max_tokens"])
+        self.assertNotIn("thinking", body)
+
+    def test_max_tokens_must_leave_room_for_thinking(self):
+        ai_messenger = ai_cat.AiMessenger(
+            {"anthropic": ai_cat.AnthropicClient("api-key")},
+            ["anthropic/claude"],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+        ai_messenger.set_max_tokens(1000)
+        ai_messenger.set_reasoning("on")
+
+        with self.assertRaisesRegex(ValueError, "greater than 1024"):
+            list(ai_messenger.ask("What is The Answer?"))
+
+
+class TestPromptCacheKey(unittest.TestCase):
+    def test_prompt_cache_key_is_stable_during_a_conversation(self):
+        turn_1 = [
+            ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="System prompt."),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="What is a question?"),
+        ]
+        turn_2 = turn_1 + [
+            ai_cat.Message(type=ai_cat.MessageType.AI, text="A sentence seeking an answer."),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="And what is The Answer?"),
+        ]
+        other = [
+            ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="Other system prompt."),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="What is a question?"),
+        ]
+        openai_client = ai_cat.OpenAiClient("api-key")
+        xai_client = ai_cat.XAiClient("api-key")
+
+        body_1 = json.loads(
+            openai_client._build_request("gpt", turn_1, 1.0, ai_cat.Reasoning.DEFAULT, False)[1]
+        )
+        body_2 = json.loads(
+            openai_client._build_request("gpt", turn_2, 1.0, ai_cat.Reasoning.DEFAULT, False)[1]
+        )
+        headers = xai_client._build_request("grok", turn_2, 1.0, ai_cat.Reasoning.DEFAULT, True)[0]
+
+        self.assertTrue(body_1["prompt_cache_key"].startswith("ai-cat-"))
+        self.assertEqual(body_1["prompt_cache_key"], body_2["prompt_cache_key"])
+        self.assertEqual(body_1["prompt_cache_key"], headers["x-grok-conv-id"])
+        self.assertNotEqual(
+            body_1["prompt_cache_key"],
+            ai_cat.AiClient.derive_prompt_cache_key(other),
+        )
+
+
+class TestReasoningSettings(unittest.TestCase):
+    CONVERSATION = [ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?")]
+
+    def test_reasoning_levels_are_mapped_to_efforts(self):
+        openai_client = ai_cat.OpenAiClient("api-key")
+
+        def build_body(reasoning, options=None):
+            return json.loads(
+                openai_client._build_request("gpt", self.CONVERSATION, 1.0, reasoning, False, options)[1]
+            )
+
+        self.assertNotIn("reasoning", build_body(ai_cat.Reasoning.DEFAULT))
+        self.assertEqual({"effort": "medium"}, build_body(ai_cat.Reasoning.ON)["reasoning"])
+        self.assertEqual({"effort": "low"}, build_body(ai_cat.Reasoning.LOW)["reasoning"])
+        self.assertEqual({"effort": "high"}, build_body(ai_cat.Reasoning.HIGH)["reasoning"])
+
+        body = build_body(ai_cat.Reasoning.ON, ai_cat.RequestOptions(max_tokens=1000, reasoning_budget=5000))
+        self.assertEqual({"effort": "medium"}, body["reasoning"])
+        self.assertEqual(1000, body["max_output_tokens"])
+
+        body = build_body(ai_cat.Reasoning.ON, ai_cat.RequestOptions(reasoning_budget=100000))
+        self.assertEqual({"effort": "high"}, body["reasoning"])
+
+    def test_reasoning_levels_are_mapped_to_thinking_budgets(self):
+        google_client = ai_cat.GoogleClient("api-key")
+
+        def build_generation_config(reasoning, options=None):
+            return json.loads(
+                google_client._build_request_body(self.CONVERSATION, 1.0, reasoning, options=options)
+            )["generationConfig"]
+
+        self.assertEqual(
+            {"includeThoughts": True},
+            build_generation_config(ai_cat.Reasoning.ON)["thinkingConfig"],
+        )
+        self.assertEqual(
+            {"includeThoughts": True, "thinkingBudget": 8192},
+            build_generation_config(ai_cat.Reasoning.MEDIUM)["thinkingConfig"],
+        )
+
+        generation_config = build_generation_config(
+            ai_cat.Reasoning.ON,
+            ai_cat.RequestOptions(max_tokens=2000, reasoning_budget=1000),
+        )
+        self.assertEqual(
+            {"includeThoughts": True, "thinkingBudget": 1000},
+            generation_config["thinkingConfig"],
+        )
+        self.assertEqual(2000, generation_config["maxOutputTokens"])
+
+
+class TestServiceTier(unittest.TestCase):
+    def test_tier_is_mapped_to_service_tier_where_supported(self):
+        conversation = [ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?")]
+        clients = {
+            "anthropic": ai_cat.AnthropicClient("api-key"),
+            "mistral": ai_cat.MistralClient("api-key"),
+            "openai": ai_cat.OpenAiClient("api-key"),
+        }
+
+        def get_service_tier(provider, tier):
+            options = ai_cat.RequestOptions(tier=tier)
+            body = json.loads(
+                clients[provider]._build_request("model", conversation, 1.0, ai_cat.Reasoning.DEFAULT, False, options)[1]
+            )
+
+            return body.get("service_tier")
+
+        self.assertIsNone(get_service_tier("openai", ai_cat.Tier.DEFAULT))
+        self.assertEqual("priority", get_service_tier("openai", ai_cat.Tier.PRIORITY))
+        self.assertEqual("flex", get_service_tier("openai", ai_cat.Tier.FLEX))
+        self.assertEqual("default", get_service_tier("openai", ai_cat.Tier.STANDARD))
+        self.assertIsNone(get_service_tier("anthropic", ai_cat.Tier.DEFAULT))
+        self.assertEqual("auto", get_service_tier("anthropic", ai_cat.Tier.PRIORITY))
+        self.assertEqual("standard_only", get_service_tier("anthropic", ai_cat.Tier.FLEX))
+        self.assertIsNone(get_service_tier("mistral", ai_cat.Tier.PRIORITY))
+
+    def test_tier_setting_is_passed_to_the_client(self):
+        ai_messenger, ai_client, response_chunks = TestAiMessenger.ask(
+            """\
+# === Settings ===
+
+Tier: flex
+
+# === User ===
+
+What is The Answer?
+""",
+            [[ai_cat.AiResponse(is_delta=True, is_reasoning=False, is_status=False, text="42.")]],
+        )
+
+        self.assertEqual(ai_cat.Tier.FLEX, ai_client.options.tier)
+        self.assertEqual("flex", ai_messenger.get_tier())
+        self.assertIn("Tier: flex\n", ai_messenger.conversation_to_str())
+
+        with self.assertRaises(ValueError):
+            ai_messenger.set_tier("economy")
+
+
+class FakeAnthropicBatchServer(http.server.ThreadingHTTPServer):
+    """
+    A local stand-in for the Message Batches API of Anthropic.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+            if not self.path.endswith("/batches"):
+                self.server.live_requests.append(body)
+                self.send_response(500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+                return
+
+            self.server.submitted.append(body["requests"])
+            self.server.submitted_headers.append(self.headers)
+            self._send_json({"id": f"msgbatch_{len(self.server.submitted)}", "processing_status": "in_progress"})
+
+        def do_GET(self):
+            batch_id = self.path.rsplit("/", 1)[-1]
+            requests = self.server.submitted[int(batch_id.split("_")[1]) - 1]
+
+            if self.path.startswith("/results/"):
+                lines = [
+                    json.dumps(
+                        {
+                            "custom_id": request["custom_id"],
+                            "result": {
+                                "type": "succeeded",
+                                "message": {
+                                    "content": [
+                                        {
+                                            "type": "text",
+                                            "text": "Re: " + request["params"]["messages"][-1]["content"][-1]["text"],
+                                        },
+                                    ],
+                                    "stop_reason": self.server.stop_reason,
+                                },
+                            },
+                        }
+                    )
+                    for request in requests
+                ]
+                self._send(("\n".join(lines) + "\n").encode("utf-8"))
+
+                return
+
+            self._send_json(
+                {
+                    "id": batch_id,
+                    "processing_status": "ended" if self.server.is_ended else "in_progress",
+                    "results_url": self.server.url + "/results/" + batch_id,
+                }
+            )
+
+        def _send_json(self, data):
+            self._send(json.dumps(data).encode("utf-8"))
+
+        def _send(self, body):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), self.Handler)
+
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.submitted = []
+        self.submitted_headers = []
+        self.live_requests = []
+        self.is_ended = False
+        self.stop_reason = "end_turn"
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeAnthropicBatchServer()
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+
+        self.ai_client = ai_cat.AnthropicClient("api-key")
+        self.ai_client.URL_CHAT = self.server.url + "/v1/messages"
+        self.ai_client.URL_BATCHES = self.server.url + "/v1/messages/batches"
+        self.ai_clients = {"anthropic": self.ai_client}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_messenger(self):
+        return ai_cat.AiMessenger(
+            self.ai_clients,
+            ["anthropic/claude"],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+
+    def test_conversations_are_answered_via_batch_api_and_can_be_resumed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = {
+                "question1.md": "# === User ===\n\nWhat is The Answer?\n",
+                "question2.md": "# === User ===\n\nWhat is The Question?\n",
+                "answered.md": "# === User ===\n\nWhat is 6 * 7?\n\n# === AI ===\n\n42.\n",
+                "notes.txt": "# === User ===\n\nIgnore me.\n",
+            }
+
+            for file_name, text in files.items():
+                with open(os.path.join(directory, file_name), "w", encoding="utf-8") as f:
+                    f.write(text)
+
+            exit_code = ai_cat.cmd_batch(self.create_messenger, self.ai_clients, directory, wait=False)
+
+            self.assertEqual(0, exit_code)
+            self.assertEqual(1, len(self.server.submitted))
+            self.assertEqual(2, len(self.server.submitted[0]))
+            self.assertNotIn("stream", self.server.submitted[0][0]["params"])
+            self.assertTrue(os.path.exists(os.path.join(directory, ai_cat.BATCH_STATE_FILE_NAME)))
+
+            with open(os.path.join(directory, "question1.md"), "r", encoding="utf-8") as f:
+                self.assertEqual(files["question1.md"], f.read())
+
+            self.server.is_ended = True
+
+            exit_code = ai_cat.cmd_batch(self.create_messenger, self.ai_clients, directory, wait=False)
+
+            self.assertEqual(0, exit_code)
+            self.assertEqual(1, len(self.server.submitted))
+            self.assertFalse(os.path.exists(os.path.join(directory, ai_cat.BATCH_STATE_FILE_NAME)))
+
+            with open(os.path.join(directory, "question1.md"), "r", encoding="utf-8") as f:
+                question1 = f.read()
+
+            with open(os.path.join(directory, "question2.md"), "r", encoding="utf-8") as f:
+                question2 = f.read()
+
+            with open(os.path.join(directory, "answered.md"), "r", encoding="utf-8") as f:
+                answered = f.read()
+
+            self.assertIn("# === AI ===\n\nRe: What is The Answer?\n", question1)
+            self.assertIn("# === AI ===\n\nRe: What is The Question?\n", question2)
+            self.assertIn("stop_reason: end_turn", question1)
+            self.assertEqual(files["answered.md"], answered)
+
+    def test_batch_uses_the_same_headers_as_live_requests_without_affecting_cache_timing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "question.md"), "w", encoding="utf-8") as f:
+                f.write("# === User ===\n\nWhat is The Answer?\n")
+
+            ai_cat.cmd_batch(self.create_messenger, self.ai_clients, directory, wait=False)
+
+            live_headers, _ = self.ai_client._build_request(
+                "claude",
+                [ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?")],
+                1.0,
+                ai_cat.Reasoning.DEFAULT,
+                stream=False,
+            )
+            batch_headers = self.server.submitted_headers[0]
+            params = self.server.submitted[0][0]["params"]
+
+            for name, value in live_headers.items():
+                self.assertEqual(value, batch_headers.get(name), name)
+
+            self.assertEqual("1h", params["system"][0]["cache_control"]["ttl"])
+
+            ai_client = ai_cat.AnthropicClient("api-key")
+            ai_client.URL_BATCHES = self.ai_client.URL_BATCHES
+            ai_client.submit_batch(
+                [
+                    ai_cat.BatchRequest(
+                        custom_id="question",
+                        model="claude",
+                        conversation=[ai_cat.Message(type=ai_cat.MessageType.USER, text="Hello")],
+                        temperature=1.0,
+                        reasoning=ai_cat.Reasoning.DEFAULT,
+                        options=ai_cat.RequestOptions(),
+                    ),
+                ]
+            )
+
+            self.assertIsNone(ai_client._last_request_time)
+
+    def test_truncated_batch_results_are_written_back_without_continuation(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, "question.md")
+
+            with open(file_name, "w", encoding="utf-8") as f:
+                f.write("# === User ===\n\nWhat is The Answer?\n")
+
+            ai_cat.cmd_batch(self.create_messenger, self.ai_clients, directory, wait=False)
+
+            self.server.is_ended = True
+            self.server.stop_reason = "max_tokens"
+
+            exit_code = ai_cat.cmd_batch(self.create_messenger, self.ai_clients, directory, wait=False)
+
+            self.assertEqual(0, exit_code)
+            self.assertEqual([], self.server.live_requests)
+
+            with open(file_name, "r", encoding="utf-8") as f:
+                question = f.read()
+
+            self.assertIn("# === AI ===\n\nRe: What is The Answer?\n", question)
+            self.assertIn("stop_reason: max_tokens", question)
+            self.assertIn("incomplete: True", question)
+
+
+class FakeBatchServer(http.server.ThreadingHTTPServer):
+    """
+    A local stand-in for a batch API, answering the requests which are
+    passed to route() with a (status code, JSON or bytes) pair.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            self._respond(self.rfile.read(int(self.headers["Content-Length"])))
+
+        def do_GET(self):
+            self._respond(b"")
+
+        def _respond(self, body):
+            status_code, response = self.server.route(self.command, self.path, self.headers, body)
+
+            if not isinstance(response, bytes):
+                response = json.dumps(response).encode("utf-8")
+
+            self.send_response(status_code)
+            self.send_header("Content-Length", str(len(response)))
+            self.end_headers()
+            self.wfile.write(response)
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), self.Handler)
+
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.requests = []
+        self.is_ended = False
+
+    def route(self, method, path, headers, body):
+        raise NotImplementedError()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    @staticmethod
+    def answer_for(text):
+        """
+        Questions mentioning "fail" are rejected, others are echoed back.
+        """
+
+        if "fail" in text.lower():
+            return None
+
+        return "Re: " + text.strip()
+
+
+class FakeOpenAiBatchServer(FakeBatchServer):
+    """
+    A local stand-in for the Files and Batch APIs of OpenAI.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.files = {}
+        self.uploads = []
+        self.batches = {}
+        self.batch_error = None
+
+    def route(self, method, path, headers, body):
+        if method == "POST" and path == "/v1/files":
+            message = email.message_from_bytes(
+                b"Content-Type: " + headers["Content-Type"].encode("ascii") + b"\r\n\r\n" + body,
+                policy=email.policy.HTTP,
+            )
+            fields = {
+                part.get_param("name", header="content-disposition"): part
+                for part in message.iter_parts()
+            }
+            file_id = f"file-{len(self.files) + 1}"
+            self.files[file_id] = fields["file"].get_payload(decode=True)
+            self.uploads.append(
+                {
+                    "purpose": fields["purpose"].get_content().strip(),
+                    "filename": fields["file"].get_filename(),
+                    "lines": [
+                        json.loads(line)
+                        for line in self.files[file_id].decode("utf-8").splitlines()
+                    ],
+                }
+            )
+
+            return 200, {"id": file_id, "object": "file"}
+
+        if method == "POST" and path == "/v1/batches":
+            batch_id = f"batch_{len(self.batches) + 1}"
+            self.batches[batch_id] = json.loads(body)
+
+            return 200, {"id": batch_id, "status": "validating"}
+
+        if method == "GET" and path.startswith("/v1/batches/"):
+            batch_id = path.rsplit("/", 1)[-1]
+
+            if self.batch_error is not None:
+                return 200, {
+                    "id": batch_id,
+                    "status": "failed",
+                    "errors": {"data": [{"message": self.batch_error}]},
+                }
+
+            if not self.is_ended:
+                return 200, {"id": batch_id, "status": "in_progress"}
+
+            return 200, self._finish(batch_id)
+
+        if method == "GET" and path.startswith("/v1/files/") and path.endswith("/content"):
+            return 200, self.files[path.split("/")[3]]
+
+        return 404, {"error": {"message": f"Unexpected request: {method} {path}"}}
+
+    def _finish(self, batch_id):
+        output_lines = []
+        error_lines = []
+
+        for line in self.files[self.batches[batch_id]["input_file_id"]].decode("utf-8").splitlines():
+            request = json.loads(line)
+            answer = self.answer_for(request["body"]["input"][-1]["content"])
+
+            if answer is None:
+                error_lines.append(
+                    {
+                        "custom_id": request["custom_id"],
+                        "response": {
+                            "status_code": 400,
+                            "body": {"error": {"message": "The question was rejected."}},
+                        },
+                        "error": None,
+                    }
+                )
+
+                continue
+
+            output_lines.append(
+                {
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "id": "resp_" + request["custom_id"],
+                            "status": "completed",
+                            "output": [
+                                {
+                                    "type": "message",
+                                    "content": [{"type": "output_text", "text": answer}],
+                                },
+                            ],
+                        },
+                    },
+                    "error": None,
+                }
+            )
+
+        batch = {"id": batch_id, "status": "completed"}
+
+        for key, lines in (("output_file_id", output_lines), ("error_file_id", error_lines)):
+            if len(lines) > 0:
+                file_id = f"file-{len(self.files) + 1}"
+                self.files[file_id] = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+                batch[key] = file_id
+
+        return batch
+
+
+class FakeGoogleBatchServer(FakeBatchServer):
+    """
+    A local stand-in for the Batch Mode of the Gemini API.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.batches = {}
+        self.failed_state = None
+
+    def route(self, method, path, headers, body):
+        if method == "POST" and ":batchGenerateContent?key=api-key" in path:
+            name = f"batches/{len(self.batches) + 1}"
+            self.batches[name] = json.loads(body)
+
+            return 200, {"name": name, "metadata": {"state": "BATCH_STATE_PENDING"}}
+
+        if method == "GET" and path.startswith("/v1beta/batches/") and path.endswith("?key=api-key"):
+            name = path[len("/v1beta/"):-len("?key=api-key")]
+
+            if self.failed_state is not None:
+                return 200, {
+                    "name": name,
+                    "metadata": {"state": self.failed_state},
+                    "error": {"message": "The batch has expired."},
+                }
+
+            if not self.is_ended:
+                return 200, {"name": name, "metadata": {"state": "BATCH_STATE_RUNNING"}}
+
+            return 200, {
+                "name": name,
+                "metadata": {"state": "BATCH_STATE_SUCCEEDED"},
+                "response": {
+                    "inlinedResponses": {
+                        "inlinedResponses": [
+                            self._answer(request)
+                            for request in self.batches[name]["batch"]["input_config"]["requests"]["requests"]
+                        ],
+                    },
+                },
+            }
+
+        return 404, {"error": {"message": f"Unexpected request: {method} {path}"}}
+
+    def _answer(self, request):
+        answer = self.answer_for(request["request"]["contents"][-1]["parts"][-1]["text"])
+
+        if answer is None:
+            return {
+                "metadata": request["metadata"],
+                "error": {"code": 400, "message": "The question was rejected."},
+            }
+
+        return {
+            "metadata": request["metadata"],
+            "response": {
+                "candidates": [
+                    {
+                        "content": {"role": "model", "parts": [{"text": answer}]},
+                        "finishReason": "STOP",
+                    },
+                ],
+            },
+        }
+
+
+class ProviderBatchTestCase(unittest.TestCase):
+    """
+    Round trips of cmd_batch() against the stand-in server of a provider.
+    """
+
+    MODEL = ""
+    FILES = {
+        "question1.md": "# === User ===\n\nWhat is The Answer?\n",
+        "question2.md": "# === User ===\n\nPlease fail.\n",
+    }
+
+    def create_server(self):
+        raise NotImplementedError()
+
+    def create_ai_client(self, server_url):
+        raise NotImplementedError()
+
+    def fail_batch(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.server = self.create_server()
+        self.server.start()
+
+        self.ai_clients = {self.MODEL.split("/", 1)[0]: self.create_ai_client(self.server.url)}
+
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = self.temp_dir.name
+
+        for file_name, text in self.FILES.items():
+            with open(os.path.join(self.directory, file_name), "w", encoding="utf-8") as f:
+                f.write(text)
+
+    def tearDown(self):
+        self.server.stop()
+        self.temp_dir.cleanup()
+
+    def create_messenger(self):
+        return ai_cat.AiMessenger(
+            self.ai_clients,
+            [self.MODEL],
+            system_prompt="Please act as a helpful AI assistant.",
+        )
+
+    def run_batch(self):
+        return ai_cat.cmd_batch(self.create_messenger, self.ai_clients, self.directory, wait=False)
+
+    def read_file(self, file_name):
+        with open(os.path.join(self.directory, file_name), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def assert_round_trip(self):
+        self.assertEqual(0, self.run_batch())
+        self.assertEqual(self.FILES["question1.md"], self.read_file("question1.md"))
+
+        self.server.is_ended = True
+
+        self.assertEqual(ai_cat.EXIT_CODE_ERROR, self.run_batch())
+        self.assertFalse(os.path.exists(os.path.join(self.directory, ai_cat.BATCH_STATE_FILE_NAME)))
+        self.assertIn("# === AI ===\n\nRe: What is The Answer?\n", self.read_file("question1.md"))
+        self.assertEqual(self.FILES["question2.md"], self.read_file("question2.md"))
+
+    def assert_failed_batch_leaves_the_files_untouched(self):
+        self.assertEqual(0, self.run_batch())
+
+        self.server.is_ended = True
+        self.fail_batch()
+
+        self.assertEqual(ai_cat.EXIT_CODE_ERROR, self.run_batch())
+        self.assertFalse(os.path.exists(os.path.join(self.directory, ai_cat.BATCH_STATE_FILE_NAME)))
+
+        for file_name, text in self.FILES.items():
+            self.assertEqual(text, self.read_file(file_name))
+
+
+class TestOpenAiBatch(ProviderBatchTestCase):
+    MODEL = "openai/gpt-4.1"
+
+    def create_server(self):
+        return FakeOpenAiBatchServer()
+
+    def create_ai_client(self, server_url):
+        ai_client = ai_cat.OpenAiClient("api-key")
+        ai_client.URL_FILES = server_url + "/v1/files"
+        ai_client.URL_BATCHES = server_url + "/v1/batches"
+
+        return ai_client
+
+    def test_conversations_are_uploaded_and_results_are_read_from_output_and_error_files(self):
+        self.assert_round_trip()
+
+        self.assertEqual(1, len(self.server.uploads))
+        self.assertEqual("batch", self.server.uploads[0]["purpose"])
+        self.assertEqual("ai-cat-batch.jsonl", self.server.uploads[0]["filename"])
+        self.assertEqual(
+            [("POST", "/v1/responses", "gpt-4.1")] * 2,
+            [
+                (line["method"], line["url"], line["body"]["model"])
+                for line in self.server.uploads[0]["lines"]
+            ],
+        )
+        self.assertEqual(
+            {"input_file_id": "file-1", "endpoint": "/v1/responses", "completion_window": "24h"},
+            self.server.batches["batch_1"],
+        )
+
+    def fail_batch(self):
+        self.server.batch_error = "The input file is invalid."
+
+    def test_failed_batch(self):
+        self.assert_failed_batch_leaves_the_files_untouched()
+
+
+class TestGoogleBatch(ProviderBatchTestCase):
+    MODEL = "google/gemini-2.5-flash"
+
+    def create_server(self):
+        return FakeGoogleBatchServer()
+
+    def create_ai_client(self, server_url):
+        ai_client = ai_cat.GoogleClient("api-key")
+        ai_client.URL_TPL_BATCHES = server_url + "/v1beta/models/{model}:batchGenerateContent?key={api_key}"
+        ai_client.URL_TPL_BATCH = server_url + "/v1beta/{name}?key={api_key}"
+
+        return ai_client
+
+    def test_conversations_are_sent_inline_and_results_are_read_from_inlined_responses(self):
+        self.assert_round_trip()
+
+        requests = self.server.batches["batches/1"]["batch"]["input_config"]["requests"]["requests"]
+
+        self.assertEqual(2, len(requests))
+        self.assertEqual(
+            "Please act as a helpful AI assistant.",
+            requests[0]["request"]["system_instruction"]["parts"][0]["text"],
+        )
+
+    def fail_batch(self):
+        self.server.failed_state = "BATCH_STATE_EXPIRED"
+
+    def test_failed_batch(self):
+        self.assert_failed_batch_leaves_the_files_untouched()
+
+
+class TestParallel(unittest.TestCase):
+    class SlowAiClient(ai_cat.AiClient):
+        def __init__(self):
+            super().__init__("api-key")
+
+            self.lock = threading.Lock()
+            self.running = 0
+            self.max_running = 0
+            self.requests = 0
+
+        def list_models(self) -> collections.abc.Sequence[str]:
+            return ["model1"]
+
+        def respond(self, model, conversation, temperature, reasoning, options=None):
+            with self.lock:
+                self.running += 1
+                self.requests += 1
+                self.max_running = max(self.max_running, self.running)
+
+            time.sleep(0.05)
+
+            with self.lock:
+                self.running -= 1
+
+            yield ai_cat.AiResponse(
+                is_delta=False,
+                is_reasoning=False,
+                is_status=False,
+                text="Re: " + conversation[-1].text,
+            )
+
+    def test_pending_conversations_are_answered_concurrently_within_limits(self):
+        ai_client = self.SlowAiClient()
+
+        def create_messenger():
+            return ai_cat.AiMessenger(
+                {"slow": ai_client},
+                ["slow/model1"],
+                system_prompt="Please act as a helpful AI assistant.",
+            )
+
+        answered = "# === User ===\n\nWhat is 6 * 7?\n\n# === AI ===\n\n42.\n"
+
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(5):
+                with open(os.path.join(directory, f"question{i}.md"), "w", encoding="utf-8") as f:
+                    f.write(f"# === User ===\n\nQuestion {i}?\n")
+
+            with open(os.path.join(directory, "answered.md"), "w", encoding="utf-8") as f:
+                f.write(answered)
+
+            exit_code = ai_cat.cmd_parallel(create_messenger, directory, jobs=4, provider_jobs={"slow": 2})
+
+            self.assertEqual(0, exit_code)
+            self.assertEqual(5, ai_client.requests)
+            self.assertEqual(2, ai_client.max_running)
+
+            for i in range(5):
+                with open(os.path.join(directory, f"question{i}.md"), "r", encoding="utf-8") as f:
+                    self.assertIn(f"# === AI ===\n\nRe: Question {i}?\n", f.read())
+
+            with open(os.path.join(directory, "answered.md"), "r", encoding="utf-8") as f:
+                self.assertEqual(answered, f.read())
+
+            exit_code = ai_cat.cmd_parallel(create_messenger, directory)
+
+            self.assertEqual(0, exit_code)
+            self.assertEqual(5, ai_client.requests)
+
+
+class TestConnectionPool(unittest.TestCase):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.server.client_addresses.append(self.client_address)
+            body = b"42."
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def test_connections_are_reused(self):
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.Handler)
+        server.client_addresses = []
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/"
+        connection_pool = ai_cat.ConnectionPool()
+        old_connection_pool = ai_cat.AiClient.connection_pool
+        ai_cat.AiClient.connection_pool = connection_pool
+
+        try:
+            responses = [ai_cat.AiClient.http_request("GET", url) for _ in range(3)]
+
+        finally:
+            ai_cat.AiClient.connection_pool = old_connection_pool
+            connection_pool.close()
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual([b"42."] * 3, responses)
+        self.assertEqual(3, len(server.client_addresses))
+        self.assertEqual(1, len(set(server.client_addresses)))
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_least_recently_used_responses_are_evicted(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            response_cache = ai_cat.ResponseCache(cache_dir, max_bytes=200)
+            now = time.time()
+
+            for i, key in enumerate(("a", "b", "c")):
+                response_cache.put(key, {"text": key * 50})
+                os.utime(os.path.join(cache_dir, key + ".json"), (now - 100 + i, now - 100 + i))
+
+            self.assertIsNotNone(response_cache.get("a"))
+
+            response_cache.put("d", {"text": "d" * 50})
+
+            self.assertIsNotNone(response_cache.get("a"))
+            self.assertIsNone(response_cache.get("b"))
+            self.assertIsNotNone(response_cache.get("c"))
+            self.assertIsNotNone(response_cache.get("d"))
+
+
+class TestDeepSeekClient(unittest.TestCase):
+    class ReplayingDeepSeekClient(ai_cat.DeepSeekClient):
+        def __init__(self, sse_events):
+            super().__init__("api-key")
+
+            self.sse_events = sse_events
+
+        def http_sse(self, method, url, headers=None, body=None, bufsize=4096):
+            return iter(self.sse_events)
+
+    def test_status_is_collected_from_first_and_final_chunks(self):
+        chunk = {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "model": "deepseek-chat",
+            "choices": [{"index": 0, "delta": {"content": "4"}, "finish_reason": None}],
+        }
+        last_chunk = json.loads(json.dumps(chunk))
+        last_chunk["choices"][0]["delta"]["content"] = "2."
+        last_chunk["choices"][0]["finish_reason"] = "stop"
+        last_chunk["usage"] = {"completion_tokens": 2}
+        ai_client = self.ReplayingDeepSeekClient(
+            [
+                ("", json.dumps(chunk)),
+                ("", json.dumps(last_chunk)),
+                ("", "[DONE]"),
+            ]
+        )
+        conversation = [ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?")]
+
+        responses = list(
+            ai_client.respond_streaming("deepseek-chat", conversation, 1.0, ai_cat.Reasoning.DEFAULT)
+        )
+
+        self.assertEqual("42.", "".join(r.text for r in responses if not r.is_status))
+        self.assertEqual(
+            {
+                "finish_reason": "stop",
+                "id": "chatcmpl-1",
+                "model": "deepseek-chat",
+                "usage.completion_tokens": 2,
+            },
+            responses[-1].status,
+        )
+
+
+class TestThinkTagScanner(unittest.TestCase):
+    def scan(self, chunks):
+        scanner = ai_cat.ThinkTagScanner()
+        reasoning = ""
+        text = ""
+
+        for chunk in chunks:
+            reasoning_delta, text_delta = scanner.feed(chunk)
+            reasoning += reasoning_delta
+            text += text_delta
+
+        reasoning_delta, text_delta = scanner.finish()
+
+        return reasoning + reasoning_delta, text + text_delta
+
+    def test_tags_split_at_any_offsets_are_recognized(self):
+        test_cases = (
+            ("\n<think>\nHmm, <b>42</b>.\n</think>\n\nThe Answer is 42.", ("\nHmm, <b>42</b>.\n", "The Answer is 42.")),
+            ("<think>Hmm.</think>42.", ("Hmm.", "42.")),
+            ("<think>Hmm. </thin", ("Hmm. </thin", "")),
+            ("<thin", ("", "<thin")),
+            ("42 is <think>not</think> reasoning.", ("", "42 is <think>not</think> reasoning.")),
+            ("<thinking>42.", ("", "<thinking>42.")),
+        )
+
+        for full_text, expected in test_cases:
+            self.assertEqual(expected, ai_cat.ThinkTagScanner.split(full_text), full_text)
+
+            for i in range(len(full_text) + 1):
+                for j in range(i, len(full_text) + 1):
+                    chunks = [full_text[:i], full_text[i:j], full_text[j:]]
+
+                    self.assertEqual(expected, self.scan(chunks), repr(chunks))
+
+            self.assertEqual(expected, self.scan(list(full_text)), full_text)
+
+
+class TestHttpRetries(unittest.TestCase):
+    class FakeConnection:
+        sock = None
+
+        def close(self):
+            pass
+
+    class FakeResponse:
+        def __init__(self, body):
+            self.body = body
+
+        def read1(self, size):
+            chunk, self.body = self.body[:size], self.body[size:]
+
+            return chunk
+
+    @classmethod
+    def create_flaky_client_cls(cls, failures):
+        class FlakyAiClient(ai_cat.AiClient):
+            RETRY_BASE_DELAY = 0.001
+
+            @staticmethod
+            def send_http_request(method, url, headers=None, body=None):
+                if len(failures) > 0:
+                    raise failures.pop(0)
+
+                return cls.FakeConnection(), cls.FakeResponse(b"42.")
+
+        return FlakyAiClient
+
+    def test_transient_errors_are_retried(self):
+        flaky_client_cls = self.create_flaky_client_cls(
+            [
+                ai_cat.HttpError(429, "Too Many Requests", "", {"retry-after": "0"}),
+                ConnectionResetError("Connection reset by peer"),
+                ai_cat.RequestTimeoutError("connect", 30.0),
+            ]
+        )
+
+        with ai_cat.RequestContext() as context:
+            response = flaky_client_cls.http_request("POST", "https://example.com/")
+
+        self.assertEqual(b"42.", response)
+        self.assertEqual(3, context.retries)
+        self.assertEqual(3, context.get_status()["http.retries"])
+
+    def test_permanent_errors_and_long_waits_are_not_retried(self):
+        for error in (
+                ai_cat.HttpError(400, "Bad Request", ""),
+                ai_cat.HttpError(429, "Too Many Requests", "", {"retry-after": "3600"}),
+                ai_cat.RequestTimeoutError("first byte", 600.0),
+                ai_cat.RequestTimeoutError("total", 900.0),
+        ):
+            flaky_client_cls = self.create_flaky_client_cls([error])
+
+            with ai_cat.RequestContext() as context:
+                self.assertRaises(
+                    type(error),
+                    flaky_client_cls.http_request,
+                    "POST",
+                    "https://example.com/",
+                )
+
+            self.assertEqual(0, context.retries)
+
+    def test_total_timeout_caps_other_timeouts(self):
+        context = ai_cat.RequestContext()
+        context.timeouts = ai_cat.RequestTimeouts(connect=10.0, first_byte=0.0, idle=60.0, total=30.0)
+
+        connect_timeout, connect_error = context.get_socket_timeout("connect", context.timeouts.connect)
+        first_byte_timeout, first_byte_error = context.get_socket_timeout("first byte", context.timeouts.first_byte)
+
+        self.assertEqual(10.0, connect_timeout)
+        self.assertEqual("connect", connect_error.kind)
+        self.assertLessEqual(first_byte_timeout, 30.0)
+        self.assertEqual("total", first_byte_error.kind)
+
+        context.start_time -= 31.0
+
+        self.assertRaises(
+            ai_cat.RequestTimeoutError,
+            context.get_socket_timeout,
+            "idle",
+            context.timeouts.idle,
+        )
+
+    def test_parse_retry_after(self):
+        self.assertEqual(1.5, ai_cat.parse_retry_after({"retry-after-ms": "1500"}, 0.0))
+        self.assertEqual(10.0, ai_cat.parse_retry_after({"retry-after": "Thu, 01 Jan 1970 00:00:20 GMT"}, 10.0))
+        self.assertEqual(
+            360.0,
+            ai_cat.parse_retry_after(
+                {
+                    "x-ratelimit-remaining-requests": "0",
+                    "x-ratelimit-reset-requests": "6m0s",
+                    "x-ratelimit-remaining-tokens": "5",
+                    "x-ratelimit-reset-tokens": "1h",
+                },
+                0.0,
+            ),
+        )
+        self.assertEqual(
+            30.0,
+            ai_cat.parse_retry_after(
+                {
+                    "anthropic-ratelimit-tokens-remaining": "0",
+                    "anthropic-ratelimit-tokens-reset": "1970-01-01T00:00:30Z",
+                },
+                0.0,
+            ),
+        )
+        self.assertIsNone(ai_cat.parse_retry_after({}, 0.0))
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_requests_are_paced_across_rate_limiter_instances(self):
+        headers = {
+            "x-ratelimit-limit-requests": "10",
+            "x-ratelimit-remaining-requests": "1",
+            "x-ratelimit-reset-requests": "9s",
+            "x-ratelimit-limit-tokens": "1000",
+            "x-ratelimit-remaining-tokens": "900",
+            "x-ratelimit-reset-tokens": "6s",
+        }
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, "ratelimits.json")
+            rate_limiter_1 = ai_cat.RateLimiter(file_name)
+            rate_limiter_2 = ai_cat.RateLimiter(file_name)
+            key = ai_cat.RateLimiter.make_key(
+                "https://api.example.com/v1/chat",
+                {"Authorization": "Bearer secret"},
+            )
+
+            rate_limiter_1.observe(key, headers, 100.0)
+
+            self.assertEqual(0.0, rate_limiter_1.acquire(key, 100, 100.0))
+            self.assertAlmostEqual(1.0, rate_limiter_2.acquire(key, 100, 100.0))
+            self.assertEqual(0.0, rate_limiter_2.acquire(key, 100, 101.0))
+            self.assertGreater(rate_limiter_2.acquire(key, 2000, 101.5), 0.0)
+            self.assertNotIn("secret", key)
+
+    def test_file_is_written_only_when_the_state_changes(self):
+        headers = {
+            "x-ratelimit-limit-requests": "10",
+            "x-ratelimit-remaining-requests": "1",
+            "x-ratelimit-reset-requests": "9s",
+        }
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, "ratelimits.json")
+            rate_limiter = ai_cat.RateLimiter(file_name)
+
+            def get_mtime_after_acquire(key):
+                os.utime(file_name, ns=(1000, 1000))
+                rate_limiter.acquire(key, 100, 100.0)
+
+                return os.stat(file_name).st_mtime_ns
+
+            rate_limiter.observe("limited", headers, 100.0)
+
+            self.assertNotEqual(1000, get_mtime_after_acquire("limited"))
+            self.assertEqual(1000, get_mtime_after_acquire("limited"))
+            self.assertEqual(1000, get_mtime_after_acquire("unlimited"))
+
+    def test_file_is_locked_with_msvcrt_when_fcntl_is_not_available(self):
+        class FakeMsvcrt:
+            LK_LOCK = 1
+            LK_UNLCK = 0
+
+            def __init__(self):
+                self.calls = []
+
+            def locking(self, fd, mode, nbytes):
+                self.calls.append((mode, os.lseek(fd, 0, os.SEEK_CUR), nbytes))
+
+        fake_msvcrt = FakeMsvcrt()
+        original_fcntl, original_msvcrt = ai_cat.fcntl, ai_cat.msvcrt
+        ai_cat.fcntl, ai_cat.msvcrt = None, fake_msvcrt
+
+        try:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                rate_limiter = ai_cat.RateLimiter(os.path.join(tmp_dir, "ratelimits.json"))
+                rate_limiter.observe(
+                    "limited",
+                    {
+                        "x-ratelimit-limit-requests": "10",
+                        "x-ratelimit-remaining-requests": "1",
+                        "x-ratelimit-reset-requests": "9s",
+                    },
+                    100.0,
+                )
+
+        finally:
+            ai_cat.fcntl, ai_cat.msvcrt = original_fcntl, original_msvcrt
+
+        self.assertEqual(
+            [(FakeMsvcrt.LK_LOCK, 0, 1), (FakeMsvcrt.LK_UNLCK, 0, 1)],
+            fake_msvcrt.calls,
+        )
+
+    def test_parse_rate_limits(self):
+        self.assertEqual(
+            {
+                "tokens": {"limit": 80000.0, "remaining": 0.0, "reset_at": 30.0},
+            },
+            ai_cat.parse_rate_limits(
+                {
+                    "anthropic-ratelimit-tokens-limit": "80000",
+                    "anthropic-ratelimit-tokens-remaining": "0",
+                    "anthropic-ratelimit-tokens-reset": "1970-01-01T00:00:30Z",
+                    "anthropic-ratelimit-requests-limit": "50",
+                    "content-type": "application/json",
+                },
+                0.0,
+            ),
+        )
+
+
+class TestGoogleClient(unittest.TestCase):
+    class RecordingGoogleClient(ai_cat.GoogleClient):
+        def __init__(self, responses):
+            super().__init__("api-key")
+
+            self.responses = responses
+            self.requests = []
+
+        def http_request(self, method, url, headers=None, body=None, bufsize=65536):
+            path = url.split("/v1beta/", 1)[1].split("?", 1)[0]
+            self.requests.append((method, path, None if body is None else json.loads(body)))
+            response = self.responses.pop(0)
+
+            if isinstance(response, Exception):
+                raise response
+
+            return response
+
+    ANSWER = json.dumps(
+        {"candidates": [{"content": {"role": "model", "parts": [{"text": "42."}]}}]}
+    ).encode("utf-8")
+
+    def test_long_system_prompt_is_cached_and_cache_is_reused(self):
+        conversation = [
+            ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="word " * 5000),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?"),
+        ]
+        created = json.dumps({"name": "cachedContents/abc"}).encode("utf-8")
+        ai_client = self.RecordingGoogleClient([created, self.ANSWER, self.ANSWER])
+
+        first = list(ai_client.respond("gemini", conversation, 1.0, ai_cat.Reasoning.DEFAULT))
+
+        conversation += [
+            ai_cat.Message(type=ai_cat.MessageType.AI, text="42."),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="Why?"),
+        ]
+        ai_client.set_persistent_state(json.loads(json.dumps(ai_client.get_persistent_state())))
+        second = list(ai_client.respond("gemini", conversation, 1.0, ai_cat.Reasoning.DEFAULT))
+
+        self.assertEqual(
+            [
+                "POST cachedContents",
+                "POST models/gemini:generateContent",
+                "POST models/gemini:generateContent",
+            ],
+            [f"{method} {path}" for method, path, body in ai_client.requests],
+        )
+        self.assertEqual("models/gemini", ai_client.requests[0][2]["model"])
+        self.assertIn("system_instruction", ai_client.requests[0][2])
+
+        for _, _, body in ai_client.requests[1:]:
+            self.assertEqual("cachedContents/abc", body["cachedContent"])
+            self.assertNotIn("system_instruction", body)
+
+        self.assertEqual(1, len(ai_client.requests[1][2]["contents"]))
+        self.assertEqual(3, len(ai_client.requests[2][2]["contents"]))
+        self.assertEqual("cachedContents/abc", first[-1].status["cachedContent"])
+        self.assertEqual("cachedContents/abc", second[-1].status["cachedContent"])
+
+    def test_whole_conversation_is_sent_when_cache_is_gone(self):
+        conversation = [
+            ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="word " * 5000),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?"),
+        ]
+        not_found = ai_cat.HttpError(403, "Forbidden", "CachedContent not found")
+        ai_client = self.RecordingGoogleClient([not_found, self.ANSWER])
+        ai_client.set_persistent_state(
+            {
+                "caches": [
+                    {
+                        "name": "cachedContents/gone",
+                        "model": "gemini",
+                        "message_count": 1,
+                        "prefix_hash": ai_cat.hash_conversation(conversation[:1]),
+                        "expire_time": time.time() + 3000,
+                    },
+                ],
+            }
+        )
+
+        responses = list(ai_client.respond("gemini", conversation, 1.0, ai_cat.Reasoning.DEFAULT))
+
+        self.assertEqual("42.", responses[0].text)
+        self.assertEqual("cachedContents/gone", ai_client.requests[0][2]["cachedContent"])
+        self.assertNotIn("cachedContent", ai_client.requests[1][2])
+        self.assertIn("system_instruction", ai_client.requests[1][2])
+        self.assertEqual([], ai_client.get_persistent_state()["caches"])
+
+    def test_errors_unrelated_to_the_cache_are_not_retried_without_it(self):
+        conversation = [
+            ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="word " * 5000),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="What is The Answer?"),
+        ]
+        invalid = ai_cat.HttpError(
+            400,
+            "Bad Request",
+            json.dumps(
+                {
+                    "error": {
+                        "code": 400,
+                        "message": "Invalid value at 'generation_config.temperature'",
+                        "status": "INVALID_ARGUMENT",
+                    },
+                }
+            ),
+        )
+        ai_client = self.RecordingGoogleClient([invalid, self.ANSWER])
+        ai_client.set_persistent_state(
+            {
+                "caches": [
+                    {
+                        "name": "cachedContents/abc",
+                        "model": "gemini",
+                        "message_count": 1,
+                        "prefix_hash": ai_cat.hash_conversation(conversation[:1]),
+                        "expire_time": time.time() + 3000,
+                    },
+                ],
+            }
+        )
+
+        with self.assertRaises(ai_cat.HttpError):
+            list(ai_client.respond("gemini", conversation, 1.0, ai_cat.Reasoning.DEFAULT))
+
+        self.assertEqual(1, len(ai_client.requests))
+        self.assertEqual(1, len(ai_client.get_persistent_state()["caches"]))
+
+
+class TestOpenAiClient(unittest.TestCase):
+    class RecordingOpenAiClient(ai_cat.OpenAiClient):
+        def __init__(self, responses):
+            super().__init__("api-key")
+
+            self.responses = responses
+            self.bodies = []
+            self.urls = []
+
+        def http_request(self, method, url, headers=None, body=None, bufsize=65536):
+            self.bodies.append(json.loads(body))
+            self.urls.append(url)
+            response = self.responses.pop(0)
+
+            if isinstance(response, Exception):
+                raise response
+
+            return response
+
+    def test_whole_conversation_is_sent_when_previous_response_is_not_found(self):
+        conversation = [
+            ai_cat.Message(type=ai_cat.MessageType.SYSTEM, text="System prompt."),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="What is a question?"),
+            ai_cat.Message(type=ai_cat.MessageType.AI, text="A sentence."),
+            ai_cat.Message(type=ai_cat.MessageType.USER, text="And what is The Answer?"),
+        ]
+        not_found = ai_cat.HttpError(
+            400,
+            "Bad Request",
+            '{"error": {"code": "previous_response_not_found"}}',
+        )
+        completed = json.dumps(
+            {
+                "id": "resp_2",
+                "output": [
+                    {
+                        "type": "message",
+                        "content": [{"type": "output_text", "text": "42."}],
+                    },
+                ],
+            }
+        ).encode("utf-8")
+        ai_client = self.RecordingOpenAiClient([completed, not_found, completed])
+        options = ai_cat.RequestOptions(previous_response_id="resp_1", previous_message_count=3)
+
+        stateful_responses = list(
+            ai_client.respond("gpt", conversation, 1.0, ai_cat.Reasoning.DEFAULT, options)
+        )
+        stateless_responses = list(
+            ai_client.respond("gpt", conversation, 1.0, ai_cat.Reasoning.DEFAULT, options)
+        )
+
+        self.assertEqual("42.", stateful_responses[0].text)
+        self.assertEqual("42.", stateless_responses[0].text)
+        self.assertEqual("resp_1", ai_client.bodies[0]["previous_response_id"])
+        self.assertEqual(
+            [{"role": "user", "content": "And what is The Answer?"}],
+            ai_client.bodies[0]["input"],
+        )
+        self.assertNotIn("previous_response_id", ai_client.bodies[2])
+        self.assertEqual(4, len(ai_client.bodies[2]["input"]))
+        self.assertEqual("resp_2", stateless_responses[-1].status["id"])
+
+    def test_prediction_is_sent_via_chat_completions(self):
+        conversation = [ai_cat.Message(type=ai_cat.MessageType.USER, text="Fix the typo: Teh Answer")]
+        not_supported = ai_cat.HttpError(
+            400,
+            "Bad Request",
+            '{"error": {"message": "Predicted outputs are not supported with this model."}}',
+        )
+        chat_completion = json.dumps(
+            {
+                "id": "chatcmpl-1",
+                "choices": [
+                    {
+                        "message": {"role": "assistant", "content": "The Answer"},
+                        "finish_reason": "stop",
+                    },
+                ],
+                "usage": {
+                    "completion_tokens_details": {
+                        "accepted_prediction_tokens": 2,
+                        "rejected_prediction_tokens": 1,
+                    },
+                },
+            }
+        ).encode("utf-8")
+        completed = json.dumps(
+            {
+                "id": "resp_1",
+                "output": [
+                    {
+                        "type": "message",
+                        "content": [{"type": "output_text", "text": "The Answer"}],
+                    },
+                ],
+            }
+        ).encode("utf-8")
+        ai_client = self.RecordingOpenAiClient([chat_completion, not_supported, completed])
+        options = ai_cat.RequestOptions(prediction="Teh Answer")
+
+        predicted_responses = list(
+            ai_client.respond("gpt", conversation, 1.0, ai_cat.Reasoning.DEFAULT, options)
+        )
+        fallback_responses = list(
+            ai_client.respond("o3", conversation, 1.0, ai_cat.Reasoning.DEFAULT, options)
+        )
+
+        self.assertEqual(ai_cat.OpenAiClient.URL_CHAT_COMPLETIONS, ai_client.urls[0])
+        self.assertEqual(
+            {"type": "content", "content": "Teh Answer"},
+            ai_client.bodies[0]["prediction"],
+        )
+        self.assertEqual("The Answer", predicted_responses[0].text)
+        self.assertEqual(
+            2,
+            predicted_responses[-1].status["usage.completion_tokens_details.accepted_prediction_tokens"],
+        )
+        self.assertEqual(
+            1,
+            predicted_responses[-1].status["usage.completion_tokens_details.rejected_prediction_tokens"],
+        )
+        self.assertEqual(ai_cat.OpenAiClient.URL_CHAT, ai_client.urls[2])
+        self.assertNotIn("prediction", ai_client.bodies[2])
+        self.assertEqual("The Answer", fallback_responses[0].text)
+        self.assertEqual("not supported by the model", fallback_responses[-1].status["prediction"])
+
+    def test_prediction_is_not_sent_with_max_tokens(self):
+        conversation = [ai_cat.Message(type=ai_cat.MessageType.USER, text="Fix the typo: Teh Answer")]
+        completed = json.dumps(
+            {
+                "id": "resp_1",
+                "output": [
+                    {
+                        "type": "message",
+                        "content": [{"type": "output_text", "text": "The Answer"}],
+                    },
+                ],
+            }
+        ).encode("utf-8")
+        ai_client = self.RecordingOpenAiClient([completed])
+        options = ai_cat.RequestOptions(prediction="Teh Answer", max_tokens=100)
+
+        responses = list(
+            ai_client.respond("gpt", conversation, 1.0, ai_cat.Reasoning.DEFAULT, options)
+        )
+
+        self.assertEqual([ai_cat.OpenAiClient.URL_CHAT], ai_client.urls)
+        self.assertNotIn("prediction", ai_client.bodies[0])
+        self.assertEqual(100, ai_client.bodies[0]["max_output_tokens"])
+        self.assertEqual("The Answer", responses[0].text)
+        self.assertEqual("not supported with max_tokens", responses[-1].status["prediction"])
 
 
 class FakeAiClient(ai_cat.AiClient):
@@ -1177,6 +3691,7 @@ class FakeAiClient(ai_cat.AiClient):
         self.temperature = None
         self.reasoning = None
         self.streaming = None
+        self.options = None
 
     def list_models(self) -> collections.abc.Sequence[str]:
         return ["model1", "model2"]
@@ -1187,12 +3702,14 @@ class FakeAiClient(ai_cat.AiClient):
             conversation: typing.Iterator[ai_cat.Message],
             temperature: float,
             reasoning: ai_cat.Reasoning,
+            options: typing.Optional[ai_cat.RequestOptions]=None,
     ) -> typing.Iterator[ai_cat.AiResponse]:
         yield from self._respond(
             model,
             conversation,
             temperature,
             reasoning,
+            options,
             streaming=False,
         )
 
@@ -1202,12 +3719,14 @@ class FakeAiClient(ai_cat.AiClient):
             conversation: typing.Iterator[ai_cat.Message],
             temperature: float,
             reasoning: ai_cat.Reasoning,
+            options: typing.Optional[ai_cat.RequestOptions]=None,
     ) -> typing.Iterator[ai_cat.AiResponse]:
         yield from self._respond(
             model,
             conversation,
             temperature,
             reasoning,
+            options,
             streaming=True,
         )
 
@@ -1217,12 +3736,14 @@ class FakeAiClient(ai_cat.AiClient):
             conversation: typing.Iterator[ai_cat.Message],
             temperature: float,
             reasoning: ai_cat.Reasoning,
+            options: typing.Optional[ai_cat.RequestOptions],
             streaming: bool,
     ) -> typing.Iterator[ai_cat.AiResponse]:
         self.model = model
         self.conversation = conversation
         self.temperature = temperature
         self.reasoning = reasoning
+        self.options = options
         self.streaming = streaming
 
         response = self.responses.pop(0)